@@ -3,6 +3,8 @@
 
 #include <memory>
 #include <vector>
+#include <map>
+#include <mutex>
 #include <random>
 #include <time.h>
 #include <cmath>
@@ -48,6 +50,24 @@ namespace mattersim {
         }
     };
 
+    /**
+     * A navigable location seen from some view of the panorama at the agent's location.
+     */
+    struct PanoramaViewpoint {
+        //! Viewpoint identifier
+        std::string viewpointId;
+        //! Viewpoint index into connectivity graph
+        unsigned int ix;
+        //! The view [0-35] the location is closest to the centre of
+        unsigned int absViewIndex;
+        //! Heading relative to looking forward horizontally, in (-pi, pi]
+        double rel_heading;
+        //! Elevation relative to looking forward horizontally
+        double rel_elevation;
+        //! Angular distance from the centre of the view absViewIndex
+        double distance;
+    };
+
     /**
      * Simulator state class.
      */
@@ -90,16 +110,39 @@ namespace mattersim {
         //! Translation component
         glm::vec3 pos;
         std::vector<bool> unobstructed;
-        GLuint cubemap_texture;
     };
 
-    typedef std::shared_ptr<Location> LocationPtr;
+    typedef std::shared_ptr<const Location> LocationPtr;
+    typedef std::vector<LocationPtr> LocationGraph;
+    typedef std::shared_ptr<const LocationGraph> LocationGraphPtr;
+
+    /**
+     * Process-wide cache of the parsed location graphs of the scans. The graphs are
+     * immutable and shared by every Simulator using the same navigation graph file,
+     * and are freed when the last Simulator holding them is closed or destroyed.
+     */
+    class LocationGraphCache {
+    public:
+        /**
+         * Returns the location graph in navGraphFile, parsing it if no Simulator holds it.
+         */
+        static LocationGraphPtr get(const std::string& navGraphFile);
+
+        /**
+         * Returns the number of location graphs currently held by some Simulator.
+         */
+        static size_t size();
+    private:
+        static std::mutex mutex;
+        static std::map<std::string, std::weak_ptr<const LocationGraph> > graphs;
+    };
 
     /**
      * Main class for accessing an instance of the simulator environment.
      */
     class Simulator {
         friend class SimulatorPython;
+        friend class SimulatorBatchPython;
     public:
         Simulator();
                       
@@ -186,6 +229,16 @@ namespace mattersim {
          *                    by the x-y plane (up is positive).
          */
         void makeAction(int index, double heading, double elevation);
+
+        /**
+         * Returns every location navigable from the agent's location in any of the 36
+         * discretized views, with the view it is closest to the centre of (the first
+         * such view, looking down first and turning right from the current heading).
+         * These are the locations a sweep of the views with makeAction would find,
+         * without moving the camera. Sorted by the magnitude of rel_heading. Requires
+         * discretized viewing angles.
+         */
+        std::vector<PanoramaViewpoint> getPanoramaNavigable();
         
         /**
          * Closes the environment and releases underlying texture resources, OpenGL contexts, etc.
@@ -197,6 +250,7 @@ namespace mattersim {
         void loadLocationGraph();
         void clearLocationGraph();
         void populateNavigable();
+        std::vector<ViewpointPtr> navigableFrom(double heading, double elevation);
         void loadTexture(int locationId);
         void setHeadingElevation(double heading, double elevation);
         void renderScene();
@@ -230,7 +284,12 @@ namespace mattersim {
         GLuint glShaderF;
         std::string datasetPath;
         std::string navGraphPath;
-        std::map<std::string, std::vector<LocationPtr> > scanLocations;
+        //! Location graphs of the scans visited, shared through the LocationGraphCache
+        std::map<std::string, LocationGraphPtr> scanLocations;
+        //! Location graph of the current scan
+        LocationGraphPtr locations;
+        //! Cubemap texture of each location of the current scan (0 if not loaded)
+        std::vector<GLuint> cubemapTextures;
         std::default_random_engine generator;
         Timer cpuLoadTimer;
         Timer gpuLoadTimer;
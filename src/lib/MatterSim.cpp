@@ -228,27 +228,18 @@ void Simulator::init() {
     initialized = true;
 }
 
-void Simulator::clearLocationGraph() {
-    if (renderingEnabled) {
-        for (auto loc : scanLocations[state->scanId]) {
-           glDeleteTextures(1, &loc->cubemap_texture);
-        }
-    }
-}
-
-void Simulator::loadLocationGraph() {
-    if (scanLocations.count(state->scanId) != 0) {
-        return;
-    }
+std::mutex LocationGraphCache::mutex;
+std::map<std::string, std::weak_ptr<const LocationGraph> > LocationGraphCache::graphs;
 
+LocationGraphPtr parseLocationGraph(const std::string& navGraphFile) {
     Json::Value root;
-    auto navGraphFile =  navGraphPath + "/" + state->scanId + "_connectivity.json";
     std::ifstream ifs(navGraphFile, std::ifstream::in);
     if (ifs.fail()){
         throw std::invalid_argument( "MatterSim: Could not open navigation graph file: " +
                 navGraphFile + ", is scan id valid?" );
     }
     ifs >> root;
+    auto graph = std::make_shared<LocationGraph>();
     for (auto viewpoint : root) {
         float posearr[16];
         int i = 0;
@@ -267,57 +258,147 @@ void Simulator::loadLocationGraph() {
             unobstructed.push_back(u.asBool());
         }
         auto viewpointId = viewpoint["image_id"].asString();
-        GLuint cubemap_texture = 0;
-        Location l{viewpoint["included"].asBool(), viewpointId, openglPose, pos, unobstructed, cubemap_texture};
-        scanLocations[state->scanId].push_back(std::make_shared<Location>(l));
+        Location l{viewpoint["included"].asBool(), viewpointId, openglPose, pos, unobstructed};
+        graph->push_back(std::make_shared<const Location>(l));
     }
+    return graph;
+}
+
+LocationGraphPtr LocationGraphCache::get(const std::string& navGraphFile) {
+    std::lock_guard<std::mutex> lock(mutex);
+    LocationGraphPtr graph = graphs[navGraphFile].lock();
+    if (!graph) {
+        // Not held by any Simulator, so parse it (again)
+        graph = parseLocationGraph(navGraphFile);
+        graphs[navGraphFile] = graph;
+    }
+    return graph;
+}
+
+size_t LocationGraphCache::size() {
+    std::lock_guard<std::mutex> lock(mutex);
+    for (auto it = graphs.begin(); it != graphs.end(); ) {
+        if (it->second.expired()) {
+            it = graphs.erase(it);
+        } else {
+            ++it;
+        }
+    }
+    return graphs.size();
+}
+
+void Simulator::clearLocationGraph() {
+    if (renderingEnabled) {
+        for (auto texture : cubemapTextures) {
+           glDeleteTextures(1, &texture);
+        }
+    }
+    cubemapTextures.clear();
+}
+
+void Simulator::loadLocationGraph() {
+    LocationGraphPtr& graph = scanLocations[state->scanId];
+    if (!graph) {
+        graph = LocationGraphCache::get(navGraphPath + "/" + state->scanId + "_connectivity.json");
+    }
+    locations = graph;
+    cubemapTextures.assign(locations->size(), 0);
 }
 
 void Simulator::populateNavigable() {
+    state->navigableLocations = navigableFrom(state->heading, state->elevation);
+}
+
+std::vector<ViewpointPtr> Simulator::navigableFrom(double heading, double elevation) {
     std::vector<ViewpointPtr> updatedNavigable;
     updatedNavigable.push_back(state->location);
     unsigned int idx = state->location->ix;
     unsigned int i = 0;
     cv::Point3f curPos = state->location->point;
-    double adjustedheading = M_PI/2.0 - state->heading;
+    double adjustedheading = M_PI/2.0 - heading;
     glm::vec3 camera_horizon_dir(cos(adjustedheading), sin(adjustedheading), 0.f);
     double cos_half_hfov = cos(vfov * width / height / 2.0);
-    for (unsigned int i = 0; i < scanLocations[state->scanId].size(); ++i) {
+    for (unsigned int i = 0; i < locations->size(); ++i) {
         if (i == idx) {
             // Current location is pushed first
             continue;
         }
-        if (scanLocations[state->scanId][idx]->unobstructed[i] && scanLocations[state->scanId][i]->included) {
+        if ((*locations)[idx]->unobstructed[i] && (*locations)[i]->included) {
             // Check if visible between camera left and camera right
-            glm::vec3 target_dir = scanLocations[state->scanId][i]->pos - scanLocations[state->scanId][idx]->pos;
+            glm::vec3 target_dir = (*locations)[i]->pos - (*locations)[idx]->pos;
             double rel_distance = glm::length(target_dir);
             double tar_z = target_dir.z;
             target_dir.z = 0.f; // project to xy plane
-            double rel_elevation = atan2(tar_z, glm::length(target_dir)) - state->elevation;
+            double rel_elevation = atan2(tar_z, glm::length(target_dir)) - elevation;
             glm::vec3 normed_target_dir = glm::normalize(target_dir);
             double cos_angle = glm::dot(normed_target_dir, camera_horizon_dir);
             if (cos_angle >= cos_half_hfov) {
-                glm::vec3 pos(scanLocations[state->scanId][i]->pos);
+                glm::vec3 pos((*locations)[i]->pos);
                 double rel_heading = atan2( target_dir.x*camera_horizon_dir.y - target_dir.y*camera_horizon_dir.x, 
                         target_dir.x*camera_horizon_dir.x + target_dir.y*camera_horizon_dir.y );
-                Viewpoint v{scanLocations[state->scanId][i]->viewpointId, i, cv::Point3f(pos[0], pos[1], pos[2]), 
+                Viewpoint v{(*locations)[i]->viewpointId, i, cv::Point3f(pos[0], pos[1], pos[2]), 
                       rel_heading, rel_elevation, rel_distance};
                 updatedNavigable.push_back(std::make_shared<Viewpoint>(v));
             }
         }
     }
     std::sort(updatedNavigable.begin(), updatedNavigable.end(), ViewpointPtrComp());
-    state->navigableLocations = updatedNavigable;
+    return updatedNavigable;
+}
+
+std::vector<PanoramaViewpoint> Simulator::getPanoramaNavigable() {
+    if (!initialized || !state->location) {
+        throw std::logic_error( "MatterSim: getPanoramaNavigable called before newEpisode" );
+    }
+    if (!discretizeViews) {
+        throw std::logic_error( "MatterSim: getPanoramaNavigable requires discretized viewing angles" );
+    }
+    double headingIncrement = M_PI*2.0/headingCount;
+    unsigned int startHeadingStep = state->viewIndex % headingCount;
+    std::vector<PanoramaViewpoint> panorama;
+    std::map<unsigned int, size_t> panoramaIndex;
+    for (unsigned int relViewIndex = 0; relViewIndex < 3*headingCount; ++relViewIndex) {
+        unsigned int headingStep = (startHeadingStep + relViewIndex % headingCount) % headingCount;
+        int elevationStep = relViewIndex / headingCount - 1;
+        unsigned int absViewIndex = headingStep + (elevationStep + 1) * headingCount;
+        // the view's heading and elevation relative to looking forward horizontally
+        double baseRelHeading = (relViewIndex % headingCount) * headingIncrement;
+        double baseRelElevation = elevationStep * elevationIncrement;
+        auto navigable = navigableFrom(headingStep * headingIncrement, elevationStep * elevationIncrement);
+        // the first is the agent's location
+        for (unsigned int j = 1; j < navigable.size(); ++j) {
+            const ViewpointPtr& loc = navigable[j];
+            double distance = sqrt(loc->rel_heading*loc->rel_heading + loc->rel_elevation*loc->rel_elevation);
+            auto found = panoramaIndex.find(loc->ix);
+            if (found == panoramaIndex.end() || distance < panorama[found->second].distance) {
+                double rel_heading = baseRelHeading + loc->rel_heading;
+                rel_heading -= 2.0*M_PI*std::nearbyint(rel_heading/(2.0*M_PI));
+                PanoramaViewpoint p{loc->viewpointId, loc->ix, absViewIndex,
+                      rel_heading, baseRelElevation + loc->rel_elevation, distance};
+                if (found == panoramaIndex.end()) {
+                    panoramaIndex[loc->ix] = panorama.size();
+                    panorama.push_back(p);
+                } else {
+                    panorama[found->second] = p;
+                }
+            }
+        }
+    }
+    std::stable_sort(panorama.begin(), panorama.end(),
+        [](const PanoramaViewpoint& l, const PanoramaViewpoint& r) {
+            return fabs(l.rel_heading) < fabs(r.rel_heading);
+        });
+    return panorama;
 }
 
 void Simulator::loadTexture(int locationId) {
-    if (glIsTexture(scanLocations[state->scanId][locationId]->cubemap_texture)){
+    if (glIsTexture(cubemapTextures[locationId])){
         // Check if it's already loaded
         return;
     }
     cpuLoadTimer.Start();
     auto datafolder = datasetPath + "/v1/scans/" + state->scanId + "/matterport_skybox_images/";
-    auto viewpointId = scanLocations[state->scanId][locationId]->viewpointId;
+    auto viewpointId = (*locations)[locationId]->viewpointId;
     auto xpos = cv::imread(datafolder + viewpointId + "_skybox2_sami.jpg");
     auto xneg = cv::imread(datafolder + viewpointId + "_skybox4_sami.jpg");
     auto ypos = cv::imread(datafolder + viewpointId + "_skybox0_sami.jpg");
@@ -329,9 +410,9 @@ void Simulator::loadTexture(int locationId) {
     }
     cpuLoadTimer.Stop();
     gpuLoadTimer.Start();
-    setupCubeMap(scanLocations[state->scanId][locationId]->cubemap_texture, xpos, xneg, ypos, yneg, zpos, zneg);
+    setupCubeMap(cubemapTextures[locationId], xpos, xneg, ypos, yneg, zpos, zneg);
     gpuLoadTimer.Stop();
-    if (!glIsTexture(scanLocations[state->scanId][locationId]->cubemap_texture)){
+    if (!glIsTexture(cubemapTextures[locationId])){
         throw std::runtime_error( "MatterSim: loadTexture failed" );
     }
 }
@@ -386,7 +467,7 @@ void Simulator::newEpisode(const std::string& scanId,
     }
     state->step = 0;
     setHeadingElevation(heading, elevation);
-    if (state->scanId != scanId) {
+    if (state->scanId != scanId || !locations) {
         // Moving to a new building...
         clearLocationGraph();
         state->scanId = scanId;
@@ -395,21 +476,21 @@ void Simulator::newEpisode(const std::string& scanId,
     int ix = -1;
     if (viewpointId.empty()) {
         // Generate a random starting viewpoint
-        std::uniform_int_distribution<int> distribution(0,scanLocations[state->scanId].size()-1);
+        std::uniform_int_distribution<int> distribution(0,locations->size()-1);
         int start_ix = distribution(generator);  // generates random starting index
         ix = start_ix;
-        while (!scanLocations[state->scanId][ix]->included) { // Don't start at an excluded viewpoint
+        while (!(*locations)[ix]->included) { // Don't start at an excluded viewpoint
             ix++;
-            if (ix >= scanLocations[state->scanId].size()) ix = 0;
+            if (ix >= locations->size()) ix = 0;
             if (ix == start_ix) {
                 throw std::logic_error( "MatterSim: ScanId: " + scanId + " has no included viewpoints!");
             }
         }
     } else {
         // Find index of selected viewpoint
-        for (int i = 0; i < scanLocations[state->scanId].size(); ++i) {
-            if (scanLocations[state->scanId][i]->viewpointId == viewpointId) {
-                if (!scanLocations[state->scanId][i]->included) {
+        for (int i = 0; i < locations->size(); ++i) {
+            if ((*locations)[i]->viewpointId == viewpointId) {
+                if (!(*locations)[i]->included) {
                     throw std::invalid_argument( "MatterSim: ViewpointId: " +
                             viewpointId + ", is excluded from the connectivity graph." );
                 }
@@ -422,8 +503,8 @@ void Simulator::newEpisode(const std::string& scanId,
                     viewpointId + ", is viewpoint id valid?" );
         }
     }
-    glm::vec3 pos(scanLocations[state->scanId][ix]->pos);
-    Viewpoint v{scanLocations[state->scanId][ix]->viewpointId, (unsigned int)ix,
+    glm::vec3 pos((*locations)[ix]->pos);
+    Viewpoint v{(*locations)[ix]->viewpointId, (unsigned int)ix,
           cv::Point3f(pos[0], pos[1], pos[2]), 0.0, 0.0, 0.0};
     state->location = std::make_shared<Viewpoint>(v);
     populateNavigable();
@@ -442,7 +523,7 @@ void Simulator::renderScene() {
     renderTimer.Start();
     glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT);
     // Scale and move the cubemap model into position
-    Model = scanLocations[state->scanId][state->location->ix]->rot * Scale;
+    Model = (*locations)[state->location->ix]->rot * Scale;
     // Opengl camera looking down -z axis. Rotate around x by 90deg (now looking down +y). Keep rotating for - elevation.
     RotateX = glm::rotate(glm::mat4(1.0f), -(float)M_PI / 2.0f - (float)state->elevation, glm::vec3(1.0f, 0.0f, 0.0f));
     // Rotate camera for heading, positive heading will turn right.
@@ -454,7 +535,7 @@ void Simulator::renderScene() {
     glBindFramebuffer(GL_FRAMEBUFFER, FramebufferName);
 #endif
     glViewport(0, 0, width, height);
-    glBindTexture(GL_TEXTURE_CUBE_MAP, scanLocations[state->scanId][state->location->ix]->cubemap_texture);
+    glBindTexture(GL_TEXTURE_CUBE_MAP, cubemapTextures[state->location->ix]);
     glDrawElements(GL_QUADS, sizeof(cube_indices)/sizeof(GLushort), GL_UNSIGNED_SHORT, 0);
     cv::Mat img(height, width, CV_8UC3);
     //use fast 4-byte alignment (default anyway) if possible
@@ -491,7 +572,7 @@ void Simulator::makeAction(int index, double heading, double elevation) {
     populateNavigable();
     if (renderingEnabled) {
         // loading cubemap
-        if (!glIsTexture(scanLocations[state->scanId][state->location->ix]->cubemap_texture)) {
+        if (!glIsTexture(cubemapTextures[state->location->ix])) {
             loadTexture(state->location->ix);
         }
         renderScene();
@@ -529,6 +610,9 @@ void Simulator::close() {
             cv::destroyAllWindows();
 #endif
         }
+        // release the location graphs, freeing any no other Simulator holds
+        scanLocations.clear();
+        locations.reset();
         initialized = false;
     }
 }
@@ -1,7 +1,12 @@
 #include <pybind11/pybind11.h>
+#include <pybind11/numpy.h>
+#include <pybind11/stl.h>
 #include <numpy/ndarrayobject.h>
 #include <numpy/npy_math.h>
 #include <iostream>
+#include <sstream>
+#include <thread>
+#include <exception>
 #include "MatterSim.hpp"
 
 namespace py = pybind11;
@@ -67,6 +72,66 @@ namespace mattersim {
             return numpyArray;
         }
     };
+    /**
+     * A navigable location, as a record of the structured array SimStateView::navigable.
+     */
+    struct NavigableRecord {
+        uint32_t ix;
+        float point[3];
+        double rel_heading;
+        double rel_elevation;
+        double rel_distance;
+    };
+
+    /**
+     * A lighter SimState: the navigable locations are a structured array (with
+     * their viewpoint ids in a list) instead of a ViewPoint object each, and the
+     * image is a view of the simulator's buffer, or None if rendering is
+     * disabled, instead of a copy.
+     */
+    class SimStateView {
+    public:
+        SimStateView(SimStatePtr state, bool renderingEnabled)
+            : scanId{state->scanId},
+              step{state->step},
+              viewIndex{state->viewIndex},
+              heading{state->heading},
+              elevation{state->elevation},
+              rgb{py::none()},
+              navigable(state->navigableLocations.size()) {
+            if (renderingEnabled) {
+                // each render makes a new image, so this copy of its header keeps the buffer alive and unchanged
+                cv::Mat *image = new cv::Mat(state->rgb);
+                py::capsule owner(image, [](void *mat) { delete reinterpret_cast<cv::Mat*>(mat); });
+                rgb = py::array_t<uint8_t>(
+                    {(size_t)image->rows, (size_t)image->cols, (size_t)3},
+                    {(size_t)image->step[0], (size_t)3, (size_t)1},
+                    image->data, owner);
+            }
+            NavigableRecord *records = navigable.mutable_data();
+            for (auto& viewpoint : state->navigableLocations) {
+                navigableViewpointIds.append(viewpoint->viewpointId);
+                records->ix = viewpoint->ix;
+                records->point[0] = viewpoint->point.x;
+                records->point[1] = viewpoint->point.y;
+                records->point[2] = viewpoint->point.z;
+                records->rel_heading = viewpoint->rel_heading;
+                records->rel_elevation = viewpoint->rel_elevation;
+                records->rel_distance = viewpoint->rel_distance;
+                ++records;
+            }
+        }
+        std::string scanId;
+        unsigned int step;
+        unsigned int viewIndex;
+        double heading;
+        double elevation;
+        py::object rgb;
+        //! Viewpoint ids of the navigable locations, the first being the agent's location
+        py::list navigableViewpointIds;
+        //! Navigable locations, the first being the agent's location
+        py::array_t<NavigableRecord> navigable;
+    };
     #if PY_MAJOR_VERSION >= 3
         void* init_numpy() {
             import_array();
@@ -116,20 +181,222 @@ namespace mattersim {
         SimStatePython *getState() {
             return new SimStatePython(sim.getState(), sim.renderingEnabled);
         }
+        SimStateView getStateView() {
+            return SimStateView(sim.getState(), sim.renderingEnabled);
+        }
         void makeAction(int index, double heading, double elevation) {
             sim.makeAction(index, heading, elevation);
         }
+        py::list getPanoramaNavigable() {
+            // entries of the adj_loc_list used by the R2R environment
+            py::list adjLocList;
+            for (auto& viewpoint : sim.getPanoramaNavigable()) {
+                py::dict adjDict;
+                adjDict["absViewIndex"] = viewpoint.absViewIndex;
+                adjDict["nextViewpointId"] = viewpoint.viewpointId;
+                adjDict["rel_heading"] = viewpoint.rel_heading;
+                adjDict["rel_elevation"] = viewpoint.rel_elevation;
+                adjDict["distance"] = viewpoint.distance;
+                adjLocList.append(adjDict);
+            }
+            return adjLocList;
+        }
         void close() {
             sim.close();
         }
     private:
         Simulator sim;
     };
+
+    /**
+     * A batch of simulators, stepped together by one call per operation. The
+     * simulators are advanced with the GIL released, split over numThreads
+     * threads if rendering is disabled (rendering contexts are bound to the
+     * thread that made them, so rendering simulators are always advanced on
+     * the calling thread). Calls operate on the first n simulators, where n
+     * is the length of their arguments.
+     */
+    class SimulatorBatchPython {
+    public:
+        SimulatorBatchPython(unsigned int size, unsigned int numThreads=1)
+            : numThreads{std::max(numThreads, 1u)} {
+            init_numpy();
+            for (unsigned int i = 0; i < size; ++i) {
+                sims.emplace_back(new Simulator());
+            }
+        }
+        unsigned int size() {
+            return sims.size();
+        }
+        void setDatasetPath(std::string path) {
+            for (auto& sim : sims) sim->setDatasetPath(path);
+        }
+        void setNavGraphPath(std::string path) {
+            for (auto& sim : sims) sim->setNavGraphPath(path);
+        }
+        void setCameraResolution(int width, int height) {
+            for (auto& sim : sims) sim->setCameraResolution(width, height);
+        }
+        void setCameraVFOV(double vfov) {
+            for (auto& sim : sims) sim->setCameraVFOV(vfov);
+        }
+        void setRenderingEnabled(bool value) {
+            for (auto& sim : sims) sim->setRenderingEnabled(value);
+        }
+        void setDiscretizedViewingAngles(bool value) {
+            for (auto& sim : sims) sim->setDiscretizedViewingAngles(value);
+        }
+        void init() {
+            for (auto& sim : sims) sim->init();
+        }
+        void newEpisodes(const std::vector<std::string>& scanIds,
+                         const std::vector<std::string>& viewpointIds,
+                         const std::vector<double>& headings,
+                         const std::vector<double>& elevations) {
+            size_t n = checkSize(scanIds.size());
+            if (viewpointIds.size() != n || headings.size() != n || elevations.size() != n) {
+                throw std::invalid_argument("MatterSim: newEpisodes arguments should have the same length");
+            }
+            forEach(n, [&](size_t i) {
+                sims[i]->newEpisode(scanIds[i], viewpointIds[i], headings[i], elevations[i]);
+            });
+        }
+        void makeActions(const std::vector<int>& indices,
+                         const std::vector<double>& headings,
+                         const std::vector<double>& elevations) {
+            size_t n = checkSize(indices.size());
+            if (headings.size() != n || elevations.size() != n) {
+                throw std::invalid_argument("MatterSim: makeActions arguments should have the same length");
+            }
+            forEach(n, [&](size_t i) {
+                sims[i]->makeAction(indices[i], headings[i], elevations[i]);
+            });
+        }
+        /**
+         * The states of the first n simulators, as a dict of arrays. The
+         * navigable locations of simulator i are the rows
+         * [navigableOffsets[i], navigableOffsets[i + 1]) of the navigable*
+         * arrays, the first of which is the current location. Viewpoints are
+         * given by their index in the connectivity graph of the scan. Images
+         * aren't included.
+         */
+        py::dict getStates(size_t n) {
+            checkSize(n);
+            std::vector<SimStatePtr> states;
+            size_t numNavigable = 0;
+            for (size_t i = 0; i < n; ++i) {
+                states.push_back(sims[i]->getState());
+                numNavigable += states.back()->navigableLocations.size();
+            }
+            py::array_t<unsigned int> step(n), viewIndex(n), locationIx(n);
+            py::array_t<double> heading(n), elevation(n);
+            py::array_t<int64_t> navigableOffsets(n + 1);
+            py::array_t<unsigned int> navigableIx(numNavigable);
+            py::array_t<float> navigablePoint(std::vector<size_t>{numNavigable, 3});
+            py::array_t<double> navigableRelHeading(numNavigable), navigableRelElevation(numNavigable),
+                navigableRelDistance(numNavigable);
+            py::list scanIds;
+            auto stepData = step.mutable_unchecked<1>();
+            auto viewIndexData = viewIndex.mutable_unchecked<1>();
+            auto locationIxData = locationIx.mutable_unchecked<1>();
+            auto headingData = heading.mutable_unchecked<1>();
+            auto elevationData = elevation.mutable_unchecked<1>();
+            auto offsetData = navigableOffsets.mutable_unchecked<1>();
+            auto ixData = navigableIx.mutable_unchecked<1>();
+            auto pointData = navigablePoint.mutable_unchecked<2>();
+            auto relHeadingData = navigableRelHeading.mutable_unchecked<1>();
+            auto relElevationData = navigableRelElevation.mutable_unchecked<1>();
+            auto relDistanceData = navigableRelDistance.mutable_unchecked<1>();
+            size_t k = 0;
+            for (size_t i = 0; i < n; ++i) {
+                const SimStatePtr& state = states[i];
+                scanIds.append(state->scanId);
+                stepData(i) = state->step;
+                viewIndexData(i) = state->viewIndex;
+                locationIxData(i) = state->location->ix;
+                headingData(i) = state->heading;
+                elevationData(i) = state->elevation;
+                offsetData(i) = k;
+                for (auto& viewpoint : state->navigableLocations) {
+                    ixData(k) = viewpoint->ix;
+                    pointData(k, 0) = viewpoint->point.x;
+                    pointData(k, 1) = viewpoint->point.y;
+                    pointData(k, 2) = viewpoint->point.z;
+                    relHeadingData(k) = viewpoint->rel_heading;
+                    relElevationData(k) = viewpoint->rel_elevation;
+                    relDistanceData(k) = viewpoint->rel_distance;
+                    ++k;
+                }
+            }
+            offsetData(n) = k;
+            py::dict result;
+            result["scanId"] = scanIds;
+            result["step"] = step;
+            result["viewIndex"] = viewIndex;
+            result["locationIx"] = locationIx;
+            result["heading"] = heading;
+            result["elevation"] = elevation;
+            result["navigableOffsets"] = navigableOffsets;
+            result["navigableIx"] = navigableIx;
+            result["navigablePoint"] = navigablePoint;
+            result["navigableRelHeading"] = navigableRelHeading;
+            result["navigableRelElevation"] = navigableRelElevation;
+            result["navigableRelDistance"] = navigableRelDistance;
+            return result;
+        }
+        void close() {
+            for (auto& sim : sims) sim->close();
+        }
+    private:
+        size_t checkSize(size_t n) {
+            if (n > sims.size()) {
+                std::stringstream msg;
+                msg << "MatterSim: " << n << " states for a batch of " << sims.size() << " simulators";
+                throw std::invalid_argument(msg.str());
+            }
+            return n;
+        }
+        template <typename F>
+        void forEach(size_t n, F f) {
+            py::gil_scoped_release release;
+            size_t threads = std::min<size_t>(numThreads, n);
+            if (threads <= 1 || (n > 0 && sims[0]->renderingEnabled)) {
+                for (size_t i = 0; i < n; ++i) {
+                    f(i);
+                }
+                return;
+            }
+            std::vector<std::exception_ptr> errors(threads);
+            std::vector<std::thread> workers;
+            for (size_t t = 0; t < threads; ++t) {
+                workers.emplace_back([&, t]() {
+                    try {
+                        for (size_t i = t; i < n; i += threads) {
+                            f(i);
+                        }
+                    } catch (...) {
+                        errors[t] = std::current_exception();
+                    }
+                });
+            }
+            for (auto& worker : workers) {
+                worker.join();
+            }
+            for (auto& error : errors) {
+                if (error) std::rethrow_exception(error);
+            }
+        }
+        std::vector<std::unique_ptr<Simulator> > sims;
+        unsigned int numThreads;
+    };
 }
 
 using namespace mattersim;
 
 PYBIND11_MODULE(MatterSim, m) {
+    m.def("locationGraphCacheSize", &LocationGraphCache::size,
+          "Number of scan location graphs currently shared by the simulators of this process");
+    PYBIND11_NUMPY_DTYPE(NavigableRecord, ix, point, rel_heading, rel_elevation, rel_distance);
     py::class_<ViewPointPython>(m, "ViewPoint")
         .def_readonly("viewpointId", &ViewPointPython::viewpointId)
         .def_readonly("ix", &ViewPointPython::ix)
@@ -146,6 +413,15 @@ PYBIND11_MODULE(MatterSim, m) {
         .def_readonly("elevation", &SimStatePython::elevation)
         .def_readonly("viewIndex", &SimStatePython::viewIndex)
         .def_readonly("navigableLocations", &SimStatePython::navigableLocations);
+    py::class_<SimStateView>(m, "SimStateView")
+        .def_readonly("scanId", &SimStateView::scanId)
+        .def_readonly("step", &SimStateView::step)
+        .def_readonly("rgb", &SimStateView::rgb)
+        .def_readonly("heading", &SimStateView::heading)
+        .def_readonly("elevation", &SimStateView::elevation)
+        .def_readonly("viewIndex", &SimStateView::viewIndex)
+        .def_readonly("navigableViewpointIds", &SimStateView::navigableViewpointIds)
+        .def_readonly("navigable", &SimStateView::navigable);
     py::class_<SimulatorPython>(m, "Simulator")
         .def(py::init<>())
         .def("setDatasetPath", &SimulatorPython::setDatasetPath)
@@ -159,8 +435,24 @@ PYBIND11_MODULE(MatterSim, m) {
         .def("setElevationLimits", &SimulatorPython::setElevationLimits)
         .def("newEpisode", &SimulatorPython::newEpisode)
         .def("getState", &SimulatorPython::getState, py::return_value_policy::take_ownership)
+        .def("getStateView", &SimulatorPython::getStateView)
         .def("makeAction", &SimulatorPython::makeAction)
+        .def("getPanoramaNavigable", &SimulatorPython::getPanoramaNavigable)
         .def("close", &SimulatorPython::close);
+    py::class_<SimulatorBatchPython>(m, "SimulatorBatch")
+        .def(py::init<unsigned int, unsigned int>(), py::arg("size"), py::arg("numThreads")=1)
+        .def("size", &SimulatorBatchPython::size)
+        .def("setDatasetPath", &SimulatorBatchPython::setDatasetPath)
+        .def("setNavGraphPath", &SimulatorBatchPython::setNavGraphPath)
+        .def("setCameraResolution", &SimulatorBatchPython::setCameraResolution)
+        .def("setCameraVFOV", &SimulatorBatchPython::setCameraVFOV)
+        .def("setRenderingEnabled", &SimulatorBatchPython::setRenderingEnabled)
+        .def("setDiscretizedViewingAngles", &SimulatorBatchPython::setDiscretizedViewingAngles)
+        .def("init", &SimulatorBatchPython::init)
+        .def("newEpisodes", &SimulatorBatchPython::newEpisodes)
+        .def("makeActions", &SimulatorBatchPython::makeActions)
+        .def("getStates", &SimulatorBatchPython::getStates)
+        .def("close", &SimulatorBatchPython::close);
 }
 
 
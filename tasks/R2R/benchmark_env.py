@@ -0,0 +1,278 @@
+''' Measure the throughput of R2RBatch reset, step and observe over a sweep
+    of batch sizes, beam sizes and image feature types, and compare it with a
+    stored baseline. Usage, from the repo root:
+
+    python tasks/R2R/benchmark_env.py --output env_benchmark.json
+    python tasks/R2R/benchmark_env.py --baseline env_benchmark.json
+
+    With --synthetic (or if the R2R data isn't there) the benchmark runs on
+    randomly generated scans, instructions and features, written to a
+    temporary directory '''
+
+import os
+import sys
+import json
+import time
+import base64
+import random
+import shutil
+import argparse
+import tempfile
+import itertools
+
+import numpy as np
+import networkx as nx
+
+import paths
+from env import R2RBatch, ImageFeatures, NoImageFeatures, MeanPooledImageFeatures, MemmapMeanPooledImageFeatures
+from feature_store import convert_mean_pooled_tsv, quantize_feature_store
+from utils import load_nav_graphs
+
+
+FEATURE_TYPES = ['none', 'mean_pooled', 'memmap_float32', 'memmap_float16', 'memmap_int8']
+
+METRICS = ['resets_per_sec', 'steps_per_sec', 'observations_per_sec', 'simulator_calls_per_observation']
+
+# metrics where smaller is better
+LOWER_IS_BETTER = ['simulator_calls_per_observation']
+
+
+def make_image_features(feature_type):
+    if feature_type == 'none':
+        return NoImageFeatures()
+    elif feature_type == 'mean_pooled':
+        return MeanPooledImageFeatures(['imagenet'])
+    else:
+        return MemmapMeanPooledImageFeatures(['imagenet'], dtype=feature_type[len('memmap_'):])
+
+
+def write_synthetic_fixture(root, n_scans, n_viewpoints, n_paths, seed=1):
+    ''' Scans of n_viewpoints on a jittered grid, connected to their grid
+        neighbours, with shortest paths between random viewpoints as the
+        instructions of the "synthetic" split, and random features in both TSV
+        and binary stores. Relative paths are as in the repo root '''
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(root, 'connectivity'))
+    os.makedirs(os.path.join(root, 'tasks/R2R/data'))
+    os.makedirs(os.path.join(root, os.path.dirname(paths.mean_pooled_feature_store_paths['imagenet'])), exist_ok=True)
+    side = int(np.ceil(np.sqrt(n_viewpoints)))
+    scans = ['synthetic%02d' % i for i in range(n_scans)]
+    for scan in scans:
+        viewpoints = ['%s_%03d' % (scan, i) for i in range(n_viewpoints)]
+        grid = [(i // side, i % side) for i in range(n_viewpoints)]
+        data = []
+        for i, (row, col) in enumerate(grid):
+            pose = np.eye(4)
+            pose[:3, 3] = [2.0 * col + rng.uniform(-0.4, 0.4), 2.0 * row + rng.uniform(-0.4, 0.4), 1.5]
+            data.append({
+                'image_id': viewpoints[i],
+                'pose': pose.flatten().tolist(),
+                'included': True,
+                'unobstructed': [j != i and max(abs(row - other_row), abs(col - other_col)) <= 1
+                                 for j, (other_row, other_col) in enumerate(grid)]})
+        with open(os.path.join(root, 'connectivity/%s_connectivity.json' % scan), 'w') as f:
+            json.dump(data, f)
+    with open(os.path.join(root, 'connectivity/scans.txt'), 'w') as f:
+        f.write('\n'.join(scans) + '\n')
+
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        graphs = load_nav_graphs(scans)
+        items = []
+        for path_id in range(n_paths):
+            scan = scans[path_id % n_scans]
+            start, goal = rng.choice(n_viewpoints, 2, replace=False)
+            path = nx.shortest_path(graphs[scan], '%s_%03d' % (scan, start), '%s_%03d' % (scan, goal), weight='weight')
+            items.append({
+                'scan': scan,
+                'path_id': path_id,
+                'path': path,
+                'heading': float(rng.uniform(0, 2 * np.pi)),
+                'distance': float(nx.shortest_path_length(graphs[scan], path[0], path[-1], weight='weight')),
+                'instructions': ['walk to the end of the path and stop']})
+        with open('tasks/R2R/data/R2R_synthetic.json', 'w') as f:
+            json.dump(items, f)
+
+        tsv_path = paths.mean_pooled_feature_store_paths['imagenet']
+        with open(tsv_path, 'w') as f:
+            for scan in scans:
+                for i in range(n_viewpoints):
+                    features = rng.rand(ImageFeatures.NUM_VIEWS, ImageFeatures.MEAN_POOLED_DIM).astype(np.float32)
+                    f.write('\t'.join([scan, '%s_%03d' % (scan, i), str(ImageFeatures.IMAGE_W), str(ImageFeatures.IMAGE_H),
+                                       str(ImageFeatures.VFOV), base64.b64encode(features.tobytes()).decode('ascii')]) + '\n')
+        prefix = paths.mean_pooled_binary_feature_store_paths['imagenet']
+        convert_mean_pooled_tsv(tsv_path, prefix)
+        for dtype in ['float16', 'int8']:
+            quantize_feature_store(prefix, dtype)
+    finally:
+        os.chdir(cwd)
+
+
+class _CountingEnv(object):
+    ''' Counts the world states an EnvBatch is asked to load or step '''
+
+    def __init__(self, env):
+        self.env = env
+        self.states_loaded = 0
+        self.states_stepped = 0
+
+    def getStates(self, world_states, beamed=False):
+        self.states_loaded += sum(len(row) for row in world_states) if beamed else len(world_states)
+        return self.env.getStates(world_states, beamed=beamed)
+
+    def makeActions(self, world_states, actions, last_obs, beamed=False):
+        self.states_stepped += sum(len(row) for row in world_states) if beamed else len(world_states)
+        return self.env.makeActions(world_states, actions, last_obs, beamed=beamed)
+
+    def __getattr__(self, name):
+        return getattr(self.env, name)
+
+
+def _random_actions(beam_obs, beam_size, rng):
+    ''' Expand each beam to up to beam_size states by moving from its states
+        to distinct adjacent locations, chosen at random '''
+    world_state_ixs, actions = [], []
+    candidates = [(i, a) for i, ob in enumerate(beam_obs) for a in range(1, len(ob['adj_loc_list']))]
+    rng.shuffle(candidates)
+    for i, a in candidates[:beam_size] or [(0, 0)]:
+        world_state_ixs.append(i)
+        actions.append(a)
+    return world_state_ixs, actions
+
+
+def benchmark(env, n_episodes, episode_len, seed=1):
+    ''' Time reset, step and observe over n_episodes minibatches of random
+        walks, on beams of env.beam_size world states '''
+    rng = random.Random(seed)
+    counting_env = _CountingEnv(env.env)
+    env.env = counting_env
+    env.observation_cache.clear()
+    reset_time, step_time, observe_time = 0., 0., 0.
+    n_resets, n_observations = 0, 0
+    try:
+        for _ in range(n_episodes):
+            start_time = time.time()
+            world_states = env.reset(beamed=True)
+            reset_time += time.time() - start_time
+            n_resets += 1
+            for t in range(episode_len):
+                start_time = time.time()
+                obs = env.observe(world_states, beamed=True)
+                observe_time += time.time() - start_time
+                n_observations += sum(len(beam_obs) for beam_obs in obs)
+
+                stepped_states, actions, last_obs = [], [], []
+                for beam_world_states, beam_obs in zip(world_states, obs):
+                    world_state_ixs, beam_actions = _random_actions(beam_obs, env.beam_size, rng)
+                    stepped_states.append([beam_world_states[i] for i in world_state_ixs])
+                    actions.append(beam_actions)
+                    last_obs.append([beam_obs[i] for i in world_state_ixs])
+                start_time = time.time()
+                world_states = env.step(stepped_states, actions, last_obs, beamed=True)
+                step_time += time.time() - start_time
+    finally:
+        env.env = counting_env.env
+    return {
+        'resets_per_sec': n_resets / reset_time if reset_time > 0 else float('inf'),
+        'steps_per_sec': counting_env.states_stepped / step_time if step_time > 0 else float('inf'),
+        'observations_per_sec': n_observations / observe_time if observe_time > 0 else float('inf'),
+        'simulator_calls_per_observation': counting_env.states_loaded / n_observations,
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    ''' Print the ratio of each metric to the baseline run with the same
+        configuration, returning the number of regressions by more than tolerance '''
+    baseline_by_config = {json.dumps(result['config'], sort_keys=True): result for result in baseline}
+    n_regressions = 0
+    for result in results:
+        baseline_result = baseline_by_config.get(json.dumps(result['config'], sort_keys=True))
+        if baseline_result is None:
+            print('%s: no baseline' % result['config'])
+            continue
+        for metric in METRICS:
+            ratio = result[metric] / baseline_result[metric] if baseline_result[metric] else float('nan')
+            regressed = ratio > 1 + tolerance if metric in LOWER_IS_BETTER else ratio < 1 - tolerance
+            n_regressions += regressed
+            print('%s %s: %.4g vs %.4g (x%.3f)%s' % (
+                result['config'], metric, result[metric], baseline_result[metric], ratio,
+                ' REGRESSION' if regressed else ''))
+    return n_regressions
+
+
+def make_arg_parser():
+    parser = argparse.ArgumentParser()
+    R2RBatch.add_args(parser)
+    parser.add_argument("--batch_sizes", nargs="+", type=int, default=[10, 100])
+    parser.add_argument("--beam_sizes", nargs="+", type=int, default=[1, 10])
+    parser.add_argument("--feature_types", nargs="+", choices=FEATURE_TYPES, default=["none"])
+    parser.add_argument("--splits", nargs="+", default=["val_seen"])
+    parser.add_argument("--n_episodes", type=int, default=5, help="minibatches per configuration")
+    parser.add_argument("--episode_len", type=int, default=10)
+    parser.add_argument("--synthetic", action='store_true', help="run on a generated fixture instead of the R2R data")
+    parser.add_argument("--synthetic_scans", type=int, default=3)
+    parser.add_argument("--synthetic_viewpoints", type=int, default=25, help="per scan")
+    parser.add_argument("--synthetic_paths", type=int, default=200)
+    parser.add_argument("--output", help="write the results here, as json")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative change in a metric counted as a regression")
+    return parser
+
+
+def benchmark_entry_point(args):
+    fixture_dir = None
+    if not args.synthetic and not all(os.path.exists('tasks/R2R/data/R2R_%s.json' % split) for split in args.splits):
+        print('R2R data for %s not found, using a synthetic fixture' % ', '.join(args.splits))
+        args.synthetic = True
+    if args.synthetic:
+        assert args.env_backend == 'nav_graph', 'the synthetic scans can only be used with the nav_graph backend'
+        fixture_dir = tempfile.mkdtemp(prefix='env_benchmark')
+        write_synthetic_fixture(fixture_dir, args.synthetic_scans, args.synthetic_viewpoints, args.synthetic_paths)
+        splits = ['synthetic']
+        output = os.path.abspath(args.output) if args.output else None
+        baseline = os.path.abspath(args.baseline) if args.baseline else None
+        os.chdir(fixture_dir)
+    else:
+        splits = args.splits
+        output, baseline = args.output, args.baseline
+
+    results = []
+    try:
+        for feature_type in args.feature_types:
+            image_features_list = [make_image_features(feature_type)]
+            for batch_size, beam_size in itertools.product(args.batch_sizes, args.beam_sizes):
+                env = R2RBatch(image_features_list, batch_size=batch_size, splits=splits, beam_size=beam_size,
+                               **R2RBatch.kwargs_from_args(args))
+                config = {
+                    'batch_size': batch_size,
+                    'beam_size': beam_size,
+                    'feature_type': feature_type,
+                    'synthetic': args.synthetic,
+                }
+                config.update(R2RBatch.kwargs_from_args(args))
+                result = {'config': config}
+                result.update(benchmark(env, args.n_episodes, args.episode_len))
+                # reported, but not compared with the baseline
+                result['scan_locality'] = env.scan_locality()
+                if hasattr(env.env, 'close'):
+                    env.env.close()
+                print(json.dumps(result, sort_keys=True))
+                results.append(result)
+    finally:
+        if fixture_dir:
+            shutil.rmtree(fixture_dir)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if baseline:
+        with open(baseline) as f:
+            n_regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        if n_regressions:
+            print('%d metrics regressed by more than %d%%' % (n_regressions, args.tolerance * 100))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    benchmark_entry_point(make_arg_parser().parse_args())
@@ -0,0 +1,74 @@
+''' Check that the nav_graph environment backend reproduces the states and
+    transitions of the MatterSim backend. Usage, from the repo root:
+
+    python tasks/R2R/check_nav_graph_parity.py --scans 17DRP5sb8fy '''
+
+import argparse
+
+import numpy as np
+
+from env import EnvBatch, NavGraphEnvBatch
+from panorama_index import load_included_viewpoints, NUM_VIEWS
+
+
+def _check_adj_loc_list(expected, actual, description):
+    assert len(expected) == len(actual), description
+    for expected_loc, actual_loc in zip(expected, actual):
+        assert set(expected_loc.keys()) == set(actual_loc.keys()), description
+        for key, value in expected_loc.items():
+            if isinstance(value, float):
+                assert np.isclose(value, actual_loc[key], atol=1e-6), \
+                    '%s: %s %s != %s' % (description, key, value, actual_loc[key])
+            else:
+                assert value == actual_loc[key], \
+                    '%s: %s %s != %s' % (description, key, value, actual_loc[key])
+
+
+def check_scan(scan, sim_env, nav_graph_env):
+    n_checked = 0
+    for viewpointId in load_included_viewpoints(scan):
+        for viewIndex in range(NUM_VIEWS):
+            description = '%s %s view %d' % (scan, viewpointId, viewIndex)
+            heading = (viewIndex % 12) * 2 * np.pi / 12
+            elevation = (viewIndex // 12 - 1) * np.pi / 6
+            world_states = [sim_env.newEpisodes([scan], [viewpointId], [heading])[0]._replace(elevation=elevation)]
+            (sim_state, sim_adj), = sim_env.getStates(world_states)
+            (state, adj), = nav_graph_env.getStates(world_states)
+            assert sim_state.viewIndex == state.viewIndex == viewIndex, description
+            assert sim_state.location.viewpointId == state.location.viewpointId, description
+            assert np.isclose(sim_state.heading, state.heading), description
+            assert np.isclose(sim_state.elevation, state.elevation), description
+            assert [loc.viewpointId for loc in sim_state.navigableLocations] == \
+                [loc.viewpointId for loc in state.navigableLocations], description
+            _check_adj_loc_list(sim_adj, adj, description)
+
+            last_obs = [{'adj_loc_list': sim_adj}]
+            for action in range(len(sim_adj)):
+                sim_next, = sim_env.makeActions(world_states, [action], last_obs)
+                next_state, = nav_graph_env.makeActions(world_states, [action], last_obs)
+                assert sim_next.scanId == next_state.scanId, description
+                assert sim_next.viewpointId == next_state.viewpointId, description
+                assert np.isclose(sim_next.heading, next_state.heading), description
+                assert np.isclose(sim_next.elevation, next_state.elevation), description
+            n_checked += 1
+    print('%s: %d states match' % (scan, n_checked))
+
+
+def make_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scans", nargs="+", help="defaults to all scans in connectivity/scans.txt")
+    return parser
+
+
+if __name__ == "__main__":
+    args = make_arg_parser().parse_args()
+    if args.scans:
+        scans = args.scans
+    else:
+        with open('connectivity/scans.txt') as f:
+            scans = [scan.strip() for scan in f.readlines()]
+    # compare against the panorama sweep itself rather than a prebuilt index
+    sim_env = EnvBatch(1, 1, use_panorama_index=False)
+    nav_graph_env = NavGraphEnvBatch(1, 1)
+    for scan in scans:
+        check_scan(scan, sim_env, nav_graph_env)
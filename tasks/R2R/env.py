@@ -2,13 +2,16 @@
 
 import sys
 sys.path.append('build')
-import MatterSim
+try:
+    import MatterSim
+except ImportError:
+    # only the nav_graph environment backend can be used without the simulator build
+    MatterSim = None
 import csv
 import numpy as np
 import math
 import json
 import random
-import networkx as nx
 import functools
 import os.path
 import time
@@ -17,11 +20,16 @@ import pickle
 import os
 import os.path
 import sys
-import itertools
+import threading
+import contextlib
 
 from collections import namedtuple, defaultdict
 
-from utils import load_datasets, load_nav_graphs, structured_map, vocab_pad_idx, decode_base64, k_best_indices, try_cuda, spatial_feature_from_bbox
+from utils import load_datasets, structured_map, flatten, LRUCache, vocab_pad_idx, decode_base64, k_best_indices, try_cuda, spatial_feature_from_bbox
+from panorama_index import load_panorama_index
+from feature_store import load_feature_store
+from shortest_paths import load_shortest_paths
+import interning
 
 import torch
 from torch.autograd import Variable
@@ -123,8 +131,67 @@ def _adjust_elevation(sim, elevation):
         sim.makeAction(0, 0, np.sign(elevation))
 
 
+class SimStateView(object):
+    ''' A NavGraphState read from a simulator's getStateView. The navigable
+        locations stay in its structured navigable array (ix, point,
+        rel_heading, rel_elevation, rel_distance) with their viewpoint ids,
+        and are only made into NavGraphLocations if navigableLocations is
+        read '''
+
+    __slots__ = ['scanId', 'step', 'heading', 'elevation', 'viewIndex',
+                 'navigable', 'navigableViewpointIds', '_navigableLocations']
+
+    def __init__(self, view):
+        self.scanId = view.scanId
+        self.step = view.step
+        self.heading = view.heading
+        self.elevation = view.elevation
+        self.viewIndex = view.viewIndex
+        self.navigable = view.navigable
+        self.navigableViewpointIds = view.navigableViewpointIds
+        self._navigableLocations = None
+
+    def _make_location(self, k):
+        record = self.navigable[k]
+        return NavGraphLocation(
+            self.navigableViewpointIds[k], int(record['ix']), record['point'].tolist(), float(record['rel_heading']),
+            float(record['rel_elevation']), float(record['rel_distance']))
+
+    @property
+    def location(self):
+        if self._navigableLocations is not None:
+            return self._navigableLocations[0]
+        return self._make_location(0)
+
+    @property
+    def navigableLocations(self):
+        if self._navigableLocations is None:
+            self._navigableLocations = [self._make_location(k) for k in range(len(self.navigableViewpointIds))]
+        return self._navigableLocations
+
+
+def get_sim_state(sim):
+    ''' The state of sim. If the simulator was built with getStateView, a
+        SimStateView, which skips the image and the ViewPoint objects
+        getState makes for every navigable location '''
+    if not hasattr(sim, 'getStateView'):
+        return sim.getState()
+    return SimStateView(sim.getStateView())
+
+
+def _navigable_angles(state):
+    ''' viewpoint ids, rel_headings and rel_elevations of the navigable
+        locations of state, read from the array of a SimStateView '''
+    if isinstance(state, SimStateView):
+        return (state.navigableViewpointIds, state.navigable['rel_heading'].tolist(),
+                state.navigable['rel_elevation'].tolist())
+    locations = state.navigableLocations
+    return ([loc.viewpointId for loc in locations], [loc.rel_heading for loc in locations],
+            [loc.rel_elevation for loc in locations])
+
+
 def _navigate_to_location(sim, nextViewpointId, absViewIndex):
-    state = sim.getState()
+    state = get_sim_state(sim)
     if state.location.viewpointId == nextViewpointId:
         return  # do nothing
 
@@ -132,15 +199,11 @@ def _navigate_to_location(sim, nextViewpointId, absViewIndex):
     _adjust_heading(sim, absViewIndex % 12 - state.viewIndex % 12)
     _adjust_elevation(sim, absViewIndex // 12 - state.viewIndex // 12)
     # find the next location
-    state = sim.getState()
+    state = get_sim_state(sim)
     assert state.viewIndex == absViewIndex
-    a, next_loc = None, None
-    for n_loc, loc in enumerate(state.navigableLocations):
-        if loc.viewpointId == nextViewpointId:
-            a = n_loc
-            next_loc = loc
-            break
-    assert next_loc is not None
+    viewpointIds, _, _ = _navigable_angles(state)
+    assert nextViewpointId in viewpointIds
+    a = viewpointIds.index(nextViewpointId)
 
     # 3. Take action
     sim.makeAction(a, 0, 0)
@@ -169,8 +232,18 @@ def _get_panorama_states(sim):
 
     Features are 36 x D_vis, ordered from relViewIndex 0 to 35 (i.e.
     feature[12] is always the feature of the patch forward horizontally)
+
+    If the simulator was built with getPanoramaNavigable, it computes the
+    same list from the location graph in one call, without turning
     '''
-    state = sim.getState()
+    if hasattr(sim, 'getPanoramaNavigable'):
+        state = get_sim_state(sim)
+        stop = {
+            'absViewIndex': -1,
+            'nextViewpointId': state.location.viewpointId}
+        return state, [stop] + sim.getPanoramaNavigable()
+
+    state = get_sim_state(sim)
     initViewIndex = state.viewIndex
     # 1. first look down, turning to relViewIndex 0
     elevation_delta = -(state.viewIndex // 12)
@@ -187,21 +260,23 @@ def _get_panorama_states(sim):
         base_rel_heading = (relViewIndex % 12) * angle_inc
         base_rel_elevation = (relViewIndex // 12 - 1) * angle_inc
 
-        state = sim.getState()
+        state = get_sim_state(sim)
         absViewIndex = state.viewIndex
         # get adjacent locations
-        for loc in state.navigableLocations[1:]:
-            distance = _loc_distance(loc)
+        viewpointIds, rel_headings, rel_elevations = _navigable_angles(state)
+        for viewpointId, loc_rel_heading, loc_rel_elevation in zip(
+                viewpointIds[1:], rel_headings[1:], rel_elevations[1:]):
+            distance = np.sqrt(loc_rel_heading ** 2 + loc_rel_elevation ** 2)
             # if a loc is visible from multiple view, use the closest
             # view (in angular distance) as its representation
-            if (loc.viewpointId not in adj_dict or
-                    distance < adj_dict[loc.viewpointId]['distance']):
+            if (viewpointId not in adj_dict or
+                    distance < adj_dict[viewpointId]['distance']):
                 rel_heading = _canonical_angle(
-                    base_rel_heading + loc.rel_heading)
-                rel_elevation = base_rel_elevation + loc.rel_elevation
-                adj_dict[loc.viewpointId] = {
+                    base_rel_heading + loc_rel_heading)
+                rel_elevation = base_rel_elevation + loc_rel_elevation
+                adj_dict[viewpointId] = {
                     'absViewIndex': absViewIndex,
-                    'nextViewpointId': loc.viewpointId,
+                    'nextViewpointId': viewpointId,
                     'rel_heading': rel_heading,
                     'rel_elevation': rel_elevation,
                     'distance': distance}
@@ -212,7 +287,7 @@ def _get_panorama_states(sim):
             sim.makeAction(0, 1, 0)  # Turn right
     # 3. turn back to the original view
     _adjust_elevation(sim, - 2 - elevation_delta)
-    state = sim.getState()
+    state = get_sim_state(sim)
     assert state.viewIndex == initViewIndex  # check the agent is back
     # collect navigable location list
     stop = {
@@ -231,14 +306,49 @@ BottomUpViewpoint = namedtuple("BottomUpViewpoint", ["cls_prob", "image_features
 def load_world_state(sim, world_state):
     sim.newEpisode(*world_state)
 
+def discretize_view(heading, elevation):
+    ''' Snap heading and elevation to the discretized viewing angles, as
+        Simulator::setHeadingElevation does. Returns heading, elevation and viewIndex '''
+    heading = math.fmod(heading, math.pi * 2.0)
+    while heading < 0.0:
+        heading += math.pi * 2.0
+    heading_increment = math.pi * 2.0 / 12
+    heading_step = int(math.floor(heading / heading_increment + 0.5))
+    if heading_step == 12:
+        heading_step = 0
+    heading = heading_step * heading_increment
+    elevation_increment = math.pi / 6.0
+    if elevation < -elevation_increment / 2.0:
+        return heading, -elevation_increment, heading_step
+    elif elevation > elevation_increment / 2.0:
+        return heading, elevation_increment, heading_step + 24
+    else:
+        return heading, 0.0, heading_step + 12
+
+def view_heading_elevation(viewIndex):
+    ''' Heading and elevation of the camera when looking at a discretized view '''
+    return (viewIndex % 12) * (math.pi * 2.0 / 12), (viewIndex // 12 - 1) * (math.pi / 6.0)
+
+def adjacent_world_state(world_state, nextViewpointId, absViewIndex):
+    ''' The world state that taking the action to nextViewpointId (looking at
+        absViewIndex) of an adj_loc_list leads to from world_state, as
+        makeActions gives it, without a simulator '''
+    if world_state.viewpointId == nextViewpointId:
+        heading, elevation, viewIndex = discretize_view(world_state.heading, world_state.elevation)
+        return WorldState(world_state.scanId, world_state.viewpointId, heading, elevation)
+    heading, elevation = view_heading_elevation(absViewIndex)
+    return WorldState(world_state.scanId, nextViewpointId, heading, elevation)
+
 def get_world_state(sim):
-    state = sim.getState()
+    state = get_sim_state(sim)
     return WorldState(scanId=state.scanId,
                       viewpointId=state.location.viewpointId,
                       heading=state.heading,
                       elevation=state.elevation)
 
 def make_sim(image_w, image_h, vfov):
+    if MatterSim is None:
+        raise ImportError("MatterSim has not been built, use the nav_graph environment backend instead")
     sim = MatterSim.Simulator()
     sim.setRenderingEnabled(False)
     sim.setDiscretizedViewingAngles(True)
@@ -247,6 +357,15 @@ def make_sim(image_w, image_h, vfov):
     sim.init()
     return sim
 
+def make_simulator_batch(size, num_threads, image_w, image_h, vfov):
+    sim_batch = MatterSim.SimulatorBatch(size, num_threads)
+    sim_batch.setRenderingEnabled(False)
+    sim_batch.setDiscretizedViewingAngles(True)
+    sim_batch.setCameraResolution(image_w, image_h)
+    sim_batch.setCameraVFOV(math.radians(vfov))
+    sim_batch.init()
+    return sim_batch
+
 # def encode_action_sequence(action_tuples):
 #     encoded = []
 #     reached_end = False
@@ -312,7 +431,10 @@ class ImageFeatures(object):
                 raise NotImplementedError('convolutional_attention has not been implemented for panorama environment')
             else:
                 assert image_feature_type == "mean_pooled"
-                feats.append(MeanPooledImageFeatures(args.image_feature_datasets))
+                if args.mean_pooled_feature_format == "memmap":
+                    feats.append(MemmapMeanPooledImageFeatures(args.image_feature_datasets, dtype=args.mean_pooled_feature_dtype))
+                else:
+                    feats.append(MeanPooledImageFeatures(args.image_feature_datasets))
         return feats
 
     @staticmethod
@@ -323,6 +445,8 @@ class ImageFeatures(object):
         argument_parser.add_argument("--bottom_up_detections", type=int, default=20)
         argument_parser.add_argument("--bottom_up_detection_embedding_size", type=int, default=20)
         argument_parser.add_argument("--downscale_convolutional_features", action='store_true')
+        argument_parser.add_argument("--mean_pooled_feature_format", choices=["tsv", "memmap"], default="tsv", help="memmap reads the binary stores written by feature_store.py")
+        argument_parser.add_argument("--mean_pooled_feature_dtype", choices=["float32", "float16", "int8"], default="float32", help="only applicable to --mean_pooled_feature_format memmap")
 
     def get_name(self):
         raise NotImplementedError("get_name")
@@ -347,6 +471,18 @@ class NoImageFeatures(ImageFeatures):
     def get_name(self):
         return "none"
 
+def read_mean_pooled_tsv(path):
+    ''' Yields (scanId, viewpointId, 36 x MEAN_POOLED_DIM features) for each row of a feature TSV '''
+    tsv_fieldnames = ['scanId', 'viewpointId', 'image_w','image_h', 'vfov', 'features']
+    with open(path, "rt") as tsv_in_file:
+        reader = csv.DictReader(tsv_in_file, delimiter='\t', fieldnames = tsv_fieldnames)
+        for item in reader:
+            assert int(item['image_h']) == ImageFeatures.IMAGE_H
+            assert int(item['image_w']) == ImageFeatures.IMAGE_W
+            assert int(item['vfov']) == ImageFeatures.VFOV
+            features = np.frombuffer(decode_base64(item['features']), dtype=np.float32).reshape((ImageFeatures.NUM_VIEWS, ImageFeatures.MEAN_POOLED_DIM))
+            yield item['scanId'], item['viewpointId'], features
+
 class MeanPooledImageFeatures(ImageFeatures):
     def __init__(self, image_feature_datasets):
         image_feature_datasets = sorted(image_feature_datasets)
@@ -356,37 +492,49 @@ class MeanPooledImageFeatures(ImageFeatures):
                                            for dataset in image_feature_datasets]
         self.feature_dim = MeanPooledImageFeatures.MEAN_POOLED_DIM * len(image_feature_datasets)
         print('Loading image features from %s' % ', '.join(self.mean_pooled_feature_stores))
-        tsv_fieldnames = ['scanId', 'viewpointId', 'image_w','image_h', 'vfov', 'features']
-        self.features = defaultdict(list)
+        features = defaultdict(list)
         for mpfs in self.mean_pooled_feature_stores:
-            with open(mpfs, "rt") as tsv_in_file:
-                reader = csv.DictReader(tsv_in_file, delimiter='\t', fieldnames = tsv_fieldnames)
-                for item in reader:
-                    assert int(item['image_h']) == ImageFeatures.IMAGE_H
-                    assert int(item['image_w']) == ImageFeatures.IMAGE_W
-                    assert int(item['vfov']) == ImageFeatures.VFOV
-                    long_id = self._make_id(item['scanId'], item['viewpointId'])
-                    features = np.frombuffer(decode_base64(item['features']), dtype=np.float32).reshape((ImageFeatures.NUM_VIEWS, ImageFeatures.MEAN_POOLED_DIM))
-                    self.features[long_id].append(features)
-        assert all(len(feats) == len(self.mean_pooled_feature_stores) for feats in self.features.values())
-        self.features = {
-            long_id: np.concatenate(feats, axis=1)
-            for long_id, feats in self.features.items()
-        }
-
-    def _make_id(self, scanId, viewpointId):
-        return scanId + '_' + viewpointId
+            for scanId, viewpointId, viewpoint_features in read_mean_pooled_tsv(mpfs):
+                features[viewpointId].append(viewpoint_features)
+        assert all(len(feats) == len(self.mean_pooled_feature_stores) for feats in features.values())
+        viewpoints = list(features.keys())
+        self.rows = interning.ViewpointRows(viewpoints)
+        self.features = np.stack([np.concatenate(features.pop(viewpointId), axis=1)
+                                  for viewpointId in viewpoints])
 
     def get_features(self, state):
-        long_id = self._make_id(state.scanId, state.location.viewpointId)
         # Return feature of all the 36 views
-        return self.features[long_id]
+        return self.features[self.rows[state.location.viewpointId]]
 
     def get_name(self):
         name = '+'.join(sorted(self.image_feature_datasets))
         name = "{}_mean_pooled".format(name)
         return name
 
+class MemmapMeanPooledImageFeatures(MeanPooledImageFeatures):
+    ''' The same features as MeanPooledImageFeatures, read from the binary
+        stores written by feature_store.py. These are memory mapped, so they
+        load instantly and are shared between processes through the page cache.
+        With dtype float16 or int8, the quantized stores are read instead and
+        only the rows that are used are dequantized '''
+
+    def __init__(self, image_feature_datasets, dtype='float32'):
+        image_feature_datasets = sorted(image_feature_datasets)
+        self.image_feature_datasets = image_feature_datasets
+        self.dtype = dtype
+        self.feature_dim = MeanPooledImageFeatures.MEAN_POOLED_DIM * len(image_feature_datasets)
+        self.stores = [load_feature_store(paths.mean_pooled_binary_feature_store_paths[dataset], dtype)
+                       for dataset in image_feature_datasets]
+        assert all(store.viewpoints == self.stores[0].viewpoints for store in self.stores[1:]), \
+            'feature stores should have the same viewpoints'
+
+    def get_features(self, state):
+        # Return feature of all the 36 views
+        if len(self.stores) == 1:
+            return self.stores[0].get_features(state.scanId, state.location.viewpointId)
+        return np.concatenate([store.get_features(state.scanId, state.location.viewpointId)
+                               for store in self.stores], axis=1)
+
 class ConvolutionalImageFeatures(ImageFeatures):
     feature_dim = ImageFeatures.MEAN_POOLED_DIM
 
@@ -582,54 +730,251 @@ class BottomUpImageFeatures(ImageFeatures):
     def get_name(self):
         return "bottom_up_attention_d={}".format(self.number_of_detections)
 
+class SimulatorPool(object):
+    ''' MatterSim simulators shared by every EnvBatch in a process. A
+        simulator is loaded with the world state before each use, so any free
+        one will do: they are handed out for the duration of a call, and a new
+        one is only made when all of them are in use. The size of the pool is
+        then the peak number of concurrent calls, not batch size x beam size.
+
+        Loading a world state in another scan than the simulator's last one
+        reloads the scan's location graph, so a simulator asked for a scan is
+        one last used in that scan if there's one free. With pin_scans, a new
+        simulator is made rather than moving a free one to another scan, so
+        that each simulator stays in one scan. scene_loads counts the
+        simulators handed out for a scan they weren't last used in '''
+
+    def __init__(self, pin_scans=False):
+        self.pin_scans = pin_scans
+        self.lock = threading.Lock()
+        self.sims = []
+        # keyed by the scan each was last used in (None if unknown)
+        self.free_sims = defaultdict(list)
+        self.scene_loads = 0
+
+    def __len__(self):
+        return len(self.sims)
+
+    def _take_free_sim(self, scanId):
+        if self.free_sims[scanId]:
+            return self.free_sims[scanId].pop()
+        if scanId is not None:
+            self.scene_loads += 1
+            if self.pin_scans:
+                return None
+        for sims in self.free_sims.values():
+            if sims:
+                return sims.pop()
+        return None
+
+    @contextlib.contextmanager
+    def simulator(self, scanId=None):
+        ''' A free simulator, to load world states of scanId with (or of any
+            scans if it's None) '''
+        with self.lock:
+            sim = self._take_free_sim(scanId)
+        if sim is None:
+            sim = make_sim(ImageFeatures.IMAGE_W, ImageFeatures.IMAGE_H, ImageFeatures.VFOV)
+            with self.lock:
+                self.sims.append(sim)
+        try:
+            yield sim
+        finally:
+            with self.lock:
+                self.free_sims[scanId].append(sim)
+
+
+@functools.lru_cache(maxsize=None)
+def get_simulator_pool(pin_scans=False):
+    return SimulatorPool(pin_scans=pin_scans)
+
+
 class EnvBatch():
     ''' A simple wrapper for a batch of MatterSim environments,
-        using discretized viewpoints and pretrained features '''
-
-    def __init__(self, batch_size, beam_size):
-        self.sims = []
+        using discretized viewpoints and pretrained features. The simulators
+        are taken from simulator_pool (by default, the one shared by the
+        process, or with pin_scans the one whose simulators stay in a scan),
+        one for the world states of each scan in a call.
+
+        If the simulator was built with SimulatorBatch, newEpisodes and
+        makeActions load and step all the world states of a call in a
+        SimulatorBatch instead, over simulator_threads threads without the
+        GIL, and so does getStates if the panorama index has been built (it
+        reads their adjacency from the index). The SimulatorBatch is grown to
+        the largest call made '''
+
+    def __init__(self, batch_size, beam_size, use_panorama_index=True, simulator_pool=None, pin_scans=False, simulator_threads=1):
         self.batch_size = batch_size
         self.beam_size = beam_size
-        for i in range(batch_size):
-            beam = []
-            for j in range(beam_size):
-                sim = make_sim(ImageFeatures.IMAGE_W, ImageFeatures.IMAGE_H, ImageFeatures.VFOV)
-                beam.append(sim)
-            self.sims.append(beam)
-
-    def sims_view(self, beamed):
+        # precomputed adjacency lists, used in place of the panorama sweep if
+        # the index has been built (see panorama_index.py)
+        self.panorama_index = load_panorama_index() if use_panorama_index else None
+        self.simulator_pool = get_simulator_pool(pin_scans) if simulator_pool is None else simulator_pool
+        self.simulator_threads = simulator_threads
+        self.use_simulator_batch = hasattr(MatterSim, 'SimulatorBatch')
+        self.simulator_batch = None
+        self.simulator_batch_lock = threading.Lock()
+
+    def _map_by_scan(self, function, world_states, *args, **kwargs):
+        ''' structured_map of function(sim, world_state, *args), where the
+            world states of each scan are loaded in the same simulator '''
+        beamed = kwargs.get('beamed', False)
         if beamed:
-            return [itertools.cycle(sim_list) for sim_list in self.sims]
+            flat_args = list(zip(flatten(world_states), *[flatten(arg) for arg in args]))
         else:
-            return (s[0] for s in self.sims)
+            flat_args = list(zip(world_states, *args))
+        ixs_by_scan = defaultdict(list)
+        for ix, function_args in enumerate(flat_args):
+            ixs_by_scan[function_args[0].scanId].append(ix)
+        results = [None] * len(flat_args)
+        for scanId, ixs in ixs_by_scan.items():
+            with self.simulator_pool.simulator(scanId) as sim:
+                for ix in ixs:
+                    results[ix] = function(sim, *flat_args[ix])
+        if not beamed:
+            return results
+        results = iter(results)
+        return [[next(results) for _ in row] for row in world_states]
 
     def newEpisodes(self, scanIds, viewpointIds, headings, beamed=False):
         assert len(scanIds) == len(viewpointIds)
         assert len(headings) == len(viewpointIds)
-        assert len(scanIds) == len(self.sims)
-        world_states = []
-        for i, (scanId, viewpointId, heading) in enumerate(zip(scanIds, viewpointIds, headings)):
-            world_state = WorldState(scanId, viewpointId, heading, 0)
-            if beamed:
-                world_states.append([world_state])
-            else:
-                world_states.append(world_state)
-            load_world_state(self.sims[i][0], world_state)
+        assert len(scanIds) == self.batch_size
+        world_states = [WorldState(scanId, viewpointId, heading, 0)
+                        for scanId, viewpointId, heading in zip(scanIds, viewpointIds, headings)]
+        if self.use_simulator_batch:
+            with self.simulator_batch_lock:
+                self._load_batched(world_states)
+        else:
+            self._map_by_scan(load_world_state, world_states)
+        if beamed:
+            world_states = [[world_state] for world_state in world_states]
         assert len(world_states) == len(scanIds)
         return world_states
 
+    def _load_batched(self, world_states):
+        ''' Load a flat list of world states into the first simulators of the
+            SimulatorBatch, growing it if there are more than it has. Should
+            be called with simulator_batch_lock held '''
+        if self.simulator_batch is None or self.simulator_batch.size() < len(world_states):
+            if self.simulator_batch is not None:
+                self.simulator_batch.close()
+            self.simulator_batch = make_simulator_batch(
+                len(world_states), self.simulator_threads,
+                ImageFeatures.IMAGE_W, ImageFeatures.IMAGE_H, ImageFeatures.VFOV)
+        self.simulator_batch.newEpisodes(
+            [ws.scanId for ws in world_states], [ws.viewpointId for ws in world_states],
+            [ws.heading for ws in world_states], [ws.elevation for ws in world_states])
+        return self.simulator_batch
+
+    @staticmethod
+    def _map_batched(function, world_states, *args, **kwargs):
+        ''' function(flat world states, *flat args), nested like world_states if beamed '''
+        beamed = kwargs.get('beamed', False)
+        if not beamed:
+            return function(world_states, *args) if world_states else []
+        flat_world_states = flatten(world_states)
+        results = function(flat_world_states, *[flatten(arg) for arg in args]) if flat_world_states else []
+        results = iter(results)
+        return [[next(results) for _ in row] for row in world_states]
+
+    def _get_batched_states(self, world_states):
+        ''' (state, adj_loc_list) of each of a flat list of world states, from
+            the SimulatorBatch, with the locations missing from the index
+            swept with a simulator from the pool '''
+        with self.simulator_batch_lock:
+            arrays = self._load_batched(world_states).getStates(len(world_states))
+        offsets = arrays['navigableOffsets'].tolist()
+        navigable_ix = arrays['navigableIx'].tolist()
+        navigable_points = arrays['navigablePoint'].tolist()
+        rel_headings = arrays['navigableRelHeading'].tolist()
+        rel_elevations = arrays['navigableRelElevation'].tolist()
+        rel_distances = arrays['navigableRelDistance'].tolist()
+        results = []
+        for i, (scanId, step, viewIndex, heading, elevation) in enumerate(zip(
+                arrays['scanId'], arrays['step'].tolist(), arrays['viewIndex'].tolist(),
+                arrays['heading'].tolist(), arrays['elevation'].tolist())):
+            viewpoints = load_nav_graph_scan(scanId).viewpoints
+            navigableLocations = [
+                NavGraphLocation(viewpoints[navigable_ix[k]], navigable_ix[k], navigable_points[k],
+                                 rel_headings[k], rel_elevations[k], rel_distances[k])
+                for k in range(offsets[i], offsets[i + 1])]
+            state = NavGraphState(scanId, step, navigableLocations[0], heading, elevation, viewIndex, navigableLocations)
+            adj_loc_list = self.panorama_index.get_adj_loc_list(scanId, navigableLocations[0].viewpointId, viewIndex)
+            results.append((state, adj_loc_list) if adj_loc_list is not None else None)
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            def sweep(sim, world_state):
+                load_world_state(sim, world_state)
+                return _get_panorama_states(sim)
+            swept = self._map_by_scan(sweep, [world_states[i] for i in missing])
+            for i, result in zip(missing, swept):
+                results[i] = result
+        return results
+
+    def _make_batched_actions(self, world_states, loc_attrs):
+        ''' The world states reached by taking the action of each of loc_attrs
+            from each of a flat list of world states, in the SimulatorBatch.
+            Each simulator starts off looking at its action's view, which is
+            where _navigate_to_location turns to, and moves to its viewpoint '''
+        start_world_states = []
+        for world_state, loc_attr in zip(world_states, loc_attrs):
+            if loc_attr['nextViewpointId'] == world_state.viewpointId:
+                start_world_states.append(world_state)
+            else:
+                heading, elevation = view_heading_elevation(loc_attr['absViewIndex'])
+                start_world_states.append(world_state._replace(heading=heading, elevation=elevation))
+        with self.simulator_batch_lock:
+            simulator_batch = self._load_batched(start_world_states)
+            arrays = simulator_batch.getStates(len(world_states))
+            offsets = arrays['navigableOffsets'].tolist()
+            navigable_ix = arrays['navigableIx'].tolist()
+            view_indices = arrays['viewIndex'].tolist()
+            indices = []
+            for i, (world_state, loc_attr) in enumerate(zip(world_states, loc_attrs)):
+                if loc_attr['nextViewpointId'] == world_state.viewpointId:
+                    # the current location, so the simulator stays where it is
+                    indices.append(0)
+                    continue
+                assert view_indices[i] == loc_attr['absViewIndex']
+                next_ix = load_nav_graph_scan(world_state.scanId).get_ix(loc_attr['nextViewpointId'])
+                navigable = navigable_ix[offsets[i]:offsets[i + 1]]
+                assert next_ix in navigable
+                indices.append(navigable.index(next_ix))
+            simulator_batch.makeActions(indices, [0.0] * len(indices), [0.0] * len(indices))
+            arrays = simulator_batch.getStates(len(world_states))
+        return [WorldState(scanId, load_nav_graph_scan(scanId).viewpoints[ix], heading, elevation)
+                for scanId, ix, heading, elevation in zip(
+                    arrays['scanId'], arrays['locationIx'].tolist(),
+                    arrays['heading'].tolist(), arrays['elevation'].tolist())]
+
     def getStates(self, world_states, beamed=False):
         ''' Get list of states. '''
+        if self.use_simulator_batch and self.panorama_index is not None:
+            return self._map_batched(self._get_batched_states, world_states, beamed=beamed)
+
         def f(sim, world_state):
             load_world_state(sim, world_state)
+            if self.panorama_index is not None:
+                state = get_sim_state(sim)
+                adj_loc_list = self.panorama_index.get_adj_loc_list(
+                    state.scanId, state.location.viewpointId, state.viewIndex)
+                if adj_loc_list is not None:
+                    return state, adj_loc_list
             return _get_panorama_states(sim)
-        return structured_map(f, self.sims_view(beamed), world_states, nested=beamed)
+        return self._map_by_scan(f, world_states, beamed=beamed)
 
     def makeActions(self, world_states, actions, last_obs, beamed=False):
         ''' Take an action using the full state dependent action interface (with batched input).
             Each action is an index in the adj_loc_list,
             0 means staying still (i.e. stop)
         '''
+        if self.use_simulator_batch:
+            def make_batched_actions(world_states, actions, last_obs):
+                loc_attrs = [last_ob['adj_loc_list'][action] for action, last_ob in zip(actions, last_obs)]
+                return self._make_batched_actions(world_states, loc_attrs)
+            return self._map_batched(make_batched_actions, world_states, actions, last_obs, beamed=beamed)
+
         def f(sim, world_state, action, last_ob):
             load_world_state(sim, world_state)
             # load the location attribute corresponding to the action
@@ -638,7 +983,7 @@ class EnvBatch():
                 sim, loc_attr['nextViewpointId'], loc_attr['absViewIndex'])
             # sim.makeAction(index, heading, elevation)
             return get_world_state(sim)
-        return structured_map(f, self.sims_view(beamed), world_states, actions, last_obs, nested=beamed)
+        return self._map_by_scan(f, world_states, actions, last_obs, beamed=beamed)
 
     # def makeSimpleActions(self, simple_indices, beamed=False):
     #     ''' Take an action using a simple interface: 0-forward, 1-turn left, 2-turn right, 3-look up, 4-look down.
@@ -661,11 +1006,401 @@ class EnvBatch():
     #     structured_map(f, self.sims_view(beamed), simple_indices, nested=beamed)
     #     return None
 
+NavGraphLocation = namedtuple("NavGraphLocation", ["viewpointId", "ix", "point", "rel_heading", "rel_elevation", "rel_distance"])
+
+NavGraphState = namedtuple("NavGraphState", ["scanId", "step", "location", "heading", "elevation", "viewIndex", "navigableLocations"])
+
+
+class NavGraphScan(object):
+    ''' The locations of a scan and their visibility from each discretized
+        heading, computed from the connectivity graph with the same (single
+        precision) geometry as Simulator::populateNavigable '''
+
+    def __init__(self, scanId, cos_half_hfov):
+        self.scanId = scanId
+        self.cos_half_hfov = cos_half_hfov
+        with open('connectivity/%s_connectivity.json' % scanId) as f:
+            data = json.load(f)
+        self.viewpoints = [item['image_id'] for item in data]
+        self.index = interning.ViewpointRows(self.viewpoints)
+        self.included = [item['included'] for item in data]
+        self.positions = np.array(
+            [[item['pose'][3], item['pose'][7], item['pose'][11]] for item in data], dtype=np.float32)
+        self.neighbours = [
+            np.array([j for j, unobstructed in enumerate(item['unobstructed'])
+                      if unobstructed and j != ix and self.included[j]], dtype=np.int64)
+            for ix, item in enumerate(data)]
+        self._visible = {}
+        self._adj_loc_lists = {}
+
+    def get_ix(self, viewpointId):
+        ix = self.index.get(viewpointId)
+        if ix is None or not self.included[ix]:
+            raise ValueError('%s is not an included viewpoint of scan %s' % (viewpointId, self.scanId))
+        return ix
+
+    def visible_locations(self, ix, heading_step):
+        ''' Locations in view from ix with the camera at the given heading,
+            as a list of (neighbour ix, rel_heading, elevation, rel_distance),
+            where elevation is relative to the horizon '''
+        key = (ix, heading_step)
+        if key in self._visible:
+            return self._visible[key]
+        neighbours = self.neighbours[ix]
+        adjusted_heading = math.pi / 2.0 - heading_step * (math.pi * 2.0 / 12)
+        cam_x = np.float32(math.cos(adjusted_heading))
+        cam_y = np.float32(math.sin(adjusted_heading))
+        target_dir = self.positions[neighbours] - self.positions[ix]
+        x, y, z = target_dir[:, 0], target_dir[:, 1], target_dir[:, 2]
+        rel_distance = np.sqrt(x * x + y * y + z * z)
+        horizontal_length = np.sqrt(x * x + y * y)
+        elevation = np.arctan2(z.astype(np.float64), horizontal_length.astype(np.float64))
+        inverse_length = np.float32(1) / horizontal_length
+        cos_angle = (x * inverse_length) * cam_x + (y * inverse_length) * cam_y
+        rel_heading = np.arctan2(
+            (x * cam_y - y * cam_x).astype(np.float64),
+            (x * cam_x + y * cam_y).astype(np.float64))
+        visible = [
+            (j, h, e, d) for j, h, e, d, in_view in zip(
+                neighbours.tolist(), rel_heading.tolist(), elevation.tolist(),
+                rel_distance.tolist(), (cos_angle >= self.cos_half_hfov).tolist())
+            if in_view]
+        self._visible[key] = visible
+        return visible
+
+    def navigable_locations(self, ix, heading_step, camera_elevation):
+        locations = [NavGraphLocation(
+            self.viewpoints[j], j, self.positions[j].tolist(),
+            rel_heading, elevation - camera_elevation, rel_distance)
+            for j, rel_heading, elevation, rel_distance in self.visible_locations(ix, heading_step)]
+        locations.sort(key=_loc_distance)
+        current = NavGraphLocation(self.viewpoints[ix], ix, self.positions[ix].tolist(), 0.0, 0.0, 0.0)
+        return [current] + locations
+
+    def get_adj_loc_list(self, ix, viewIndex):
+        ''' The adj_loc_list that _get_panorama_states would return. This only
+            depends on the heading, and the returned list is shared between
+            calls so shouldn't be modified '''
+        key = (ix, viewIndex % 12)
+        if key in self._adj_loc_lists:
+            return self._adj_loc_lists[key]
+        adj_dict = {}
+        for relViewIndex in range(36):
+            base_rel_heading = (relViewIndex % 12) * angle_inc
+            base_rel_elevation = (relViewIndex // 12 - 1) * angle_inc
+            heading_step = (viewIndex + relViewIndex) % 12
+            absViewIndex = (relViewIndex // 12) * 12 + heading_step
+            camera_elevation = (relViewIndex // 12 - 1) * (math.pi / 6.0)
+            locations = [
+                NavGraphLocation(self.viewpoints[j], j, None, rel_heading, elevation - camera_elevation, rel_distance)
+                for j, rel_heading, elevation, rel_distance in self.visible_locations(ix, heading_step)]
+            locations.sort(key=_loc_distance)
+            for loc in locations:
+                distance = _loc_distance(loc)
+                if (loc.viewpointId not in adj_dict or
+                        distance < adj_dict[loc.viewpointId]['distance']):
+                    adj_dict[loc.viewpointId] = {
+                        'absViewIndex': absViewIndex,
+                        'nextViewpointId': loc.viewpointId,
+                        'rel_heading': _canonical_angle(base_rel_heading + loc.rel_heading),
+                        'rel_elevation': base_rel_elevation + loc.rel_elevation,
+                        'distance': distance}
+        stop = {
+            'absViewIndex': -1,
+            'nextViewpointId': self.viewpoints[ix]}
+        adj_loc_list = [stop] + sorted(
+            adj_dict.values(), key=lambda x: abs(x['rel_heading']))
+        self._adj_loc_lists[key] = adj_loc_list
+        return adj_loc_list
+
+
+@functools.lru_cache(maxsize=None)
+def load_nav_graph_scan(scanId):
+    cos_half_hfov = math.cos(math.radians(ImageFeatures.VFOV) * ImageFeatures.IMAGE_W / ImageFeatures.IMAGE_H / 2.0)
+    return NavGraphScan(scanId, cos_half_hfov)
+
+
+class NavGraphEnvBatch():
+    ''' Same interface as EnvBatch, but states and transitions are computed
+        from the connectivity graphs instead of by driving MatterSim, so no
+        simulator build (or panorama sweep) is needed '''
+
+    def __init__(self, batch_size, beam_size):
+        self.batch_size = batch_size
+        self.beam_size = beam_size
+
+    def newEpisodes(self, scanIds, viewpointIds, headings, beamed=False):
+        assert len(scanIds) == len(viewpointIds)
+        assert len(headings) == len(viewpointIds)
+        assert len(scanIds) == self.batch_size
+        world_states = []
+        for scanId, viewpointId, heading in zip(scanIds, viewpointIds, headings):
+            load_nav_graph_scan(scanId).get_ix(viewpointId)
+            world_state = WorldState(scanId, viewpointId, heading, 0)
+            if beamed:
+                world_states.append([world_state])
+            else:
+                world_states.append(world_state)
+        return world_states
+
+    def _get_state(self, world_state):
+        heading, elevation, viewIndex = discretize_view(world_state.heading, world_state.elevation)
+        scan = load_nav_graph_scan(world_state.scanId)
+        ix = scan.get_ix(world_state.viewpointId)
+        navigable_locations = scan.navigable_locations(ix, viewIndex % 12, elevation)
+        state = NavGraphState(
+            world_state.scanId, 0, navigable_locations[0], heading, elevation, viewIndex, navigable_locations)
+        return state, scan.get_adj_loc_list(ix, viewIndex)
+
+    def getStates(self, world_states, beamed=False):
+        ''' Get list of states. '''
+        return structured_map(self._get_state, world_states, nested=beamed)
+
+    def _navigate_to_location(self, world_state, nextViewpointId, absViewIndex):
+        if world_state.viewpointId != nextViewpointId:
+            scan = load_nav_graph_scan(world_state.scanId)
+            ix = scan.get_ix(world_state.viewpointId)
+            next_ix = scan.get_ix(nextViewpointId)
+            assert any(loc[0] == next_ix for loc in scan.visible_locations(ix, absViewIndex % 12))
+        return adjacent_world_state(world_state, nextViewpointId, absViewIndex)
+
+    def makeActions(self, world_states, actions, last_obs, beamed=False):
+        ''' Take an action using the full state dependent action interface (with batched input).
+            Each action is an index in the adj_loc_list,
+            0 means staying still (i.e. stop)
+        '''
+        def f(world_state, action, last_ob):
+            loc_attr = last_ob['adj_loc_list'][action]
+            return self._navigate_to_location(
+                world_state, loc_attr['nextViewpointId'], loc_attr['absViewIndex'])
+        return structured_map(f, world_states, actions, last_obs, nested=beamed)
+
+_OBSERVATION_ENTRIES = {
+    'instr_id': lambda ob: ob.item['instr_id'],
+    'scan': lambda ob: ob.state.scanId,
+    'viewpoint': lambda ob: ob.state.location.viewpointId,
+    'viewIndex': lambda ob: ob.state.viewIndex,
+    'heading': lambda ob: ob.state.heading,
+    'elevation': lambda ob: ob.state.elevation,
+    'step': lambda ob: ob.state.step,
+    'adj_loc_list': lambda ob: ob.adj_loc_list,
+    'navigableLocations': lambda ob: ob.state.navigableLocations,
+    'instructions': lambda ob: ob.item['instructions'],
+    'instr_encoding': lambda ob: ob.item['instr_encoding'],
+    'instr_length': lambda ob: ob.item['instr_length'],
+    'teacher': lambda ob: ob.get_teacher(),
+}
+
+# the entries read from the batch item, which only has some of them
+_ITEM_OBSERVATION_ENTRIES = frozenset(['instr_id', 'instructions', 'instr_encoding', 'instr_length'])
+
+
+class Observation(object):
+    ''' An agent's observation, read like a dict: ob['viewpoint'],
+        ob['adj_loc_list'], ob['feature'] etc. It only references the batch
+        item, the state and the per-location parts shared with the observation
+        cache, and each entry is looked up from them when it's read. The
+        teacher action is computed the first time it's read, and the entry is
+        missing if the observation was made without one. Entries can be set
+        like in a dict, and are kept in the observation itself, overriding
+        the looked up ones '''
+
+    __slots__ = ['item', 'state', 'adj_loc_list', 'feature_entries', 'teacher_env', '_teacher', '_entries']
+
+    def __init__(self, item, state, adj_loc_list, feature_entries, teacher_env=None):
+        self.item = item
+        self.state = state
+        self.adj_loc_list = adj_loc_list
+        self.feature_entries = feature_entries
+        self.teacher_env = teacher_env
+        self._teacher = None
+        self._entries = None
+
+    def get_teacher(self):
+        if self.teacher_env is None:
+            raise KeyError('teacher')
+        if self._teacher is None:
+            self._teacher = self.teacher_env._shortest_path_action(
+                self.state, self.adj_loc_list, self.item['path'][-1])
+        return self._teacher
+
+    def __getitem__(self, key):
+        if self._entries is not None and key in self._entries:
+            return self._entries[key]
+        entry = _OBSERVATION_ENTRIES.get(key)
+        if entry is not None:
+            return entry(self)
+        return self.feature_entries[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if self._entries is None:
+            self._entries = {}
+        self._entries[key] = value
+
+    def __contains__(self, key):
+        ''' Whether there is an entry for key, without reading it '''
+        if self._entries is not None and key in self._entries:
+            return True
+        if key == 'teacher':
+            return self.teacher_env is not None
+        if key in _ITEM_OBSERVATION_ENTRIES:
+            return key in self.item
+        return key in _OBSERVATION_ENTRIES or key in self.feature_entries
+
+    def keys(self):
+        keys = [key for key in list(_OBSERVATION_ENTRIES) + list(self.feature_entries) if key in self]
+        if self._entries is not None:
+            keys += [key for key in self._entries if key not in keys]
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+# the indices a FeatureBank makes the features and action embeddings of a
+# batch of observations from: the row of each observation's viewpoint, its
+# view index, and the absViewIndex (-1 for stop and padding) and
+# (rel_heading, rel_elevation) of each of its actions
+FeatureBankIndices = namedtuple("FeatureBankIndices", ["feature_bank", "rows", "view_indices", "action_view_indices", "action_angles"])
+
+
+class BatchedObservations(object):
+    ''' A batch of observations, with the per-observation dicts in obs and
+        their features, padded action embeddings and teacher actions stacked
+        into arrays. Indexing and iterating go through to obs.
+
+        If the observations were made with a feature bank, features and
+        action_embeddings are None, and are gathered from feature_bank on the
+        device with the indices in feature_rows, view_indices,
+        action_view_indices and action_angles instead.
+
+        The arrays are buffers owned by the R2RBatch that made them, and are
+        overwritten by its next call to observe_batched or batch_observations
+        with the same buffer_set '''
+
+    def __init__(self, obs, features, action_embeddings, is_valid, teacher, feature_bank=None,
+                 feature_rows=None, view_indices=None, action_view_indices=None, action_angles=None):
+        self.obs = obs
+        self.features = features
+        self.action_embeddings = action_embeddings
+        self.is_valid = is_valid
+        self.teacher = teacher
+        self.feature_bank = feature_bank
+        self.feature_rows = feature_rows
+        self.view_indices = view_indices
+        self.action_view_indices = action_view_indices
+        self.action_angles = action_angles
+
+    @property
+    def viewpoints(self):
+        return [ob['viewpoint'] for ob in self.obs]
+
+    def __len__(self):
+        return len(self.obs)
+
+    def __getitem__(self, index):
+        return self.obs[index]
+
+    def __iter__(self):
+        return iter(self.obs)
+
+
+class FeatureBank(object):
+    ''' The panorama features of a list of (scanId, viewpointId), as one
+        (num viewpoints, 36, feature dim) tensor on the compute device, stored
+        as dtype and read as float32. Observations and action embeddings are
+        gathered from it by row '''
+
+    def __init__(self, image_features_list, viewpoints, dtype='float32'):
+        assert len(image_features_list) == 1, 'for now, only work with MeanPooled feature'
+        featurizer = image_features_list[0]
+        self.rows = interning.ViewpointRows([viewpointId for scanId, viewpointId in viewpoints])
+        features = torch.zeros(len(viewpoints), ImageFeatures.NUM_VIEWS, featurizer.feature_dim,
+                               dtype=getattr(torch, dtype))
+        for row, (scanId, viewpointId) in enumerate(viewpoints):
+            location = NavGraphLocation(viewpointId, None, None, 0.0, 0.0, 0.0)
+            state = NavGraphState(scanId, 0, location, 0.0, 0.0, 0, [location])
+            features[row] = torch.from_numpy(np.asarray(featurizer.get_features(state), dtype=np.float32))
+        self.features = try_cuda(features)
+        self.loc_embeddings = try_cuda(torch.from_numpy(np.stack(_static_loc_embeddings)))
+
+    def get_row(self, scanId, viewpointId):
+        return self.rows[viewpointId]
+
+    def get_features(self, rows):
+        return self.features[rows].float()
+
+    def get_features_with_loc(self, rows, view_indices):
+        ''' The feature_with_loc of observations '''
+        return torch.cat([self.get_features(rows), self.loc_embeddings[view_indices]], dim=-1)
+
+    def get_action_embeddings(self, rows, action_view_indices, action_angles):
+        ''' The (padded) action embeddings of observations, as
+            _build_action_embedding makes them, from the absViewIndex of each
+            action (-1 for stop and padding, which are left as zero) and its
+            rel_heading and rel_elevation '''
+        features = self.get_features(rows)
+        action_features = features.gather(
+            1, action_view_indices.clamp(min=0).unsqueeze(2).expand(-1, -1, features.size(2)))
+        return torch.cat([action_features, self.get_action_loc_embeddings(action_angles)], dim=2) * \
+            (action_view_indices >= 0).unsqueeze(2).float()
+
+    def get_action_loc_embeddings(self, action_angles):
+        ''' The location part of action embeddings, from their rel_heading and rel_elevation '''
+        rel_headings = action_angles[:, :, 0:1]
+        rel_elevations = action_angles[:, :, 1:2]
+        return torch.cat([
+            torch.sin(rel_headings).expand(-1, -1, 32),
+            torch.cos(rel_headings).expand(-1, -1, 32),
+            torch.sin(rel_elevations).expand(-1, -1, 32),
+            torch.cos(rel_elevations).expand(-1, -1, 32)], dim=2).float()
+
+
+def _action_indices(adj_loc_list):
+    ''' absViewIndex, and rel_heading and rel_elevation, of each action, for
+        a FeatureBank to make the action embedding from '''
+    action_view_indices = np.full(len(adj_loc_list), -1, dtype=np.int64)
+    action_angles = np.zeros((len(adj_loc_list), 2), dtype=np.float64)
+    for a, adj_dict in enumerate(adj_loc_list[1:], 1):
+        action_view_indices[a] = adj_dict['absViewIndex']
+        action_angles[a] = adj_dict['rel_heading'], adj_dict['rel_elevation']
+    return action_view_indices, action_angles
+
+
+def scan_affinity_shuffle(data, block_size):
+    ''' Shuffle data in place into blocks of block_size items from the same
+        scan (fewer for the last block of a scan), in random order. It's
+        still a permutation, so an epoch covers every item '''
+    items_by_scan = defaultdict(list)
+    for item in data:
+        items_by_scan[item['scan']].append(item)
+    blocks = []
+    for scan in sorted(items_by_scan):
+        items = items_by_scan[scan]
+        random.shuffle(items)
+        blocks.extend(items[start:start + block_size] for start in range(0, len(items), block_size))
+    random.shuffle(blocks)
+    data[:] = [item for block in blocks for item in block]
+
+
 class R2RBatch():
     ''' Implements the Room to Room navigation task, using discretized viewpoints and pretrained features '''
 
-    def __init__(self, image_features_list, batch_size=100, seed=10, splits=['train'], tokenizer=None, beam_size=1, instruction_limit=None):
+    def __init__(self, image_features_list, batch_size=100, seed=10, splits=['train'], tokenizer=None, beam_size=1, instruction_limit=None, env_backend='simulator', observation_cache_size=1000, env_workers=0, feature_bank=False, feature_bank_dtype='float32', scan_affinity_block=0, simulator_threads=1):
         self.image_features_list = image_features_list
+        assert env_backend in ['simulator', 'nav_graph']
+        self.env_backend = env_backend
+        self.env_workers = env_workers
+        # per-location parts of observations, keyed by (interned viewpointId, viewIndex)
+        self.observation_cache = LRUCache(observation_cache_size)
+        # reused by batch_observations
+        self._observation_buffers = {}
         self.data = []
         self.scans = []
         self.gt = {}
@@ -690,15 +1425,43 @@ class R2RBatch():
         self.scans = set(self.scans)
         self.splits = splits
         self.seed = seed
+        self.scan_affinity_block = scan_affinity_block
+        self.simulator_threads = simulator_threads
         random.seed(self.seed)
-        random.shuffle(self.data)
+        self._shuffle()
         self.ix = 0
+        self.minibatch_count = 0
+        self.minibatch_scan_count = 0
         self.batch_size = batch_size
         self._load_nav_graphs()
+        if feature_bank:
+            self._load_feature_bank(feature_bank_dtype)
+        else:
+            self.feature_bank = None
         self.set_beam_size(beam_size)
         self.print_progress = False
         print('R2RBatch loaded with %d instructions, using splits: %s' % (len(self.data), ",".join(splits)))
 
+    @staticmethod
+    def add_args(argument_parser):
+        argument_parser.add_argument("--env_backend", choices=["simulator", "nav_graph"], default="simulator", help="nav_graph computes states from the connectivity graphs, without MatterSim")
+        argument_parser.add_argument("--observation_cache_size", type=int, default=1000, help="number of locations whose features and action embeddings are kept between steps (0 to disable)")
+        argument_parser.add_argument("--env_workers", type=int, default=0, help="step the environment in this many worker processes (0 to step it in the main process)")
+        argument_parser.add_argument("--feature_bank", action='store_true', help="keep the features in one tensor on the compute device, and make observations of indices into it")
+        argument_parser.add_argument("--feature_bank_dtype", choices=["float32", "float16"], default="float32", help="storage of the feature bank on the device")
+        argument_parser.add_argument("--scan_affinity_block", type=int, default=0, help="make minibatches of blocks of this many instructions from the same scan, and keep each simulator in one scan (0 to shuffle across scans)")
+        argument_parser.add_argument("--simulator_threads", type=int, default=1, help="threads to step the simulator with, if it was built with SimulatorBatch")
+
+    @staticmethod
+    def kwargs_from_args(args):
+        return {'env_backend': args.env_backend,
+                'observation_cache_size': args.observation_cache_size,
+                'env_workers': args.env_workers,
+                'feature_bank': args.feature_bank,
+                'feature_bank_dtype': args.feature_bank_dtype,
+                'scan_affinity_block': args.scan_affinity_block,
+                'simulator_threads': args.simulator_threads}
+
     def set_beam_size(self, beam_size, force_reload=False):
         # warning: this will invalidate the environment, self.reset() should be called afterward!
         try:
@@ -707,25 +1470,38 @@ class R2RBatch():
             invalid = True
         if force_reload or invalid:
             self.beam_size = beam_size
-            self.env = EnvBatch(self.batch_size, beam_size)
+            if hasattr(self, 'env') and hasattr(self.env, 'close'):
+                self.env.close()
+            pin_scans = self.scan_affinity_block > 0
+            if self.env_workers > 0:
+                # imported here since sharded_env depends on this module
+                from sharded_env import ShardedEnvBatch
+                self.env = ShardedEnvBatch(self.batch_size, beam_size, self.env_workers, env_backend=self.env_backend, pin_scans=pin_scans)
+            elif self.env_backend == 'nav_graph':
+                self.env = NavGraphEnvBatch(self.batch_size, beam_size)
+            else:
+                self.env = EnvBatch(self.batch_size, beam_size, pin_scans=pin_scans, simulator_threads=self.simulator_threads)
 
     def _load_nav_graphs(self):
-        ''' Load connectivity graph for each scan, useful for reasoning about shortest paths '''
+        ''' Load shortest path distances and next hops for each scan, shared with other environments and evaluators '''
         print('Loading navigation graphs for %d scans' % len(self.scans))
-        self.graphs = load_nav_graphs(self.scans)
-        self.paths = {}
-        for scan,G in self.graphs.items(): # compute all shortest paths
-            self.paths[scan] = dict(nx.all_pairs_dijkstra_path(G))
-        self.distances = {}
-        for scan,G in self.graphs.items(): # compute all shortest paths
-            self.distances[scan] = dict(nx.all_pairs_dijkstra_path_length(G))
+        self.shortest_paths = {scan: load_shortest_paths(scan) for scan in self.scans}
+
+    def _load_feature_bank(self, dtype):
+        ''' Load the features of every viewpoint of the scans onto the device '''
+        viewpoints = []
+        for scan in sorted(self.scans):
+            nav_scan = load_nav_graph_scan(scan)
+            viewpoints.extend((scan, viewpointId) for viewpointId, included in zip(nav_scan.viewpoints, nav_scan.included) if included)
+        print('Loading features of %d viewpoints into a feature bank' % len(viewpoints))
+        self.feature_bank = FeatureBank(self.image_features_list, viewpoints, dtype=dtype)
 
     def _next_minibatch(self, sort_instr_length):
         batch = self.data[self.ix:self.ix+self.batch_size]
         if self.print_progress:
             sys.stderr.write("\rix {} / {}".format(self.ix, len(self.data)))
         if len(batch) < self.batch_size:
-            random.shuffle(self.data)
+            self._shuffle()
             self.ix = self.batch_size - len(batch)
             batch += self.data[:self.ix]
         else:
@@ -733,6 +1509,30 @@ class R2RBatch():
         if sort_instr_length:
             batch = sorted(batch, key=lambda item: item['instr_length'], reverse=True)
         self.batch = batch
+        self.minibatch_count += 1
+        self.minibatch_scan_count += len(set(item['scan'] for item in batch))
+
+    def _shuffle(self):
+        if self.scan_affinity_block > 0:
+            scan_affinity_shuffle(self.data, self.scan_affinity_block)
+        else:
+            random.shuffle(self.data)
+
+    def scan_locality(self):
+        ''' The mean number of scans in the minibatches loaded so far and, with
+            the simulator backend in this process, the number of times a
+            simulator was moved to another scan and the number of scan location
+            graphs the simulators of the process share '''
+        locality = {
+            'minibatches': self.minibatch_count,
+            'scans_per_minibatch': self.minibatch_scan_count / self.minibatch_count if self.minibatch_count else 0.,
+        }
+        if hasattr(self.env, 'simulator_pool'):
+            locality['scene_loads'] = self.env.simulator_pool.scene_loads
+            locality['simulators'] = len(self.env.simulator_pool)
+            if hasattr(MatterSim, 'locationGraphCacheSize'):
+                locality['location_graphs'] = MatterSim.locationGraphCacheSize()
+        return locality
 
     def reset_epoch(self):
         ''' Reset the data index to beginning of epoch. Primarily for testing.
@@ -746,9 +1546,8 @@ class R2RBatch():
         '''
         if state.location.viewpointId == goalViewpointId:
             return 0  # do nothing
-        path = self.paths[state.scanId][state.location.viewpointId][
-            goalViewpointId]
-        nextViewpointId = path[1]
+        nextViewpointId = self.shortest_paths[state.scanId].next_viewpoint(
+            state.location.viewpointId, goalViewpointId)
         for n_a, loc_attr in enumerate(adj_loc_list):
             if loc_attr['nextViewpointId'] == nextViewpointId:
                 return n_a
@@ -760,39 +1559,68 @@ class R2RBatch():
         print('longId:', long_id)
         raise Exception('Bug: nextViewpointId not in adj_loc_list')
 
-    def observe(self, world_states, beamed=False, include_teacher=True):
+    @staticmethod
+    def _observation_key(world_state):
+        heading, elevation, viewIndex = discretize_view(world_state.heading, world_state.elevation)
+        return interning.viewpoints.intern(world_state.viewpointId), viewIndex
+
+    def _get_observation_parts(self, world_states, beamed=False):
+        ''' (state, adj_loc_list, feature entries) for each world state, in the
+            same structure as world_states, where the feature entries of an
+            observation are its feature and action_embedding or, with a feature
+            bank, the indices to gather them from it. These only depend on the
+            location and discretized view, so they are cached between calls,
+            and world states sharing a view are only loaded once per call.
+            The returned parts are shared and shouldn't be modified '''
+        keys = structured_map(self._observation_key, world_states, nested=beamed)
+        parts = {}
+        # grouped by batch row, since the simulator backend has a set of sims per row
+        to_load = []
+        for row_keys, row_world_states in zip(keys, world_states) if beamed else zip([[k] for k in keys], [[ws] for ws in world_states]):
+            row_to_load = []
+            for key, world_state in zip(row_keys, row_world_states):
+                if key in parts:
+                    continue
+                parts[key] = self.observation_cache.get(key)
+                if parts[key] is None:
+                    row_to_load.append((key, world_state))
+            to_load.append(row_to_load)
+
+        loaded = self.env.getStates([[world_state for key, world_state in row] for row in to_load], beamed=True)
+        for row_to_load, row_loaded in zip(to_load, loaded):
+            for (key, _), (state, adj_loc_list) in zip(row_to_load, row_loaded):
+                if self.feature_bank is not None:
+                    action_view_indices, action_angles = _action_indices(adj_loc_list)
+                    feature_entries = {
+                        'feature_row': self.feature_bank.get_row(state.scanId, state.location.viewpointId),
+                        'action_view_indices': action_view_indices,
+                        'action_angles': action_angles,
+                    }
+                else:
+                    feature = [featurizer.get_features(state) for featurizer in self.image_features_list]
+                    assert len(feature) == 1, 'for now, only work with MeanPooled feature'
+                    feature_with_loc = np.concatenate((feature[0], _static_loc_embeddings[state.viewIndex]), axis=-1)
+                    feature_entries = {
+                        'feature': [feature_with_loc],
+                        'action_embedding': _build_action_embedding(adj_loc_list, feature[0]),
+                    }
+                parts[key] = (state, adj_loc_list, feature_entries)
+                self.observation_cache.put(key, parts[key])
+        return structured_map(parts.__getitem__, keys, nested=beamed)
+
+    def observe(self, world_states, beamed=False, include_teacher=True, rows=None):
+        ''' Observations of world states (a list of beams if beamed) of the
+            minibatch. rows are the indices in the minibatch of the items the
+            world states belong to, if they aren't all of them in order '''
         #start_time = time.time()
         obs = []
-        for i,states_beam in enumerate(self.env.getStates(world_states, beamed=beamed)):
-            item = self.batch[i]
+        for i,parts_beam in enumerate(self._get_observation_parts(world_states, beamed=beamed)):
+            item = self.batch[rows[i] if rows is not None else i]
             obs_batch = []
-            for state, adj_loc_list in states_beam if beamed else [states_beam]:
+            for state, adj_loc_list, feature_entries in parts_beam if beamed else [parts_beam]:
                 assert item['scan'] == state.scanId
-                feature = [featurizer.get_features(state) for featurizer in self.image_features_list]
-                assert len(feature) == 1, 'for now, only work with MeanPooled feature'
-                feature_with_loc = np.concatenate((feature[0], _static_loc_embeddings[state.viewIndex]), axis=-1)
-                action_embedding = _build_action_embedding(adj_loc_list, feature[0])
-                ob = {
-                    'instr_id' : item['instr_id'],
-                    'scan' : state.scanId,
-                    'viewpoint' : state.location.viewpointId,
-                    'viewIndex' : state.viewIndex,
-                    'heading' : state.heading,
-                    'elevation' : state.elevation,
-                    'feature' : [feature_with_loc],
-                    'step' : state.step,
-                    'adj_loc_list' : adj_loc_list,
-                    'action_embedding': action_embedding,
-                    'navigableLocations' : state.navigableLocations,
-                    'instructions' : item['instructions'],
-                }
-                if include_teacher:
-                    ob['teacher'] = self._shortest_path_action(state, adj_loc_list, item['path'][-1])
-                if 'instr_encoding' in item:
-                    ob['instr_encoding'] = item['instr_encoding']
-                if 'instr_length' in item:
-                    ob['instr_length'] = item['instr_length']
-                obs_batch.append(ob)
+                obs_batch.append(Observation(item, state, adj_loc_list, feature_entries,
+                                             teacher_env=self if include_teacher else None))
             if beamed:
                 obs.append(obs_batch)
             else:
@@ -803,6 +1631,65 @@ class R2RBatch():
         #print("get obs in {} seconds".format(end_time - start_time))
         return obs
 
+    def _observation_buffer(self, name, shape, dtype, buffer_set=0):
+        size = int(np.prod(shape))
+        buffer = self._observation_buffers.get((name, buffer_set))
+        if buffer is None or buffer.size < size:
+            buffer = np.empty(size, dtype)
+            self._observation_buffers[(name, buffer_set)] = buffer
+        return buffer[:size].reshape(shape)
+
+    def batch_observations(self, obs, buffer_set=0):
+        ''' Stack a flat list of observations into a BatchedObservations, in
+            the buffers of buffer_set. Batches that are used at the same time
+            should be made in different buffer sets '''
+        batch_size = len(obs)
+        max_num_a = max(len(ob['adj_loc_list']) for ob in obs)
+        if all('teacher' in ob for ob in obs):
+            teacher = self._observation_buffer('teacher', (batch_size,), np.int64, buffer_set)
+            teacher[:] = [ob['teacher'] for ob in obs]
+        else:
+            teacher = None
+        is_valid = self._observation_buffer('is_valid', (batch_size, max_num_a), np.float32, buffer_set)
+        is_valid.fill(0)
+        for i, ob in enumerate(obs):
+            is_valid[i, :len(ob['adj_loc_list'])] = 1.
+
+        if self.feature_bank is not None:
+            feature_rows = self._observation_buffer('feature_rows', (batch_size,), np.int64, buffer_set)
+            feature_rows[:] = [ob['feature_row'] for ob in obs]
+            view_indices = self._observation_buffer('view_indices', (batch_size,), np.int64, buffer_set)
+            view_indices[:] = [ob['viewIndex'] for ob in obs]
+            action_view_indices = self._observation_buffer('action_view_indices', (batch_size, max_num_a), np.int64, buffer_set)
+            action_view_indices.fill(-1)
+            action_angles = self._observation_buffer('action_angles', (batch_size, max_num_a, 2), np.float64, buffer_set)
+            action_angles.fill(0)
+            for i, ob in enumerate(obs):
+                num_a = len(ob['adj_loc_list'])
+                action_view_indices[i, :num_a] = ob['action_view_indices']
+                action_angles[i, :num_a] = ob['action_angles']
+            return BatchedObservations(
+                obs, None, None, is_valid, teacher, feature_bank=self.feature_bank,
+                feature_rows=feature_rows, view_indices=view_indices,
+                action_view_indices=action_view_indices, action_angles=action_angles)
+
+        feature_shape = obs[0]['feature'][0].shape
+        action_embedding_dim = obs[0]['action_embedding'].shape[-1]
+
+        features = self._observation_buffer('features', (batch_size,) + feature_shape, np.float32, buffer_set)
+        np.stack([ob['feature'][0] for ob in obs], out=features)
+        action_embeddings = self._observation_buffer(
+            'action_embeddings', (batch_size, max_num_a, action_embedding_dim), np.float32, buffer_set)
+        action_embeddings.fill(0)
+        for i, ob in enumerate(obs):
+            action_embeddings[i, :len(ob['adj_loc_list'])] = ob['action_embedding']
+        return BatchedObservations(obs, features, action_embeddings, is_valid, teacher)
+
+    def observe_batched(self, world_states, include_teacher=True, rows=None, buffer_set=0):
+        ''' observe, returning a BatchedObservations '''
+        return self.batch_observations(
+            self.observe(world_states, include_teacher=include_teacher, rows=rows), buffer_set=buffer_set)
+
     def get_starting_world_states(self, instance_list, beamed=False):
         scanIds = [item['scan'] for item in instance_list]
         viewpointIds = [item['path'][0] for item in instance_list]
@@ -820,31 +1707,72 @@ class R2RBatch():
         ''' Take action (same interface as makeActions) '''
         return self.env.makeActions(world_states, actions, last_obs, beamed=beamed)
 
+    def _gold_action(self, world_state, goalViewpointId):
+        ''' The teacher action from world_state, and the world state it leads
+            to, using the adjacency of the connectivity graph rather than the
+            environment '''
+        heading, elevation, viewIndex = discretize_view(world_state.heading, world_state.elevation)
+        if world_state.viewpointId == goalViewpointId:
+            return 0, WorldState(world_state.scanId, world_state.viewpointId, heading, elevation)
+        scan = load_nav_graph_scan(world_state.scanId)
+        nextViewpointId = self.shortest_paths[world_state.scanId].next_viewpoint(
+            world_state.viewpointId, goalViewpointId)
+        adj_loc_list = scan.get_adj_loc_list(scan.get_ix(world_state.viewpointId), viewIndex)
+        for n_a, loc_attr in enumerate(adj_loc_list):
+            if loc_attr['nextViewpointId'] == nextViewpointId:
+                heading, elevation = view_heading_elevation(loc_attr['absViewIndex'])
+                return n_a, WorldState(world_state.scanId, nextViewpointId, heading, elevation)
+        raise Exception('Bug: nextViewpointId %s not in adj_loc_list of %s_%s' % (
+            nextViewpointId, world_state.scanId, world_state.viewpointId))
+
+    def gold_paths(self, starting_world_states, max_steps):
+        ''' The world states and teacher actions of following the shortest
+            path to the goal of each item in the batch, ending with the stop
+            action (which leaves the final location duplicated) unless max_steps
+            is reached first. These are computed from the next hop tables
+            without stepping the environment or making any observations, so
+            the actions index the adj_loc_lists of the connectivity graph;
+            shortest_paths_to_goals resolves them against the observed ones '''
+        all_world_states = [[world_state] for world_state in starting_world_states]
+        all_actions = [[] for _ in starting_world_states]
+        for world_states, actions, item in zip(all_world_states, all_actions, self.batch):
+            goalViewpointId = item['path'][-1]
+            while len(actions) < max_steps and (not actions or actions[-1] != 0):
+                action, world_state = self._gold_action(world_states[-1], goalViewpointId)
+                actions.append(action)
+                world_states.append(world_state)
+        return all_world_states, all_actions
+
+    def _observed_gold_actions(self, world_states, obs, actions):
+        ''' The gold actions of a path as indices in the adj_loc_list of its
+            observations, found by the viewpoint each leads to, since
+            gold_paths numbers them in the adj_loc_list of the connectivity
+            graph, which the environment might order differently. Raises if
+            an observation has no action to the gold path's next viewpoint,
+            or one that looks at a different view '''
+        observed_actions = []
+        for ob, action, next_world_state in zip(obs, actions, world_states[1:]):
+            if action == 0:
+                observed_actions.append(0)
+                continue
+            for n_a, loc_attr in enumerate(ob['adj_loc_list']):
+                if n_a > 0 and loc_attr['nextViewpointId'] == next_world_state.viewpointId:
+                    break
+            else:
+                raise Exception('Bug: gold nextViewpointId %s not in the observed adj_loc_list of %s_%s' % (
+                    next_world_state.viewpointId, ob['scan'], ob['viewpoint']))
+            if view_heading_elevation(loc_attr['absViewIndex']) != (next_world_state.heading, next_world_state.elevation):
+                raise Exception('Bug: observed absViewIndex %d to %s from %s_%s differs from the connectivity graph' % (
+                    loc_attr['absViewIndex'], next_world_state.viewpointId, ob['scan'], ob['viewpoint']))
+            observed_actions.append(n_a)
+        return observed_actions
+
     def shortest_paths_to_goals(self, starting_world_states, max_steps):
-        world_states = starting_world_states
-        obs = self.observe(world_states)
-
-        all_obs = []
-        all_actions = []
-        for ob in obs:
-            all_obs.append([ob])
-            all_actions.append([])
-
-        ended = np.array([False] * len(obs))
-        for t in range(max_steps):
-            actions = [ob['teacher'] for ob in obs]
-            world_states = self.step(world_states, actions, obs)
-            obs = self.observe(world_states)
-            for i,ob in enumerate(obs):
-                if not ended[i]:
-                    all_obs[i].append(ob)
-            for i,a in enumerate(actions):
-                if not ended[i]:
-                    all_actions[i].append(a)
-                    if a == 0:
-                        ended[i] = True
-            if ended.all():
-                break
+        all_world_states, all_actions = self.gold_paths(starting_world_states, max_steps)
+        # observe every location on the paths at once
+        all_obs = self.observe(all_world_states, beamed=True)
+        all_actions = [self._observed_gold_actions(world_states, obs, actions)
+                       for world_states, obs, actions in zip(all_world_states, all_obs, all_actions)]
         return all_obs, all_actions
 
     def gold_obs_actions_and_instructions(self, max_steps, load_next_minibatch=True):
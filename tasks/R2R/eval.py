@@ -2,13 +2,13 @@
 
 import json
 from collections import defaultdict
-import networkx as nx
 import numpy as np
 import pprint; pp = pprint.PrettyPrinter(indent=4)  # NoQA
 
 from env import R2RBatch, ImageFeatures
 import utils
-from utils import load_datasets, load_nav_graphs
+from utils import load_datasets
+from shortest_paths import load_shortest_paths
 from follower import BaseAgent
 
 import train
@@ -40,16 +40,13 @@ class Evaluation(object):
                 '%d_%d' % (item['path_id'], i) for i in range(3)]
         self.scans = set(self.scans)
         self.instr_ids = set(self.instr_ids)
-        self.graphs = load_nav_graphs(self.scans)
-        self.distances = {}
-        for scan, G in self.graphs.items():  # compute all shortest paths
-            self.distances[scan] = dict(nx.all_pairs_dijkstra_path_length(G))
+        self.shortest_paths = {scan: load_shortest_paths(scan) for scan in self.scans}
 
     def _get_nearest(self, scan, goal_id, path):
         near_id = path[0][0]
-        near_d = self.distances[scan][near_id][goal_id]
+        near_d = self.shortest_paths[scan].distance(near_id, goal_id)
         for item in path:
-            d = self.distances[scan][item[0]][goal_id]
+            d = self.shortest_paths[scan].distance(item[0], goal_id)
             if d < near_d:
                 near_id = item[0]
                 near_d = d
@@ -65,13 +62,14 @@ class Evaluation(object):
         goal = gt['path'][-1]
         final_position = path[-1][0]
         nearest_position = self._get_nearest(gt['scan'], goal, path)
-        nav_error = self.distances[gt['scan']][final_position][goal]
-        oracle_error = self.distances[gt['scan']][nearest_position][goal]
+        shortest_paths = self.shortest_paths[gt['scan']]
+        nav_error = shortest_paths.distance(final_position, goal)
+        oracle_error = shortest_paths.distance(nearest_position, goal)
         trajectory_steps = len(path)-1
         trajectory_length = 0  # Work out the length of the path in meters
         prev = path[0]
         for curr in path[1:]:
-            trajectory_length += self.distances[gt['scan']][prev[0]][curr[0]]
+            trajectory_length += shortest_paths.distance(prev[0], curr[0])
             prev = curr
 
         success = nav_error < self.error_margin
@@ -167,7 +165,8 @@ def eval_simple_agents(args):
     ''' Run simple baselines on each split. '''
     img_features = ImageFeatures.from_args(args)
     for split in ['train', 'val_seen', 'val_unseen', 'test']:
-        env = R2RBatch(img_features, batch_size=1, splits=[split])
+        env = R2RBatch(img_features, batch_size=1, splits=[split],
+                       **R2RBatch.kwargs_from_args(args))
         ev = Evaluation([split])
 
         for agent_type in ['Stop', 'Shortest', 'Random']:
@@ -0,0 +1,126 @@
+''' Binary mean-pooled feature stores, converted once from the feature TSVs
+    so that they can be memory mapped instead of parsed in every process '''
+
+import os.path
+import json
+import functools
+import argparse
+
+import numpy as np
+
+import paths
+import interning
+
+
+FEATURE_DTYPES = ['float32', 'float16', 'int8']
+
+
+def feature_store_path(prefix, dtype='float32'):
+    if dtype == 'float32':
+        return prefix + '.npy'
+    return '%s_%s.npy' % (prefix, dtype)
+
+
+def int8_scale_path(prefix):
+    return prefix + '_int8_scale.npy'
+
+
+class FeatureStore(object):
+    ''' Read-only features of every viewpoint, as a (num viewpoints, 36,
+        feature dim) array in <prefix>.npy and with the (scanId, viewpointId)
+        of each row in <prefix>_index.json.
+
+        The float16 and int8 stores hold the same array quantized (int8 with a
+        scale per feature channel), and rows are dequantized to float32 as they
+        are read '''
+
+    def __init__(self, prefix, dtype='float32'):
+        assert dtype in FEATURE_DTYPES
+        path = feature_store_path(prefix, dtype)
+        print('Memory mapping image features from %s' % path)
+        self.features = np.load(path, mmap_mode='r')
+        self.scale = np.load(int8_scale_path(prefix)) if dtype == 'int8' else None
+        with open(prefix + '_index.json') as f:
+            self.viewpoints = [tuple(scan_and_viewpoint) for scan_and_viewpoint in json.load(f)]
+        assert len(self.viewpoints) == len(self.features)
+        self._rows = interning.ViewpointRows([viewpointId for scanId, viewpointId in self.viewpoints])
+
+    def __contains__(self, scan_and_viewpoint):
+        return scan_and_viewpoint[1] in self._rows
+
+    def get_features(self, scanId, viewpointId):
+        features = self.features[self._rows[viewpointId]]
+        if self.scale is not None:
+            return features * self.scale
+        if features.dtype != np.float32:
+            return features.astype(np.float32)
+        return features
+
+
+@functools.lru_cache(maxsize=None)
+def load_feature_store(prefix, dtype='float32'):
+    ''' Load a store shared by all featurizers in this process '''
+    return FeatureStore(prefix, dtype)
+
+
+def convert_mean_pooled_tsv(tsv_path, prefix):
+    # imported here so that loading a store doesn't require the simulator
+    from env import read_mean_pooled_tsv, ImageFeatures
+
+    with open(tsv_path, "rt") as f:
+        num_rows = sum(1 for line in f if line.strip())
+    print('Converting %d rows of %s to %s' % (num_rows, tsv_path, feature_store_path(prefix)))
+    features = np.lib.format.open_memmap(
+        feature_store_path(prefix), mode='w+', dtype=np.float32,
+        shape=(num_rows, ImageFeatures.NUM_VIEWS, ImageFeatures.MEAN_POOLED_DIM))
+    viewpoints = []
+    for row, (scanId, viewpointId, row_features) in enumerate(read_mean_pooled_tsv(tsv_path)):
+        features[row] = row_features
+        viewpoints.append([scanId, viewpointId])
+    assert len(viewpoints) == num_rows
+    features.flush()
+    del features
+    with open(prefix + '_index.json', 'w') as f:
+        json.dump(viewpoints, f)
+
+
+def quantize_feature_store(prefix, dtype, chunk_size=1000):
+    ''' Write a float16 or int8 copy of the float32 store at prefix. int8 uses
+        a symmetric scale per feature channel, from its largest magnitude '''
+    assert dtype in ['float16', 'int8']
+    features = np.load(feature_store_path(prefix), mmap_mode='r')
+    chunks = [slice(start, start + chunk_size) for start in range(0, len(features), chunk_size)]
+    print('Quantizing %s to %s' % (feature_store_path(prefix), feature_store_path(prefix, dtype)))
+    quantized = np.lib.format.open_memmap(
+        feature_store_path(prefix, dtype), mode='w+', dtype=dtype, shape=features.shape)
+    if dtype == 'int8':
+        max_abs = np.zeros(features.shape[-1], dtype=np.float32)
+        for chunk in chunks:
+            max_abs = np.maximum(max_abs, np.abs(features[chunk]).max(axis=(0, 1)))
+        scale = np.where(max_abs > 0, max_abs / 127., 1.).astype(np.float32)
+        np.save(int8_scale_path(prefix), scale)
+        for chunk in chunks:
+            quantized[chunk] = np.clip(np.rint(features[chunk] / scale), -127, 127)
+    else:
+        for chunk in chunks:
+            quantized[chunk] = features[chunk]
+    quantized.flush()
+    del quantized
+
+
+def make_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image_feature_datasets", nargs="+", choices=["imagenet", "places365"], default=["imagenet"])
+    parser.add_argument("--dtype", nargs="+", choices=FEATURE_DTYPES, default=["float32"], help="quantized stores are made from the float32 one, which is converted first if it doesn't exist")
+    return parser
+
+
+if __name__ == "__main__":
+    args = make_arg_parser().parse_args()
+    for dataset in args.image_feature_datasets:
+        prefix = paths.mean_pooled_binary_feature_store_paths[dataset]
+        if 'float32' in args.dtype or not os.path.exists(feature_store_path(prefix)):
+            convert_mean_pooled_tsv(paths.mean_pooled_feature_store_paths[dataset], prefix)
+        for dtype in args.dtype:
+            if dtype != 'float32':
+                quantize_feature_store(prefix, dtype)
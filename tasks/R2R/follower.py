@@ -2,6 +2,8 @@
 
 import json
 import sys
+import heapq
+import bisect
 import numpy as np
 import random
 from collections import namedtuple
@@ -12,22 +14,36 @@ from torch.autograd import Variable
 import torch.nn.functional as F
 import torch.distributions as D
 
-from utils import vocab_pad_idx, vocab_eos_idx, flatten, structured_map, try_cuda
+from utils import vocab_pad_idx, vocab_eos_idx, flatten, structured_map, try_cuda, OrderedWorker
+from env import BatchedObservations, FeatureBankIndices, discretize_view, adjacent_world_state
+from tensor_env import TensorizedR2RBatch
 
 #from env import FOLLOWER_MODEL_ACTIONS, FOLLOWER_ENV_ACTIONS, IGNORE_ACTION_INDEX, LEFT_ACTION_INDEX, RIGHT_ACTION_INDEX, START_ACTION_INDEX, END_ACTION_INDEX, FORWARD_ACTION_INDEX, index_action_tuple
 
 InferenceState = namedtuple("InferenceState", "prev_inference_state, world_state, observation, flat_index, last_action, last_action_embedding, action_count, score, h_t, c_t, last_alpha")
 
-Cons = namedtuple("Cons", "first, rest")
-
-def cons_to_list(cons):
-    l = []
-    while True:
-        l.append(cons.first)
-        cons = cons.rest
-        if cons is None:
-            break
-    return l
+# the successors of a step of beam_search, as tensors of the instance, the
+# successor of the previous step it follows (-1 at the start), the beam
+# element it was expanded from, and the action and score of each, and lists
+# of the world state and observation each leads to
+BeamSearchStep = namedtuple("BeamSearchStep", "instances, predecessors, parents, actions, scores, world_states, observations, action_embeddings, alphas")
+
+def _buffer_variable(array):
+    ''' Variable with a copy of array, which may be a buffer that is reused
+        for the next batch of observations '''
+    tensor = try_cuda(torch.from_numpy(array))
+    if not tensor.is_cuda:
+        tensor = tensor.clone()
+    return Variable(tensor, requires_grad=False)
+
+def _split_rows(flat, counts):
+    ''' Split a flat list into consecutive rows of the given lengths '''
+    rows = []
+    start = 0
+    for count in counts:
+        rows.append(flat[start:start + count])
+        start += count
+    return rows
 
 def backchain_inference_states(last_inference_state):
     states = []
@@ -49,28 +65,169 @@ def backchain_inference_states(last_inference_state):
     scores.append(last_score)
     return list(reversed(states)), list(reversed(observations)), list(reversed(actions))[1:], list(reversed(scores))[1:], list(reversed(attentions))[1:] # exclude start action
 
-def least_common_viewpoint_path(inf_state_a, inf_state_b):
+class AncestorIndex(object):
+    ''' The ancestors of inference states, indexed so that paths between
+        them in the search tree are found without walking and copying their
+        prev_inference_state chains. For each state it holds the tuple of its
+        ancestors from the root (ending with the state itself), and the depth
+        of the first state at each viewpoint along that chain. Entries are
+        made on demand from the entry of the parent, and hold their states,
+        so ids stay unique for the life of the index '''
+
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, inf_state):
+        ''' (ancestors, viewpoint_depths) of inf_state '''
+        entry = self._entries.get(id(inf_state))
+        if entry is not None:
+            return entry
+        unindexed = []
+        while inf_state is not None and id(inf_state) not in self._entries:
+            unindexed.append(inf_state)
+            inf_state = inf_state.prev_inference_state
+        if inf_state is None:
+            ancestors, viewpoint_depths = (), {}
+        else:
+            ancestors, viewpoint_depths = self._entries[id(inf_state)]
+        for inf_state in reversed(unindexed):
+            viewpointId = inf_state.world_state.viewpointId
+            if viewpointId not in viewpoint_depths:
+                viewpoint_depths = dict(viewpoint_depths)
+                viewpoint_depths[viewpointId] = len(ancestors)
+            ancestors = ancestors + (inf_state,)
+            self._entries[id(inf_state)] = ancestors, viewpoint_depths
+        return ancestors, viewpoint_depths
+
+    def common_viewpoint_runs(self, inf_state_a, inf_state_b):
+        ''' The ancestors of A and B, and the depths of X and Y, where X is
+            the nearest ancestor of A that shares a viewpointId with an
+            ancestor of B, and Y the first such ancestor of B '''
+        a_ancestors, _ = self.get(inf_state_a)
+        b_ancestors, b_viewpoint_depths = self.get(inf_state_b)
+        for a_depth in range(len(a_ancestors) - 1, -1, -1):
+            b_depth = b_viewpoint_depths.get(a_ancestors[a_depth].world_state.viewpointId)
+            if b_depth is not None:
+                return a_ancestors, a_depth, b_ancestors, b_depth
+        raise AssertionError("no common ancestor found")
+
+def least_common_viewpoint_path(inf_state_a, inf_state_b, ancestor_index=None):
     # return inference states traversing from A to X, then from Y to B,
     # where X and Y are the least common ancestors of A and B respectively that share a viewpointId
-    path_to_b_by_viewpoint =  {
-    }
-    b = inf_state_b
-    b_stack = Cons(b, None)
-    while b is not None:
-        path_to_b_by_viewpoint[b.world_state.viewpointId] = b_stack
-        b = b.prev_inference_state
-        b_stack = Cons(b, b_stack)
-    a = inf_state_a
-    path_from_a = [a]
-    while a is not None:
-        vp = a.world_state.viewpointId
-        if vp in path_to_b_by_viewpoint:
-            path_to_b = cons_to_list(path_to_b_by_viewpoint[vp])
-            assert path_from_a[-1].world_state.viewpointId == path_to_b[0].world_state.viewpointId
-            return path_from_a + path_to_b[1:]
-        a = a.prev_inference_state
-        path_from_a.append(a)
-    raise AssertionError("no common ancestor found")
+    if ancestor_index is None:
+        ancestor_index = AncestorIndex()
+    a_ancestors, a_depth, b_ancestors, b_depth = ancestor_index.common_viewpoint_runs(inf_state_a, inf_state_b)
+    return list(reversed(a_ancestors[a_depth:])) + list(b_ancestors[b_depth + 1:])
+
+class TraversedPath(object):
+    ''' The inference states an agent physically passes through as it moves
+        from each state it expands to the next, starting at first_state.
+        Rather than a list of states, it is a list of runs of the ancestor
+        tuples of an AncestorIndex, each run being (ancestors, range of
+        depths), so extending it is O(1) in memory. It can be indexed and
+        iterated like a list of the states. last is the state it was last
+        extended to, whose viewpoint it ends at '''
+
+    def __init__(self, first_state, ancestor_index):
+        self.ancestor_index = ancestor_index
+        self.last = first_state
+        self._runs = [((first_state,), range(1))]
+        self._ends = [1]
+
+    def __len__(self):
+        return self._ends[-1]
+
+    def __iter__(self):
+        for ancestors, depths in self._runs:
+            for depth in depths:
+                yield ancestors[depth]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        run_index = bisect.bisect_right(self._ends, index)
+        ancestors, depths = self._runs[run_index]
+        return ancestors[depths[index - self._ends[run_index] + len(depths)]]
+
+    def __add__(self, inf_states):
+        return list(self) + list(inf_states)
+
+    def _append_run(self, ancestors, depths):
+        if len(depths) > 0:
+            self._runs.append((ancestors, depths))
+            self._ends.append(self._ends[-1] + len(depths))
+
+    def extend_to(self, inf_state):
+        ''' Move from last to inf_state, along least_common_viewpoint_path '''
+        assert self.last.world_state.viewpointId == self[-1].world_state.viewpointId
+        a_ancestors, a_depth, b_ancestors, b_depth = \
+            self.ancestor_index.common_viewpoint_runs(self.last, inf_state)
+        # the path starts at last's viewpoint, which the path already ends at
+        self._append_run(a_ancestors, range(len(a_ancestors) - 2, a_depth - 1, -1))
+        self._append_run(b_ancestors, range(b_depth + 1, len(b_ancestors)))
+        assert self[-1].world_state.viewpointId == inf_state.world_state.viewpointId
+        self.last = inf_state
+
+def _beam_successors(instances, scores, log_probs, batch_size, beam_size):
+    ''' The best beam_size successors of each instance of a flattened beam,
+        by a top-k over the (beam element, action) pairs of the instance.
+        instances are the instance of each beam element, which are grouped by
+        instance, and log_probs the log probabilities of their actions (-inf
+        for invalid actions). Returns the instance, beam element, action and
+        score of each successor, grouped by instance and best first '''
+    instance_counts = torch.bincount(instances, minlength=batch_size)
+    slots = try_cuda(torch.arange(len(instances))) - (torch.cumsum(instance_counts, 0) - instance_counts)[instances]
+    num_a = log_probs.size(1)
+    candidate_scores = try_cuda(torch.full((batch_size, beam_size, num_a), -float('inf')))
+    candidate_scores[instances, slots] = scores.unsqueeze(1) + log_probs
+    top_scores, top_indices = candidate_scores.view(batch_size, -1).topk(beam_size, dim=1)
+    candidate_slots = try_cuda(torch.arange(beam_size)).view(-1, 1).expand(beam_size, num_a).contiguous().view(-1)
+    candidate_actions = try_cuda(torch.arange(num_a)).repeat(beam_size)
+    element_by_slot = torch.full_like(candidate_scores[:, :, 0], -1).long()
+    element_by_slot[instances, slots] = try_cuda(torch.arange(len(instances)))
+
+    successor_instances, successor_ranks = (top_scores > -float('inf')).nonzero().t()
+    successor_indices = top_indices[successor_instances, successor_ranks]
+    parents = element_by_slot[successor_instances, candidate_slots[successor_indices]]
+    actions = candidate_actions[successor_indices]
+    return successor_instances, parents, actions, top_scores[successor_instances, successor_ranks]
+
+class StateFrontier(object):
+    ''' The best inference state found for each key of a search instance, as
+        (inf_state, expanded), with a heap of the unexpanded ones by score so
+        that adding a state and popping the best are O(log n). A state that is
+        replaced by a better one for its key stays in the heap, and is skipped
+        when it is popped '''
+
+    def __init__(self):
+        self.best = {}
+        self._heap = []
+        self._pushed = 0
+
+    def improves(self, key, score):
+        return key not in self.best or self.best[key][0].score < score
+
+    def add(self, key, inf_state):
+        self.best[key] = (inf_state, False)
+        # ties go to the state added first
+        heapq.heappush(self._heap, (-inf_state.score, self._pushed, key, inf_state))
+        self._pushed += 1
+
+    def expand(self, n):
+        ''' Mark the (up to) n best unexpanded states expanded, and return
+            their keys and states, best first '''
+        expanded = []
+        while self._heap and len(expanded) < n:
+            _, _, key, inf_state = heapq.heappop(self._heap)
+            best_state, best_expanded = self.best[key]
+            if best_state is inf_state and not best_expanded:
+                self.best[key] = (inf_state, True)
+                expanded.append((key, inf_state))
+        return expanded
 
 def batch_instructions_from_encoded(encoded_instructions, max_length, reverse=False, sort=False):
     # encoded_instructions: list of lists of token indices (should not be padded, or contain BOS or EOS tokens)
@@ -194,6 +351,10 @@ class BaseAgent(object):
 def path_element_from_observation(ob):
     return (ob['viewpoint'], ob['heading'], ob['elevation'])
 
+def path_element_from_world_state(world_state):
+    heading, elevation, _ = discretize_view(world_state.heading, world_state.elevation)
+    return (world_state.viewpointId, heading, elevation)
+
 class StopAgent(BaseAgent):
     ''' An agent that doesn't move! '''
 
@@ -247,15 +408,15 @@ class ShortestAgent(BaseAgent):
 
     def rollout(self):
         world_states = self.env.reset()
-        #obs = self.env.observe(world_states)
-        all_obs, all_actions = self.env.shortest_paths_to_goals(world_states, 20)
+        # only the locations are needed, so the paths aren't observed
+        all_world_states, all_actions = self.env.gold_paths(world_states, 20)
         return [
             {
-                'instr_id': obs[0]['instr_id'],
+                'instr_id': item['instr_id'],
                 # end state will appear twice because stop action is a no-op, so exclude it
-                'trajectory': [path_element_from_observation(ob) for ob in obs[:-1]]
+                'trajectory': [path_element_from_world_state(ws) for ws in path_world_states[:-1]]
             }
-            for obs in all_obs
+            for item, path_world_states in zip(self.env.batch, all_world_states)
         ]
 
 class Seq2SeqAgent(BaseAgent):
@@ -269,7 +430,7 @@ class Seq2SeqAgent(BaseAgent):
     # end_index = END_ACTION_INDEX
     feedback_options = ['teacher', 'argmax', 'sample']
 
-    def __init__(self, env, results_path, encoder, decoder, episode_len=10, beam_size=1, reverse_instruction=True, max_instruction_length=80):
+    def __init__(self, env, results_path, encoder, decoder, episode_len=10, beam_size=1, reverse_instruction=True, max_instruction_length=80, pipelined=False):
         super(Seq2SeqAgent, self).__init__(env, results_path)
         self.encoder = encoder
         self.decoder = decoder
@@ -279,6 +440,7 @@ class Seq2SeqAgent(BaseAgent):
         self.beam_size = beam_size
         self.reverse_instruction = reverse_instruction
         self.max_instruction_length = max_instruction_length
+        self.pipelined = pipelined
 
     # @staticmethod
     # def n_inputs():
@@ -290,6 +452,13 @@ class Seq2SeqAgent(BaseAgent):
 
     def _feature_variables(self, obs, beamed=False):
         ''' Extract precomputed features into variable. '''
+        if isinstance(obs, BatchedObservations):
+            if obs.feature_bank is not None:
+                return [obs.feature_bank.get_features_with_loc(
+                    _buffer_variable(obs.feature_rows), _buffer_variable(obs.view_indices))]
+            return [_buffer_variable(obs.features)]
+        if self.env.feature_bank is not None:
+            return self._feature_variables(self.env.batch_observations(flatten(obs) if beamed else obs))
         feature_lists = list(zip(*[ob['feature'] for ob in (flatten(obs) if beamed else obs)]))
         assert len(feature_lists) == len(self.env.image_features_list)
         batched = []
@@ -297,7 +466,32 @@ class Seq2SeqAgent(BaseAgent):
             batched.append(featurizer.batch_features(feature_list))
         return batched
 
+    def _feature_bank_indices(self, obs):
+        ''' The FeatureBankIndices of a BatchedObservations made with a
+            feature bank, for the decoder to look up cached projections of in
+            eval mode (None otherwise) '''
+        if self.decoder.training or not isinstance(obs, BatchedObservations) or obs.feature_bank is None:
+            return None
+        return FeatureBankIndices(
+            obs.feature_bank, _buffer_variable(obs.feature_rows), _buffer_variable(obs.view_indices),
+            _buffer_variable(obs.action_view_indices), _buffer_variable(obs.action_angles))
+
     def _action_variable(self, obs):
+        if isinstance(obs, BatchedObservations):
+            if obs.feature_bank is not None:
+                action_embeddings = obs.feature_bank.get_action_embeddings(
+                    _buffer_variable(obs.feature_rows),
+                    _buffer_variable(obs.action_view_indices),
+                    _buffer_variable(obs.action_angles))
+            else:
+                action_embeddings = _buffer_variable(obs.action_embeddings)
+            return (
+                action_embeddings,
+                _buffer_variable(obs.is_valid),
+                obs.is_valid)
+        if self.env.feature_bank is not None:
+            return self._action_variable(self.env.batch_observations(obs))
+
         # get the maximum number of actions of all sample in this batch
         max_num_a = -1
         for i, ob in enumerate(obs):
@@ -309,18 +503,19 @@ class Seq2SeqAgent(BaseAgent):
             (len(obs), max_num_a, action_embedding_dim),
             dtype=np.float32)
         for i, ob in enumerate(obs):
-            adj_loc_list = ob['adj_loc_list']
-            num_a = len(adj_loc_list)
+            num_a = len(ob['adj_loc_list'])
             is_valid[i, 0:num_a] = 1.
-            for n_a, adj_dict in enumerate(adj_loc_list):
-                action_embeddings[i, :num_a, :] = ob['action_embedding']
+            action_embeddings[i, :num_a, :] = ob['action_embedding']
         return (
-            Variable(torch.from_numpy(action_embeddings), requires_grad=False).cuda(),
-            Variable(torch.from_numpy(is_valid), requires_grad=False).cuda(),
+            try_cuda(Variable(torch.from_numpy(action_embeddings), requires_grad=False)),
+            try_cuda(Variable(torch.from_numpy(is_valid), requires_grad=False)),
             is_valid)
 
     def _teacher_action(self, obs, ended):
         ''' Extract teacher actions into variable. '''
+        if isinstance(obs, BatchedObservations):
+            a = torch.from_numpy(np.where(ended, -1, obs.teacher))
+            return try_cuda(Variable(a, requires_grad=False))
         a = torch.LongTensor(len(obs))
         for i,ob in enumerate(obs):
             # Supervised teacher only moves one axis at a time
@@ -381,6 +576,8 @@ class Seq2SeqAgent(BaseAgent):
                     next_obs.append(obs[perm_index])
 
             obs = next_obs
+            if self.env.feature_bank is not None:
+                obs = self.env.batch_observations(obs)
 
             target = try_cuda(Variable(torch.LongTensor(next_target_list), requires_grad=False))
 
@@ -389,7 +586,8 @@ class Seq2SeqAgent(BaseAgent):
 
             assert len(f_t_list) == 1, 'for now, only work with MeanPooled feature'
             h_t, c_t, alpha, logit, alpha_v = self.decoder(
-                u_t_prev, all_u_t, f_t_list[0], h_t, c_t, ctx, seq_mask)
+                u_t_prev, all_u_t, f_t_list[0], h_t, c_t, ctx, seq_mask,
+                feature_bank_indices=self._feature_bank_indices(obs))
 
             # Mask outputs of invalid actions
             logit[is_valid == 0] = -float('inf')
@@ -427,11 +625,26 @@ class Seq2SeqAgent(BaseAgent):
 
         return traj, loss
 
+    def _rollout_slices(self, batch_size):
+        ''' (start, end) of the slices of the batch that are stepped in turn:
+            two if pipelined, so that the environment steps one on a background
+            thread while the decoder runs on the other, and the whole batch
+            otherwise '''
+        if self.pipelined and batch_size > 1:
+            half = (batch_size + 1) // 2
+            return [(0, half), (half, batch_size)]
+        return [(0, batch_size)]
+
     def _rollout_with_loss(self):
+        if isinstance(self.env, TensorizedR2RBatch):
+            return self._tensorized_rollout_with_loss()
         initial_world_states = self.env.reset(sort=True)
-        initial_obs = self.env.observe(initial_world_states)
-        initial_obs = np.array(initial_obs)
-        batch_size = len(initial_obs)
+        batch_size = len(initial_world_states)
+        slices = self._rollout_slices(batch_size)
+        # each slice's observations are in its own buffers, which its next step overwrites
+        slice_obs = [self.env.observe_batched(initial_world_states[start:end], rows=range(start, end), buffer_set=k)
+                     for k, (start, end) in enumerate(slices)]
+        initial_obs = flatten(slice_obs)
 
         # get mask and lengths
         seq, seq_mask, seq_lengths = self._proc_batch(initial_obs)
@@ -455,29 +668,156 @@ class Seq2SeqAgent(BaseAgent):
             'instr_encoding': ob['instr_encoding']
         } for ob in initial_obs]
 
-        obs = initial_obs
-        world_states = initial_world_states
+        slice_world_states = [initial_world_states[start:end] for start, end in slices]
+        slice_h_t = [h_t[start:end] for start, end in slices]
+        slice_c_t = [c_t[start:end] for start, end in slices]
 
         # Initial action
-        u_t_prev = self.decoder.u_begin.expand(batch_size, -1)  # init action
+        slice_u_t_prev = [self.decoder.u_begin.expand(end - start, -1) for start, end in slices]  # init action
         ended = np.array([False] * batch_size) # Indices match permuation of the model, not env
+        # ended after the actions taken so far, which may not have been stepped yet
+        stopped = np.array([False] * batch_size)
+        # actions and scores of the step of each slice that is being taken
+        pending = [None] * len(slices)
+
+        def step(k, world_states, env_action, obs):
+            start, end = slices[k]
+            world_states = self.env.step(world_states, env_action, obs)
+            return world_states, self.env.observe_batched(world_states, rows=range(start, end), buffer_set=k)
+
+        def finish_step(k):
+            start, end = slices[k]
+            a_t, action_scores = pending[k]
+            pending[k] = None
+            slice_world_states[k], slice_obs[k] = worker.result()
+
+            # Save trajectory output
+            for i,ob in enumerate(slice_obs[k], start):
+                if not ended[i]:
+                    traj[i]['trajectory'].append(path_element_from_observation(ob))
+                    traj[i]['score'] = sequence_scores[i]
+                    traj[i]['scores'].append(action_scores[i - start])
+                    traj[i]['actions'].append(a_t.data[i - start])
+                    traj[i]['observations'].append(ob)
+
+            # Update ended list
+            ended[start:end] = stopped[start:end]
 
         # Do a sequence rollout and calculate the loss
-        env_action = [None] * batch_size
         sequence_scores = try_cuda(torch.zeros(batch_size))
+        with OrderedWorker(len(slices), background=len(slices) > 1) as worker:
+            for t in range(self.episode_len):
+                # with several slices, the loss of a step is summed over them and
+                # divided by the number of targets, which is what self.criterion
+                # computes over the whole batch
+                step_loss = 0
+                n_targets = 0
+                for k, (start, end) in enumerate(slices):
+                    if pending[k] is not None:
+                        finish_step(k)
+                    obs = slice_obs[k]
+                    f_t_list = self._feature_variables(obs) # Image features from obs
+                    all_u_t, is_valid, _ = self._action_variable(obs)
+
+                    assert len(f_t_list) == 1, 'for now, only work with MeanPooled feature'
+                    slice_h_t[k], slice_c_t[k], alpha, logit, alpha_v = self.decoder(
+                        slice_u_t_prev[k], all_u_t, f_t_list[0], slice_h_t[k], slice_c_t[k],
+                        ctx[start:end], seq_mask[start:end], feature_bank_indices=self._feature_bank_indices(obs))
+
+                    # Mask outputs of invalid actions
+                    logit[is_valid == 0] = -float('inf')
+
+                    # Supervised training
+                    target = self._teacher_action(obs, ended[start:end])
+                    if len(slices) == 1:
+                        self.loss += self.criterion(logit, target)
+                    else:
+                        step_loss += F.cross_entropy(logit, target, ignore_index=-1, reduction='sum')
+                        n_targets += int((target >= 0).sum())
+
+                    # Determine next model inputs
+                    if feedback == 'teacher':
+                        # turn -1 (ignore) to 0 (stop) so that the action is executable
+                        a_t = torch.clamp(target, min=0)
+                    elif feedback == 'argmax':
+                        _,a_t = logit.max(1)        # student forcing - argmax
+                        a_t = a_t.detach()
+                    elif feedback == 'sample':
+                        probs = F.softmax(logit, dim=1)    # sampling an action from model
+                        # Further mask probs where agent can't move forward
+                        # Note input to `D.Categorical` does not have to sum up to 1
+                        # http://pytorch.org/docs/stable/torch.html#torch.multinomial
+                        probs[is_valid == 0] = 0.
+                        m = D.Categorical(probs)
+                        a_t = m.sample()
+                    else:
+                        sys.exit('Invalid feedback option')
+
+                    # update the previous action
+                    slice_u_t_prev[k] = all_u_t[np.arange(end - start), a_t, :].detach()
+
+                    action_scores = -F.cross_entropy(logit, a_t, ignore_index=-1, reduce=False).data
+                    sequence_scores[start:end] += action_scores
+
+                    # dfried: I changed this so that the ended list is updated afterward; this causes <end> to be added as the last action, along with its score, and the final world state will be duplicated (to more closely match beam search)
+                    # Make environment action, stepping the slice while the decoder runs on the next one
+                    env_action = [a_t[i].item() for i in range(end - start)]
+                    stopped[start:end] |= np.array(env_action) == 0
+                    pending[k] = (a_t, action_scores)
+                    worker.submit(step, k, slice_world_states[k], env_action, obs)
+
+                if len(slices) > 1:
+                    self.loss += step_loss / n_targets
+
+                # Early exit if all ended
+                if stopped.all():
+                    break
+
+            for k in range(len(slices)):
+                finish_step(k)
+
+        #self.losses.append(self.loss.data[0] / self.episode_len)
+        # shouldn't divide by the episode length because of masking
+        self.losses.append(self.loss.item())
+        return traj
+
+    def _tensorized_rollout_with_loss(self):
+        ''' _rollout_with_loss on a TensorizedR2RBatch. The batch is stepped
+            and observed as tensors, and the trajectories (which have no
+            observations) are only read back once the episode is over '''
+        nodes, view_indices = self.env.reset_tensors(sort=True)
+        batch = self.env.batch
+        batch_size = len(batch)
+
+        seq, seq_mask, seq_lengths = batch_instructions_from_encoded(
+            [item['instr_encoding'] for item in batch], self.max_instruction_length,
+            reverse=self.reverse_instruction)
+
+        self.loss = 0
+        feedback = self.feedback
+        ctx,h_t,c_t = self.encoder(seq, seq_lengths)
+
+        u_t_prev = self.decoder.u_begin.expand(batch_size, -1)  # init action
+        ended = nodes != nodes  # all False
+        sequence_scores = try_cuda(torch.zeros(batch_size))
+        path_nodes = [nodes]
+        path_view_indices = [view_indices]
+        path_actions = []
+        path_scores = []
+        path_ended = []
         for t in range(self.episode_len):
-            f_t_list = self._feature_variables(obs) # Image features from obs
-            all_u_t, is_valid, _ = self._action_variable(obs)
+            obs = self.env.observe_tensors(nodes, view_indices, self.env.goal_nodes)
+            all_u_t, is_valid = obs.action_embeddings, obs.is_valid
 
-            assert len(f_t_list) == 1, 'for now, only work with MeanPooled feature'
             h_t, c_t, alpha, logit, alpha_v = self.decoder(
-                u_t_prev, all_u_t, f_t_list[0], h_t, c_t, ctx, seq_mask)
+                u_t_prev, all_u_t, obs.features, h_t, c_t, ctx, seq_mask,
+                feature_bank_indices=obs.feature_bank_indices)
 
             # Mask outputs of invalid actions
             logit[is_valid == 0] = -float('inf')
 
             # Supervised training
-            target = self._teacher_action(obs, ended)
+            target = obs.teacher.masked_fill(ended, -1)
             self.loss += self.criterion(logit, target)
 
             # Determine next model inputs
@@ -489,9 +829,6 @@ class Seq2SeqAgent(BaseAgent):
                 a_t = a_t.detach()
             elif feedback == 'sample':
                 probs = F.softmax(logit, dim=1)    # sampling an action from model
-                # Further mask probs where agent can't move forward
-                # Note input to `D.Categorical` does not have to sum up to 1
-                # http://pytorch.org/docs/stable/torch.html#torch.multinomial
                 probs[is_valid == 0] = 0.
                 m = D.Categorical(probs)
                 a_t = m.sample()
@@ -499,50 +836,148 @@ class Seq2SeqAgent(BaseAgent):
                 sys.exit('Invalid feedback option')
 
             # update the previous action
-            u_t_prev = all_u_t[np.arange(batch_size), a_t, :].detach()
+            u_t_prev = all_u_t[try_cuda(torch.arange(batch_size)), a_t, :].detach()
 
             action_scores = -F.cross_entropy(logit, a_t, ignore_index=-1, reduce=False).data
             sequence_scores += action_scores
 
-            # dfried: I changed this so that the ended list is updated afterward; this causes <end> to be added as the last action, along with its score, and the final world state will be duplicated (to more closely match beam search)
-            # Make environment action
-            for i in range(batch_size):
-                action_idx = a_t[i].item()
-                env_action[i] = action_idx
+            nodes, view_indices = self.env.step_tensors(nodes, view_indices, a_t)
+            path_nodes.append(nodes)
+            path_view_indices.append(view_indices)
+            path_actions.append(a_t.data)
+            path_scores.append(action_scores)
+            path_ended.append(ended)
 
-            world_states = self.env.step(world_states, env_action, obs)
-            obs = self.env.observe(world_states)
-            # print("t: %s\tstate: %s\taction: %s\tscore: %s" % (t, world_states[0], a_t.data[0], sequence_scores[0]))
-
-            # Save trajectory output
-            for i,ob in enumerate(obs):
-                if not ended[i]:
-                    traj[i]['trajectory'].append(path_element_from_observation(ob))
-                    traj[i]['score'] = sequence_scores[i]
-                    traj[i]['scores'].append(action_scores[i])
-                    traj[i]['actions'].append(a_t.data[i])
-                    traj[i]['observations'].append(ob)
-
-            # Update ended list
-            for i in range(batch_size):
-                action_idx = a_t[i].item()
-                if action_idx == 0:
-                    ended[i] = True
-
-            # Early exit if all ended
+            ended = ended | (a_t == 0)
             if ended.all():
                 break
 
-        #self.losses.append(self.loss.data[0] / self.episode_len)
-        # shouldn't divide by the episode length because of masking
+        path_elements = list(zip(*[
+            self.env.path_elements(step_nodes.tolist(), step_view_indices.tolist())
+            for step_nodes, step_view_indices in zip(path_nodes, path_view_indices)]))
+        path_ended = torch.stack(path_ended).t().tolist()
+        traj = []
+        for i, item in enumerate(batch):
+            steps = [t for t, step_ended in enumerate(path_ended[i]) if not step_ended]
+            traj.append({
+                'instr_id': item['instr_id'],
+                'trajectory': [path_elements[i][0]] + [path_elements[i][t + 1] for t in steps],
+                'actions': [path_actions[t][i] for t in steps],
+                'scores': [path_scores[t][i] for t in steps],
+                'score': sequence_scores[i],
+                'instr_encoding': item['instr_encoding']
+            })
         self.losses.append(self.loss.item())
         return traj
 
+    def _tensorized_beam_search(self, beam_size, load_next_minibatch=True):
+        ''' beam_search on a TensorizedR2RBatch. The beams of all instances are
+            flattened into one batch, their successors are selected by a top-k
+            over (beam element, action) per instance, and paths are kept as
+            backpointers which are only followed once the search is over. The
+            trajectories have no observations, and the completed inference
+            states and traversed lists aren't returned '''
+        nodes, view_indices = self.env.reset_tensors(sort=True, load_next_minibatch=load_next_minibatch)
+        batch = self.env.batch
+        batch_size = len(batch)
+        start_path_elements = self.env.path_elements(nodes.tolist(), view_indices.tolist())
+
+        seq, seq_mask, seq_lengths = batch_instructions_from_encoded(
+            [item['instr_encoding'] for item in batch], self.max_instruction_length,
+            reverse=self.reverse_instruction)
+        ctx,h_t,c_t = self.encoder(seq, seq_lengths)
+
+        # the beam elements, as the instance of each, and the successor of the
+        # previous step that each one is (-1 at the start)
+        instances = try_cuda(torch.arange(batch_size))
+        predecessors = torch.full_like(instances, -1)
+        scores = try_cuda(torch.zeros(batch_size))
+        u_t_prev = self.decoder.u_begin.expand(batch_size, -1)
+        completed_counts = torch.zeros_like(instances)
+        # the successors of each step
+        history = []
+        for t in range(self.episode_len):
+            obs = self.env.observe_tensors(nodes, view_indices)
+            h_t, c_t, alpha, logit, alpha_v = self.decoder(
+                u_t_prev, obs.action_embeddings, obs.features, h_t, c_t, ctx[instances], seq_mask[instances],
+                feature_bank_indices=obs.feature_bank_indices)
+
+            # Mask outputs of invalid actions
+            logit[obs.is_valid == 0] = -float('inf')
+            log_probs = F.log_softmax(logit, dim=1).data.masked_fill(obs.is_valid == 0, -float('inf'))
+
+            successor_instances, parents, actions, scores = _beam_successors(
+                instances, scores, log_probs, batch_size, beam_size)
+            nodes, view_indices = self.env.step_tensors(nodes[parents], view_indices[parents], actions)
+
+            if t == self.episode_len - 1:
+                is_completed = actions >= 0
+            else:
+                is_completed = actions == 0
+            history.append((successor_instances, predecessors[parents], actions, scores,
+                            nodes, view_indices, alpha.data[parents], is_completed))
+            completed_counts = completed_counts + torch.bincount(
+                successor_instances[is_completed], minlength=batch_size)
+            live = ((is_completed == 0) & (completed_counts[successor_instances] < beam_size)).nonzero().view(-1)
+            if len(live) == 0:
+                break
+
+            instances = successor_instances[live]
+            predecessors = live
+            nodes, view_indices = nodes[live], view_indices[live]
+            scores = scores[live]
+            u_t_prev = obs.action_embeddings[parents[live], actions[live]].detach()
+            h_t, c_t = h_t[parents[live]], c_t[parents[live]]
+
+        # read the search back, and follow the backpointers of the best completed paths
+        steps = []
+        completed = [[] for _ in range(batch_size)]
+        for t, (successor_instances, predecessors, actions, scores, step_nodes, step_view_indices, alphas, is_completed) in enumerate(history):
+            scores = scores.tolist()
+            for successor, (instance, is_completed) in enumerate(zip(successor_instances.tolist(), is_completed.tolist())):
+                if is_completed:
+                    completed[instance].append((scores[successor], t, successor))
+            steps.append((predecessors.tolist(), actions.tolist(), scores,
+                          self.env.path_elements(step_nodes.tolist(), step_view_indices.tolist()), alphas))
+
+        trajs = []
+        for item, start_path_element, this_completed in zip(batch, start_path_elements, completed):
+            assert this_completed
+            this_trajs = []
+            for score, t, successor in sorted(this_completed, key=lambda c: c[0], reverse=True)[:beam_size]:
+                trajectory, actions, path_scores, attentions = [], [], [], []
+                while successor >= 0:
+                    predecessors, step_actions, step_scores, step_path_elements, alphas = steps[t]
+                    trajectory.append(step_path_elements[successor])
+                    actions.append(step_actions[successor])
+                    path_scores.append(step_scores[successor])
+                    attentions.append(alphas[successor])
+                    successor = predecessors[successor]
+                    t -= 1
+                trajectory.append(start_path_element)
+                path_scores.append(0.0)
+                trajectory, actions, path_scores, attentions = [
+                    list(reversed(l)) for l in (trajectory, actions, path_scores, attentions)]
+                this_trajs.append({
+                    'instr_id': item['instr_id'],
+                    'instr_encoding': item['instr_encoding'],
+                    'trajectory': trajectory,
+                    'actions': actions,
+                    'score': score,
+                    'scores': [b - a for a, b in zip(path_scores, path_scores[1:])],
+                    'attentions': attentions
+                })
+            trajs.append(this_trajs)
+        return trajs, None, None
+
     def beam_search(self, beam_size, load_next_minibatch=True, mask_undo=False):
+        if isinstance(self.env, TensorizedR2RBatch):
+            return self._tensorized_beam_search(beam_size, load_next_minibatch=load_next_minibatch)
         assert self.env.beam_size >= beam_size
         world_states = self.env.reset(sort=True, beamed=True, load_next_minibatch=load_next_minibatch)
         obs = self.env.observe(world_states, beamed=True)
         batch_size = len(world_states)
+        slices = self._rollout_slices(batch_size)
 
         # get mask and lengths
         seq, seq_mask, seq_lengths = self._proc_batch(obs, beamed=True)
@@ -554,142 +989,156 @@ class Seq2SeqAgent(BaseAgent):
         for _ in range(batch_size):
             completed.append([])
 
-        beams = [
-            [InferenceState(prev_inference_state=None,
-                            world_state=ws[0],
-                            observation=o[0],
-                            flat_index=i,
-                            last_action=-1,
-                            last_action_embedding=self.decoder.u_begin.view(-1),
-                            action_count=0,
-                            score=0.0, h_t=None, c_t=None, last_alpha=None)]
-            for i, (ws, o) in enumerate(zip(world_states, obs))
+        start_states = [
+            InferenceState(prev_inference_state=None,
+                           world_state=ws[0],
+                           observation=o[0],
+                           flat_index=i - start,
+                           last_action=-1,
+                           last_action_embedding=self.decoder.u_begin.view(-1),
+                           action_count=0,
+                           score=0.0, h_t=None, c_t=None, last_alpha=None)
+            for start, end in slices
+            for i, (ws, o) in enumerate(zip(world_states[start:end], obs[start:end]), start)
         ]
 
-        # Do a sequence rollout and calculate the loss
-        for t in range(self.episode_len):
-            flat_indices = []
-            beam_indices = []
-            u_t_list = []
-            for beam_index, beam in enumerate(beams):
-                for inf_state in beam:
-                    beam_indices.append(beam_index)
-                    flat_indices.append(inf_state.flat_index)
-                    u_t_list.append(inf_state.last_action_embedding)
-
-            u_t_prev = torch.stack(u_t_list, dim=0)
-            assert len(u_t_prev.shape) == 2
-            flat_obs = flatten(obs)
-            f_t_list = self._feature_variables(flat_obs) # Image features from obs
-            all_u_t, is_valid, is_valid_numpy = self._action_variable(flat_obs)
-
-            assert len(f_t_list) == 1, 'for now, only work with MeanPooled feature'
-            h_t, c_t, alpha, logit, alpha_v = self.decoder(
-                u_t_prev, all_u_t, f_t_list[0], h_t[flat_indices], c_t[flat_indices], ctx[beam_indices], seq_mask[beam_indices])
-
-            # Mask outputs of invalid actions
-            logit[is_valid == 0] = -float('inf')
-            # # Mask outputs where agent can't move forward
-            # no_forward_mask = [len(ob['navigableLocations']) <= 1 for ob in flat_obs]
-
-            if mask_undo:
-                masked_logit = logit.clone()
-            else:
-                masked_logit = logit
-
-            log_probs = F.log_softmax(logit, dim=1).data
-
-            # force ending if we've reached the max time steps
-            # if t == self.episode_len - 1:
-            #     action_scores = log_probs[:,self.end_index].unsqueeze(-1)
-            #     action_indices = torch.from_numpy(np.full((log_probs.size()[0], 1), self.end_index))
-            # else:
-            #action_scores, action_indices = log_probs.topk(min(beam_size, logit.size()[1]), dim=1)
-            _, action_indices = masked_logit.data.topk(min(beam_size, logit.size()[1]), dim=1)
-            action_scores = log_probs.gather(1, action_indices)
-            assert action_scores.size() == action_indices.size()
-
-            start_index = 0
-            new_beams = []
-            assert len(beams) == len(world_states)
-            all_successors = []
-            for beam_index, (beam, beam_world_states, beam_obs) in enumerate(zip(beams, world_states, obs)):
-                successors = []
-                end_index = start_index + len(beam)
-                assert len(beam_world_states) == len(beam)
-                assert len(beam_obs) == len(beam)
-                if beam:
-                    for inf_index, (inf_state, world_state, ob, action_score_row, action_index_row) in \
-                            enumerate(zip(beam, beam_world_states, beam_obs, action_scores[start_index:end_index], action_indices[start_index:end_index])):
-                        flat_index = start_index + inf_index
-                        for action_score, action_index in zip(action_score_row, action_index_row):
-                            if is_valid_numpy[flat_index, action_index] == 0:
-                                continue
-                            successors.append(
-                                InferenceState(prev_inference_state=inf_state,
-                                               world_state=world_state, # will be updated later after successors are pruned
-                                               observation=ob, # will be updated later after successors are pruned
-                                               flat_index=flat_index,
-                                               last_action=action_index,
-                                               last_action_embedding=all_u_t[flat_index, action_index].detach(),
-                                               action_count=inf_state.action_count + 1,
-                                               score=float(inf_state.score + action_score), h_t=None, c_t=None,
-                                               last_alpha=alpha[flat_index].data)
-                            )
-                start_index = end_index
-                successors = sorted(successors, key=lambda t: t.score, reverse=True)[:beam_size]
-                all_successors.append(successors)
-
-            successor_world_states = [
-                [inf_state.world_state for inf_state in successors]
-                for successors in all_successors
-            ]
-
-            successor_env_actions = [
-                [inf_state.last_action for inf_state in successors]
-                for successors in all_successors
-            ]
-
-            successor_last_obs = [
-                [inf_state.observation for inf_state in successors]
-                for successors in all_successors
-            ]
-
+        # the live beam elements of each slice, grouped by instance (row of the
+        # slice), as the instance of each, the successor of the previous step
+        # it is (-1 at the start), its score, world state and observation, and
+        # its decoder state
+        slice_instances = [try_cuda(torch.arange(end - start)) for start, end in slices]
+        slice_predecessors = [torch.full_like(instances, -1) for instances in slice_instances]
+        slice_scores = [try_cuda(torch.zeros(end - start)) for start, end in slices]
+        slice_world_states = [flatten(world_states[start:end]) for start, end in slices]
+        slice_obs = [flatten(obs[start:end]) for start, end in slices]
+        slice_u_t_prev = [self.decoder.u_begin.expand(end - start, -1) for start, end in slices]
+        slice_h_t = [h_t[start:end] for start, end in slices]
+        slice_c_t = [c_t[start:end] for start, end in slices]
+        completed_counts = [torch.zeros_like(instances) for instances in slice_instances]
+        # the successors of every step of each slice, as backpointers into the previous step
+        slice_history = [[] for _ in slices]
+        # the successors and decoder state of the step of each slice that is being taken
+        pending = [None] * len(slices)
+
+        def step(k, successor_world_states, successor_env_actions, successor_last_obs):
+            start, end = slices[k]
             successor_world_states = self.env.step(successor_world_states, successor_env_actions, successor_last_obs, beamed=True)
-            successor_obs = self.env.observe(successor_world_states, beamed=True)
-
-            all_successors = structured_map(lambda inf_state, world_state, obs: inf_state._replace(world_state=world_state, observation=obs),
-                                   all_successors, successor_world_states, successor_obs, nested=True)
-
-            # if all_successors[0]:
-            #     print("t: %s\tstate: %s\taction: %s\tscore: %s" % (t, all_successors[0][0].world_state, all_successors[0][0].last_action, all_successors[0][0].score))
-
-            for beam_index, successors in enumerate(all_successors):
-                new_beam = []
-                for successor in successors:
-                    if successor.last_action == 0 or t == self.episode_len - 1:
-                        completed[beam_index].append(successor)
-                    else:
-                        new_beam.append(successor)
-                if len(completed[beam_index]) >= beam_size:
-                    new_beam = []
-                new_beams.append(new_beam)
-
-            beams = new_beams
-
-            world_states = [
-                [inf_state.world_state for inf_state in beam]
-                for beam in beams
-            ]
-
-            obs = [
-                [inf_state.observation for inf_state in beam]
-                for beam in beams
-            ]
+            return successor_world_states, self.env.observe(successor_world_states, beamed=True, rows=range(start, end))
+
+        def finish_step(k):
+            start, end = slices[k]
+            t, successors, h_t, c_t = pending[k]
+            pending[k] = None
+            successor_world_states, successor_obs = worker.result()
+            successors = successors._replace(world_states=flatten(successor_world_states),
+                                             observations=flatten(successor_obs))
+            slice_history[k].append(successors)
+
+            if t == self.episode_len - 1:
+                is_completed = successors.actions >= 0
+            else:
+                is_completed = successors.actions == 0
+            completed_counts[k] = completed_counts[k] + torch.bincount(
+                successors.instances[is_completed], minlength=end - start)
+            live = ((is_completed == 0) & (completed_counts[k][successors.instances] < beam_size)).nonzero().view(-1)
+            live_list = live.tolist()
+
+            parents = successors.parents[live]
+            slice_instances[k] = successors.instances[live]
+            slice_predecessors[k] = live
+            slice_scores[k] = successors.scores[live]
+            slice_world_states[k] = [successors.world_states[j] for j in live_list]
+            slice_obs[k] = [successors.observations[j] for j in live_list]
+            slice_u_t_prev[k] = successors.action_embeddings[parents, successors.actions[live]].detach()
+            slice_h_t[k], slice_c_t[k] = h_t[parents], c_t[parents]
 
-            # Early exit if all ended
-            if not any(beam for beam in beams):
-                break
+        # Do a sequence rollout and calculate the loss
+        with OrderedWorker(len(slices), background=len(slices) > 1) as worker:
+            for t in range(self.episode_len):
+                for k, (start, end) in enumerate(slices):
+                    if pending[k] is not None:
+                        finish_step(k)
+                    instances = slice_instances[k]
+                    if len(instances) == 0:
+                        continue
+
+                    flat_obs = self.env.batch_observations(slice_obs[k], buffer_set=k)
+                    f_t_list = self._feature_variables(flat_obs) # Image features from obs
+                    all_u_t, is_valid, _ = self._action_variable(flat_obs)
+
+                    assert len(f_t_list) == 1, 'for now, only work with MeanPooled feature'
+                    h_t, c_t, alpha, logit, alpha_v = self.decoder(
+                        slice_u_t_prev[k], all_u_t, f_t_list[0], slice_h_t[k], slice_c_t[k],
+                        ctx[start:end][instances], seq_mask[start:end][instances],
+                        feature_bank_indices=self._feature_bank_indices(flat_obs))
+
+                    # Mask outputs of invalid actions
+                    logit[is_valid == 0] = -float('inf')
+                    # # Mask outputs where agent can't move forward
+                    # no_forward_mask = [len(ob['navigableLocations']) <= 1 for ob in flat_obs]
+
+                    log_probs = F.log_softmax(logit, dim=1).data
+                    successor_instances, parents, actions, scores = _beam_successors(
+                        instances, slice_scores[k], log_probs, end - start, beam_size)
+
+                    # each successor starts where its parent is, and is stepped with its action
+                    parent_list = parents.tolist()
+                    action_list = actions.tolist()
+                    instance_counts = torch.bincount(successor_instances, minlength=end - start).tolist()
+                    successor_world_states = _split_rows([slice_world_states[k][p] for p in parent_list], instance_counts)
+                    successor_env_actions = _split_rows(action_list, instance_counts)
+                    successor_last_obs = _split_rows([slice_obs[k][p] for p in parent_list], instance_counts)
+
+                    # step the slice while the decoder runs on the next one
+                    successors = BeamSearchStep(
+                        successor_instances, slice_predecessors[k][parents], parents, actions, scores,
+                        None, None, all_u_t, alpha.data)
+                    pending[k] = (t, successors, h_t, c_t)
+                    worker.submit(step, k, successor_world_states, successor_env_actions, successor_last_obs)
+
+                # Early exit if all ended
+                if not any(pending):
+                    break
+
+            for k in range(len(slices)):
+                if pending[k] is not None:
+                    finish_step(k)
+
+        # make inference states for the paths to the completed successors, by following their backpointers
+        for k, (start, end) in enumerate(slices):
+            history = slice_history[k]
+            made = {}
+            # read each step off the device once, rather than an element per state
+            history_lists = [
+                (successors.instances.tolist(), successors.predecessors.tolist(), successors.parents.tolist(),
+                 successors.actions.tolist(), successors.scores.tolist())
+                for successors in history]
+
+            def inference_state(t, j):
+                if (t, j) not in made:
+                    successors = history[t]
+                    instances, predecessors, parents, actions, scores = history_lists[t]
+                    predecessor = predecessors[j]
+                    parent = parents[j]
+                    action = actions[j]
+                    made[(t, j)] = InferenceState(
+                        prev_inference_state=inference_state(t - 1, predecessor) if predecessor >= 0 else
+                            start_states[start + instances[j]],
+                        world_state=successors.world_states[j],
+                        observation=successors.observations[j],
+                        flat_index=parent,
+                        last_action=action,
+                        last_action_embedding=successors.action_embeddings[parent, action].detach(),
+                        action_count=t + 1,
+                        score=scores[j], h_t=None, c_t=None,
+                        last_alpha=successors.alphas[parent])
+                return made[(t, j)]
+
+            for t, (instances, _, _, actions, _) in enumerate(history_lists):
+                for j, (instance, action) in enumerate(zip(instances, actions)):
+                    # every successor still going at episode_len completes there
+                    if action == 0 or (t == self.episode_len - 1 and action >= 0):
+                        completed[start + instance].append(inference_state(t, j))
 
         trajs = []
 
@@ -717,7 +1166,22 @@ class Seq2SeqAgent(BaseAgent):
         traversed_lists = None # todo
         return trajs, completed, traversed_lists
 
-    def state_factored_search(self, completion_size, successor_size, load_next_minibatch=True, mask_undo=False, first_n_ws_key=4):
+    def state_factored_search(self, completion_size, successor_size, load_next_minibatch=True, mask_undo=False, first_n_ws_key=4,
+                              expansion_budget=None):
+        ''' Search for completion_size paths of each instance, expanding the
+            successor_size best unexpanded states of each instance (factored
+            by their first first_n_ws_key world state fields) at each step,
+            each of which has its successor_size best actions as successors.
+            With an expansion_budget, the search expands at most that many
+            states in total, handing out what is left of it between the
+            instances that are still searching at each step. When it is
+            spent, instances without a completed path complete with the best
+            state left in their frontier, and if it hasn't stopped, their
+            trajectories have budget_exhausted set.
+
+            Since each expanded state only keeps its successor_size best
+            actions, results differ from searches that made every action a
+            successor unless successor_size covers all the actions '''
         assert self.env.beam_size >= successor_size
         world_states = self.env.reset(sort=True, beamed=True, load_next_minibatch=load_next_minibatch)
         initial_obs = self.env.observe(world_states, beamed=True)
@@ -730,53 +1194,39 @@ class Seq2SeqAgent(BaseAgent):
         ctx,h_t,c_t = self.encoder(seq, seq_lengths)
 
         completed = []
-        completed_holding = []
         for _ in range(batch_size):
             completed.append({})
-            completed_holding.append({})
-
-        state_cache = [
-            {ws[0][0:first_n_ws_key]: (InferenceState(prev_inference_state=None,
-                                                      world_state=ws[0],
-                                                      observation=o[0],
-                                                      flat_index=None,
-                                                      last_action=-1,
-                                                      last_action_embedding=self.decoder.u_begin.view(-1),
-                                                      action_count=0,
-                                                      score=0.0, h_t=h_t[i], c_t=c_t[i], last_alpha=None), True)}
-            for i, (ws, o) in enumerate(zip(world_states, initial_obs))
-        ]
-
-        beams = [[inf_state for world_state, (inf_state, expanded) in sorted(instance_cache.items())]
-                 for instance_cache in state_cache] # sorting is a noop here since each instance_cache should only contain one
 
-
-        # traversed_lists = None
-        # list of inference states containing states in order of the states being expanded
-        last_expanded_list = []
+        # the states of each instance by key, uncompleted keys being (False, ws_keys) and completed (True, ws_keys)
+        frontiers = [StateFrontier() for _ in range(batch_size)]
+        beams = []
+        for i, (ws, o) in enumerate(zip(world_states, initial_obs)):
+            first_state = InferenceState(prev_inference_state=None,
+                                         world_state=ws[0],
+                                         observation=o[0],
+                                         flat_index=None,
+                                         last_action=-1,
+                                         last_action_embedding=self.decoder.u_begin.view(-1),
+                                         action_count=0,
+                                         score=0.0, h_t=h_t[i], c_t=c_t[i], last_alpha=None)
+            frontiers[i].add((False, ws[0][0:first_n_ws_key]), first_state)
+            beams.append([state for key, state in frontiers[i].expand(1)])
+
+        # the states passed through moving from each state expanded to the next, for each instance
+        ancestor_index = AncestorIndex()
         traversed_lists = []
         for beam in beams:
             assert len(beam) == 1
-            first_state = beam[0]
-            last_expanded_list.append(first_state)
-            traversed_lists.append([first_state])
+            traversed_lists.append(TraversedPath(beam[0], ancestor_index))
 
         def update_traversed_lists(new_visited_inf_states):
-            assert len(new_visited_inf_states) == len(last_expanded_list)
             assert len(new_visited_inf_states) == len(traversed_lists)
-
-            for instance_index, instance_states in enumerate(new_visited_inf_states):
-                last_expanded = last_expanded_list[instance_index]
-                # todo: if this passes, shouldn't need traversed_lists
-                assert last_expanded.world_state.viewpointId == traversed_lists[instance_index][-1].world_state.viewpointId
+            for traversed, instance_states in zip(traversed_lists, new_visited_inf_states):
                 for inf_state in instance_states:
-                    path_from_last_to_next = least_common_viewpoint_path(last_expanded, inf_state)
-                    # path_from_last should include last_expanded's world state as the first element, so check and drop that
-                    assert path_from_last_to_next[0].world_state.viewpointId == last_expanded.world_state.viewpointId
-                    assert path_from_last_to_next[-1].world_state.viewpointId == inf_state.world_state.viewpointId
-                    traversed_lists[instance_index].extend(path_from_last_to_next[1:])
-                    last_expanded = inf_state
-                last_expanded_list[instance_index] = last_expanded
+                    traversed.extend_to(inf_state)
+
+        remaining_budget = expansion_budget
+        budget_exhausted = [False] * batch_size
 
         # Do a sequence rollout and calculate the loss
         while any(len(comp) < completion_size for comp in completed):
@@ -785,6 +1235,7 @@ class Seq2SeqAgent(BaseAgent):
             h_t_list = []
             c_t_list = []
             flat_obs = []
+            flat_states = []
             for beam_index, beam in enumerate(beams):
                 for inf_state in beam:
                     beam_indices.append(beam_index)
@@ -792,9 +1243,11 @@ class Seq2SeqAgent(BaseAgent):
                     h_t_list.append(inf_state.h_t.unsqueeze(0))
                     c_t_list.append(inf_state.c_t.unsqueeze(0))
                     flat_obs.append(inf_state.observation)
+                    flat_states.append(inf_state)
 
             u_t_prev = torch.stack(u_t_list, dim=0)
             assert len(u_t_prev.shape) == 2
+            flat_obs = self.env.batch_observations(flat_obs)
             f_t_list = self._feature_variables(flat_obs) # Image features from obs
             all_u_t, is_valid, is_valid_numpy = self._action_variable(flat_obs)
             h_t = torch.cat(h_t_list, dim=0)
@@ -802,126 +1255,85 @@ class Seq2SeqAgent(BaseAgent):
 
             assert len(f_t_list) == 1, 'for now, only work with MeanPooled feature'
             h_t, c_t, alpha, logit, alpha_v = self.decoder(
-                u_t_prev, all_u_t, f_t_list[0], h_t, c_t, ctx[beam_indices], seq_mask[beam_indices])
+                u_t_prev, all_u_t, f_t_list[0], h_t, c_t, ctx[beam_indices], seq_mask[beam_indices],
+                feature_bank_indices=self._feature_bank_indices(flat_obs))
 
             # Mask outputs of invalid actions
             logit[is_valid == 0] = -float('inf')
             # # Mask outputs where agent can't move forward
             # no_forward_mask = [len(ob['navigableLocations']) <= 1 for ob in flat_obs]
 
-            if mask_undo:
-                masked_logit = logit.clone()
-            else:
-                masked_logit = logit
-
             log_probs = F.log_softmax(logit, dim=1).data
 
-            # force ending if we've reached the max time steps
-            # if t == self.episode_len - 1:
-            #     action_scores = log_probs[:,self.end_index].unsqueeze(-1)
-            #     action_indices = torch.from_numpy(np.full((log_probs.size()[0], 1), self.end_index))
-            # else:
-            #_, action_indices = masked_logit.data.topk(min(successor_size, logit.size()[1]), dim=1)
-            _, action_indices = masked_logit.data.topk(logit.size()[1], dim=1) # todo: fix this
-            action_scores = log_probs.gather(1, action_indices)
-            assert action_scores.size() == action_indices.size()
-
-            start_index = 0
-            assert len(beams) == len(world_states)
-            all_successors = []
-            for beam_index, (beam, beam_world_states) in enumerate(zip(beams, world_states)):
-                successors = []
-                end_index = start_index + len(beam)
-                assert len(beam_world_states) == len(beam)
-                if beam:
-                    for inf_index, (inf_state, world_state, action_score_row) in \
-                            enumerate(zip(beam, beam_world_states, log_probs[start_index:end_index])):
-                        flat_index = start_index + inf_index
-                        for action_index, action_score in enumerate(action_score_row):
-                            if is_valid_numpy[flat_index, action_index] == 0:
-                                continue
-                            successors.append(
-                                InferenceState(prev_inference_state=inf_state,
-                                               world_state=world_state, # will be updated later after successors are pruned
-                                               observation=flat_obs[flat_index], # will be updated later after successors are pruned
-                                               flat_index=None,
-                                               last_action=action_index,
-                                               last_action_embedding=all_u_t[flat_index, action_index].detach(),
-                                               action_count=inf_state.action_count + 1,
-                                               score=inf_state.score + action_score,
-                                               h_t=h_t[flat_index], c_t=c_t[flat_index],
-                                               last_alpha=alpha[flat_index].data)
-                            )
-                start_index = end_index
-                successors = sorted(successors, key=lambda t: t.score, reverse=True)
-                all_successors.append(successors)
-
-            successor_world_states = [
-                [inf_state.world_state for inf_state in successors]
-                for successors in all_successors
-            ]
-
-            successor_env_actions = [
-                [inf_state.last_action for inf_state in successors]
-                for successors in all_successors
-            ]
-
-            successor_last_obs = [
-                [inf_state.observation for inf_state in successors]
-                for successors in all_successors
-            ]
-
-            successor_world_states = self.env.step(successor_world_states, successor_env_actions, successor_last_obs, beamed=True)
-
-            all_successors = structured_map(lambda inf_state, world_state: inf_state._replace(world_state=world_state),
-                                            all_successors, successor_world_states, nested=True)
-
-            # if all_successors[0]:
-            #     print("t: %s\tstate: %s\taction: %s\tscore: %s" % (t, all_successors[0][0].world_state, all_successors[0][0].last_action, all_successors[0][0].score))
-
-            assert len(all_successors) == len(state_cache)
+            # the successor_size best valid actions of each expanded state are
+            # its successors, but only those that improve on the best state
+            # for their key make an InferenceState. They are taken from the
+            # adj_loc_list, without stepping the env
+            flat_scores = try_cuda(torch.FloatTensor([inf_state.score for inf_state in flat_states]))
+            action_scores, action_indices = log_probs.topk(min(successor_size, log_probs.size(1)), dim=1)
+            successor_rows, successor_ranks = (action_scores > -float('inf')).nonzero().t()
+            successor_actions = action_indices[successor_rows, successor_ranks]
+            successor_scores = flat_scores[successor_rows] + action_scores[successor_rows, successor_ranks]
+            successor_rows = successor_rows.tolist()
+            successor_actions = successor_actions.tolist()
+            successor_scores = successor_scores.tolist()
+
+            for flat_index, action_index, score in zip(successor_rows, successor_actions, successor_scores):
+                loc_attr = flat_obs[flat_index]['adj_loc_list'][action_index]
+                world_state = adjacent_world_state(
+                    flat_states[flat_index].world_state, loc_attr['nextViewpointId'], loc_attr['absViewIndex'])
+                frontier = frontiers[beam_indices[flat_index]]
+                is_completed = action_index == 0 or flat_states[flat_index].action_count + 1 == self.episode_len
+                key = (is_completed, world_state[0:first_n_ws_key])
+                if frontier.improves(key, score):
+                    inf_state = flat_states[flat_index]
+                    frontier.add(key, InferenceState(prev_inference_state=inf_state,
+                                                     world_state=world_state,
+                                                     observation=flat_obs[flat_index], # will be updated later if this is expanded
+                                                     flat_index=None,
+                                                     last_action=action_index,
+                                                     last_action_embedding=all_u_t[flat_index, action_index].detach(),
+                                                     action_count=inf_state.action_count + 1,
+                                                     score=score,
+                                                     h_t=h_t[flat_index], c_t=c_t[flat_index],
+                                                     last_alpha=alpha[flat_index].data))
+
+            if expansion_budget is not None and remaining_budget <= 0:
+                for beam_index, instance_completed in enumerate(completed):
+                    if not instance_completed:
+                        best = frontiers[beam_index].expand(1)
+                        if best:
+                            (is_completed, ws_keys), inf_state = best[0]
+                        else:
+                            is_completed, inf_state = False, traversed_lists[beam_index].last
+                        instance_completed[inf_state.world_state[0:first_n_ws_key]] = inf_state
+                        budget_exhausted[beam_index] = not is_completed
+                break
 
-            new_beams = []
+            searching = [beam_index for beam_index, instance_completed in enumerate(completed)
+                         if len(instance_completed) < completion_size]
+            if expansion_budget is None:
+                expand_sizes = [successor_size] * len(searching)
+            else:
+                share, extra = divmod(remaining_budget, len(searching))
+                expand_sizes = [min(successor_size, share + (1 if i < extra else 0)) for i in range(len(searching))]
 
-            for beam_index, (successors, instance_cache) in enumerate(zip(all_successors, state_cache)):
-                # early stop if we've already built a sizable completion list
+            new_beams = [[] for _ in beams]
+            for beam_index, expand_size in zip(searching, expand_sizes):
                 instance_completed = completed[beam_index]
-                instance_completed_holding = completed_holding[beam_index]
-                if len(instance_completed) >= completion_size:
-                    new_beams.append([])
-                    continue
-                for successor in successors:
-                    ws_keys = successor.world_state[0:first_n_ws_key]
-                    if successor.last_action == 0 or successor.action_count == self.episode_len:
-                        if ws_keys not in instance_completed_holding or instance_completed_holding[ws_keys][0].score < successor.score:
-                            instance_completed_holding[ws_keys] = (successor, False)
-                    else:
-                        if ws_keys not in instance_cache or instance_cache[ws_keys][0].score < successor.score:
-                            instance_cache[ws_keys] = (successor, False)
-
-                # third value: did this come from completed_holding?
-                uncompleted_to_consider = ((ws_keys, inf_state, False) for (ws_keys, (inf_state, expanded)) in instance_cache.items() if not expanded)
-                completed_to_consider = ((ws_keys, inf_state, True) for (ws_keys, (inf_state, expanded)) in instance_completed_holding.items() if not expanded)
-                import itertools
-                import heapq
-                to_consider = itertools.chain(uncompleted_to_consider, completed_to_consider)
-                ws_keys_and_inf_states = heapq.nlargest(successor_size, to_consider, key=lambda pair: pair[1].score)
-
                 new_beam = []
-                for ws_keys, inf_state, is_completed in ws_keys_and_inf_states:
+                expanded = frontiers[beam_index].expand(expand_size)
+                if expansion_budget is not None:
+                    remaining_budget -= len(expanded)
+                for (is_completed, ws_keys), inf_state in expanded:
                     if is_completed:
-                        assert instance_completed_holding[ws_keys] == (inf_state, False)
-                        instance_completed_holding[ws_keys] = (inf_state, True)
                         if ws_keys not in instance_completed or instance_completed[ws_keys].score < inf_state.score:
                             instance_completed[ws_keys] = inf_state
                     else:
-                        instance_cache[ws_keys] = (inf_state, True)
                         new_beam.append(inf_state)
 
-                if len(instance_completed) >= completion_size:
-                    new_beams.append([])
-                else:
-                    new_beams.append(new_beam)
+                if len(instance_completed) < completion_size:
+                    new_beams[beam_index] = new_beam
 
             beams = new_beams
 
@@ -954,7 +1366,7 @@ class Seq2SeqAgent(BaseAgent):
         # TODO: sanity check the traversed lists here
 
         trajs = []
-        for this_completed in completed_list:
+        for this_completed, this_budget_exhausted in zip(completed_list, budget_exhausted):
             assert this_completed
             this_trajs = []
             for inf_state in this_completed:
@@ -972,7 +1384,8 @@ class Seq2SeqAgent(BaseAgent):
                     'actions': path_actions,
                     'score': inf_state.score,
                     'scores': path_scores,
-                    'attentions': path_attentions
+                    'attentions': path_attentions,
+                    'budget_exhausted': this_budget_exhausted,
                 })
             trajs.append(this_trajs)
         # completed_list: list of lists of final inference states corresponding to the candidates, one list per instance
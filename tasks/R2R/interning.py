@@ -0,0 +1,98 @@
+''' Dense integer ids of the scan and viewpoint ids of the dataset, shared by
+    every table in a process. Tables of per-viewpoint data (features, graphs,
+    shortest paths) are arrays whose rows are found through the interned id,
+    instead of dicts keyed by 32-character hex strings. Viewpoint ids are
+    unique across scans, so they are numbered on their own.
+
+    Ids depend on the order strings are first interned, so they are only
+    meaningful within a process: anything written to disk, sent to another
+    process or returned as a result uses the strings '''
+
+import threading
+
+import numpy as np
+
+
+class Interner(object):
+    ''' Numbers strings densely, in the order they are first interned '''
+
+    def __init__(self):
+        self._ids = {}
+        self.names = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._ids
+
+    def __getitem__(self, name):
+        return self._ids[name]
+
+    def get(self, name, default=None):
+        return self._ids.get(name, default)
+
+    def intern(self, name):
+        id = self._ids.get(name)
+        if id is None:
+            with self._lock:
+                id = self._ids.get(name)
+                if id is None:
+                    id = len(self.names)
+                    self.names.append(name)
+                    self._ids[name] = id
+        return id
+
+    def intern_all(self, names):
+        return np.array([self.intern(name) for name in names], dtype=np.int64)
+
+    def name(self, id):
+        return self.names[id]
+
+
+scans = Interner()
+viewpoints = Interner()
+
+
+class ViewpointRows(object):
+    ''' The row of each of a list of viewpoints in some table, looked up like
+        a dict from viewpointId to row. Rows are held in an array indexed by
+        interned id, so that the rows of a batch of ids are one gather '''
+
+    def __init__(self, viewpoint_ids):
+        ids = viewpoints.intern_all(viewpoint_ids)
+        self.row_of_id = np.full(ids.max() + 1 if len(ids) else 0, -1, dtype=np.int64)
+        self.row_of_id[ids] = np.arange(len(ids))
+        assert (self.row_of_id >= 0).sum() == len(ids), 'viewpoints should be unique'
+        self._row_list = self.row_of_id.tolist()
+        self._len = len(ids)
+
+    def __len__(self):
+        return self._len
+
+    def get_row_of_id(self, id, default=None):
+        if 0 <= id < len(self._row_list) and self._row_list[id] >= 0:
+            return self._row_list[id]
+        return default
+
+    def get(self, viewpointId, default=None):
+        id = viewpoints.get(viewpointId)
+        if id is None:
+            return default
+        return self.get_row_of_id(id, default)
+
+    def __getitem__(self, viewpointId):
+        row = self.get(viewpointId)
+        if row is None:
+            raise KeyError(viewpointId)
+        return row
+
+    def __contains__(self, viewpointId):
+        return self.get(viewpointId) is not None
+
+    def rows_of_ids(self, ids):
+        ''' Rows of an array of interned ids, all of which should be in the table '''
+        rows = self.row_of_id[ids]
+        assert (rows >= 0).all()
+        return rows
@@ -307,14 +307,18 @@ class VisualSoftDotAttention(nn.Module):
         self.linear_in_v = nn.Linear(v_dim, dot_dim, bias=True)
         self.sm = nn.Softmax(dim=1)
 
-    def forward(self, h, visual_context, mask=None):
+    def forward(self, h, visual_context, mask=None, projected_context=None):
         '''Propagate h through the network.
 
         h: batch x h_dim
         visual_context: batch x v_num x v_dim
+        projected_context: batch x v_num x dot_dim - linear_in_v of
+            visual_context, if it has already been computed
         '''
         target = self.linear_in_h(h).unsqueeze(2)  # batch x dot_dim x 1
-        context = self.linear_in_v(visual_context)  # batch x v_num x dot_dim
+        if projected_context is None:
+            projected_context = self.linear_in_v(visual_context)
+        context = projected_context  # batch x v_num x dot_dim
 
         # Get attention
         attn = torch.bmm(context, target).squeeze(2)  # batch x v_num
@@ -339,19 +343,96 @@ class EltwiseProdScoring(nn.Module):
         self.linear_in_a = nn.Linear(a_dim, dot_dim, bias=True)
         self.linear_out = nn.Linear(dot_dim, 1, bias=True)
 
-    def forward(self, h, all_u_t, mask=None):
+    def forward(self, h, all_u_t, mask=None, projected_actions=None):
         '''Propagate h through the network.
 
         h: batch x h_dim
         all_u_t: batch x a_num x a_dim
+        projected_actions: batch x a_num x dot_dim - linear_in_a of all_u_t,
+            if it has already been computed
         '''
         target = self.linear_in_h(h).unsqueeze(1)  # batch x 1 x dot_dim
-        context = self.linear_in_a(all_u_t)  # batch x a_num x dot_dim
+        if projected_actions is None:
+            projected_actions = self.linear_in_a(all_u_t)
+        context = projected_actions  # batch x a_num x dot_dim
         eltprod = torch.mul(target, context)  # batch x a_num x dot_dim
         logits = self.linear_out(eltprod).squeeze(2)  # batch x a_num
         return logits
 
 
+class ViewpointProjectionCache(object):
+    ''' The projections of the panorama features of the viewpoints of a
+        FeatureBank by the linear_in_v of a VisualSoftDotAttention and the
+        linear_in_a of an EltwiseProdScoring. These are the largest matmuls
+        of a decoder step, but depend only on the viewpoint and the weights,
+        so each viewpoint is projected the first time it is looked up. Since
+        the layers are linear, the location embeddings, which depend on the
+        view and the action angles, are projected separately and added.
+
+        Projections are made without gradients, so it is only for inference.
+        The decoder owning the cache drops it whenever the weights may change
+        (train(), eval() and load_state_dict), and anything else changing the
+        weights in eval mode should call its invalidate_projection_cache '''
+
+    def __init__(self, feature_bank):
+        self.feature_bank = feature_bank
+        self.slot_of_row = None
+
+    def _clear(self, linear_in_v, linear_in_a):
+        feature_dim = self.feature_bank.features.size(2)
+        self.slot_of_row = try_cuda(torch.full((len(self.feature_bank.rows),), -1, dtype=torch.long))
+        self.num_slots = 0
+        self.visual_projections = None
+        self.action_projections = None
+        # (view index, v_num, dot_dim)
+        self.loc_projections = F.linear(
+            self.feature_bank.loc_embeddings, linear_in_v.weight[:, feature_dim:], linear_in_v.bias)
+
+    def _add_rows(self, rows, linear_in_v, linear_in_a):
+        feature_dim = self.feature_bank.features.size(2)
+        features = self.feature_bank.get_features(rows)
+        visual_projections = F.linear(features, linear_in_v.weight[:, :feature_dim])
+        action_projections = F.linear(features, linear_in_a.weight[:, :feature_dim])
+        capacity = 0 if self.visual_projections is None else self.visual_projections.size(0)
+        if self.num_slots + len(rows) > capacity:
+            capacity = max(2 * capacity, self.num_slots + len(rows))
+            grown_visual = visual_projections.new_zeros((capacity,) + visual_projections.size()[1:])
+            grown_action = action_projections.new_zeros((capacity,) + action_projections.size()[1:])
+            if self.num_slots > 0:
+                grown_visual[:self.num_slots] = self.visual_projections[:self.num_slots]
+                grown_action[:self.num_slots] = self.action_projections[:self.num_slots]
+            self.visual_projections = grown_visual
+            self.action_projections = grown_action
+        slots = try_cuda(torch.arange(self.num_slots, self.num_slots + len(rows)))
+        self.visual_projections[slots] = visual_projections
+        self.action_projections[slots] = action_projections
+        self.slot_of_row[rows] = slots
+        self.num_slots += len(rows)
+
+    def project(self, indices, linear_in_v, linear_in_a):
+        ''' linear_in_v of the visual context and linear_in_a of the action
+            embeddings of the observations of a FeatureBankIndices '''
+        with torch.no_grad():
+            if self.slot_of_row is None:
+                self._clear(linear_in_v, linear_in_a)
+            slots = self.slot_of_row[indices.rows]
+            missing = slots < 0
+            if missing.any():
+                self._add_rows(torch.unique(indices.rows[missing]), linear_in_v, linear_in_a)
+                slots = self.slot_of_row[indices.rows]
+
+            projected_context = self.visual_projections[slots] + self.loc_projections[indices.view_indices]
+            feature_dim = self.feature_bank.features.size(2)
+            action_projections = self.action_projections[slots].gather(
+                1, indices.action_view_indices.clamp(min=0).unsqueeze(2).expand(-1, -1, linear_in_a.out_features))
+            action_loc_projections = F.linear(
+                self.feature_bank.get_action_loc_embeddings(indices.action_angles), linear_in_a.weight[:, feature_dim:])
+            # stop and padding have zero embeddings, which project to the bias
+            projected_actions = (action_projections + action_loc_projections) * \
+                (indices.action_view_indices >= 0).unsqueeze(2).float() + linear_in_a.bias
+        return projected_context, projected_actions
+
+
 class AttnDecoderLSTM(nn.Module):
     '''
     An unrolled LSTM with attention over instructions for decoding navigation
@@ -373,9 +454,10 @@ class AttnDecoderLSTM(nn.Module):
             hidden_size, feature_size)
         self.text_attention_layer = SoftDotAttention(hidden_size)
         self.decoder2action = EltwiseProdScoring(hidden_size, embedding_size)
+        self.projection_cache = None
 
     def forward(self, u_t_prev, all_u_t, visual_context, h_0, c_0, ctx,
-                ctx_mask=None):
+                ctx_mask=None, feature_bank_indices=None):
         ''' Takes a single step in the decoder LSTM (allowing sampling).
 
         u_t_prev: batch x embedding_size
@@ -385,17 +467,43 @@ class AttnDecoderLSTM(nn.Module):
         c_0: batch x hidden_size
         ctx: batch x seq_len x dim
         ctx_mask: batch x seq_len - indices to be masked
+        feature_bank_indices: FeatureBankIndices of the observations, if they
+            were made with a feature bank. In eval mode, their projections
+            are then looked up in a ViewpointProjectionCache. Without a
+            feature bank (no --feature_bank) the observations don't identify
+            their viewpoints, and visual_context is projected at every step
         '''
-        feature, alpha_v = self.visual_attention_layer(h_0, visual_context)
+        projected_context = projected_actions = None
+        if feature_bank_indices is not None and not self.training:
+            if self.projection_cache is None or \
+                    self.projection_cache.feature_bank is not feature_bank_indices.feature_bank:
+                self.projection_cache = ViewpointProjectionCache(feature_bank_indices.feature_bank)
+            projected_context, projected_actions = self.projection_cache.project(
+                feature_bank_indices, self.visual_attention_layer.linear_in_v, self.decoder2action.linear_in_a)
+        feature, alpha_v = self.visual_attention_layer(
+            h_0, visual_context, projected_context=projected_context)
         # (batch, embedding_size+feature_size)
         concat_input = torch.cat((u_t_prev, feature), 1)
         drop = self.drop(concat_input)
         h_1, c_1 = self.lstm(drop, (h_0, c_0))
         h_1_drop = self.drop(h_1)
         h_tilde, alpha = self.text_attention_layer(h_1_drop, ctx, ctx_mask)
-        logit = self.decoder2action(h_tilde, all_u_t)
+        logit = self.decoder2action(h_tilde, all_u_t, projected_actions=projected_actions)
         return h_1, c_1, alpha, logit, alpha_v
 
+    def invalidate_projection_cache(self):
+        ''' Drop the cached projections, which were made with the current
+            weights '''
+        self.projection_cache = None
+
+    def train(self, mode=True):
+        self.invalidate_projection_cache()
+        return super(AttnDecoderLSTM, self).train(mode)
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        self.invalidate_projection_cache()
+        return super(AttnDecoderLSTM, self).load_state_dict(state_dict, *args, **kwargs)
+
 
 ###############################################################################
 # speaker models
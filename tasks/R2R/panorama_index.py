@@ -0,0 +1,149 @@
+''' Precomputed panorama adjacency lists, keyed by (scanId, viewpointId, viewIndex) '''
+
+import os
+import os.path
+import json
+import functools
+import argparse
+
+import numpy as np
+
+import paths
+import interning
+
+NUM_VIEWS = 36
+
+
+class PanoramaIndex(object):
+    ''' Read-only lookup of the adj_loc_list that _get_panorama_states would
+        return for a given location and discretized view.
+
+        The index is stored as flat arrays: the adjacent locations (excluding
+        the 'stop' entry) of (viewpoint row, viewIndex) k are the entries in
+        [offsets[k], offsets[k+1]), already sorted by abs(rel_heading). '''
+
+    def __init__(self, path):
+        print('Loading panorama adjacency index from %s' % path)
+        data = np.load(path)
+        self.scans = data['scans'].tolist()
+        self.viewpoints = data['viewpoints'].tolist()
+        self._rows = interning.ViewpointRows(self.viewpoints)
+        self.offsets = data['offsets']
+        self.next_viewpoint = data['next_viewpoint']
+        self.abs_view_index = data['abs_view_index']
+        self.rel_heading = data['rel_heading']
+        self.rel_elevation = data['rel_elevation']
+        self.distance = data['distance']
+
+    def __contains__(self, scan_and_viewpoint):
+        return scan_and_viewpoint[1] in self._rows
+
+    def get_adj_loc_list(self, scanId, viewpointId, viewIndex):
+        ''' Returns None if the location is not in the index '''
+        row = self._rows.get(viewpointId)
+        if row is None:
+            return None
+        k = row * NUM_VIEWS + viewIndex
+        start, end = self.offsets[k], self.offsets[k + 1]
+        stop = {
+            'absViewIndex': -1,
+            'nextViewpointId': viewpointId}
+        adj_loc_list = [stop]
+        for next_viewpoint, absViewIndex, rel_heading, rel_elevation, distance in zip(
+                self.next_viewpoint[start:end].tolist(),
+                self.abs_view_index[start:end].tolist(),
+                self.rel_heading[start:end].tolist(),
+                self.rel_elevation[start:end].tolist(),
+                self.distance[start:end].tolist()):
+            adj_loc_list.append({
+                'absViewIndex': absViewIndex,
+                'nextViewpointId': self.viewpoints[next_viewpoint],
+                'rel_heading': rel_heading,
+                'rel_elevation': rel_elevation,
+                'distance': distance})
+        return adj_loc_list
+
+
+@functools.lru_cache(maxsize=None)
+def load_panorama_index(path=paths.panorama_index_path):
+    ''' Load the index shared by all environments in this process, or return
+        None if it hasn't been built yet '''
+    if not os.path.exists(path):
+        return None
+    return PanoramaIndex(path)
+
+
+def load_included_viewpoints(scan):
+    with open('connectivity/%s_connectivity.json' % scan) as f:
+        return [item['image_id'] for item in json.load(f) if item['included']]
+
+
+def build_panorama_index(scans, output_path):
+    ''' Sweep every included viewpoint of every scan from each of the 36
+        discretized views with the simulator, and save the resulting
+        adjacency lists '''
+    # imported here so that loading an index doesn't require the simulator
+    from env import make_sim, _get_panorama_states, ImageFeatures, angle_inc
+
+    sim = make_sim(ImageFeatures.IMAGE_W, ImageFeatures.IMAGE_H, ImageFeatures.VFOV)
+    viewpoints = []
+    viewpoint_scans = []
+    for scan_ix, scan in enumerate(scans):
+        for viewpointId in load_included_viewpoints(scan):
+            viewpoints.append(viewpointId)
+            viewpoint_scans.append(scan_ix)
+    viewpoint_rows = {vp: row for row, vp in enumerate(viewpoints)}
+    assert len(viewpoint_rows) == len(viewpoints), 'viewpoint ids should be unique across scans'
+
+    offsets = [0]
+    next_viewpoint = []
+    abs_view_index = []
+    rel_heading = []
+    rel_elevation = []
+    distance = []
+    for row, (viewpointId, scan_ix) in enumerate(zip(viewpoints, viewpoint_scans)):
+        if row % 1000 == 0:
+            print('%d / %d viewpoints' % (row, len(viewpoints)))
+        for viewIndex in range(NUM_VIEWS):
+            heading = (viewIndex % 12) * angle_inc
+            elevation = (viewIndex // 12 - 1) * angle_inc
+            sim.newEpisode(scans[scan_ix], viewpointId, heading, elevation)
+            state, adj_loc_list = _get_panorama_states(sim)
+            assert state.viewIndex == viewIndex
+            for adj_dict in adj_loc_list[1:]:
+                next_viewpoint.append(viewpoint_rows[adj_dict['nextViewpointId']])
+                abs_view_index.append(adj_dict['absViewIndex'])
+                rel_heading.append(adj_dict['rel_heading'])
+                rel_elevation.append(adj_dict['rel_elevation'])
+                distance.append(adj_dict['distance'])
+            offsets.append(len(next_viewpoint))
+
+    np.savez_compressed(
+        output_path,
+        scans=np.array(scans),
+        viewpoints=np.array(viewpoints),
+        viewpoint_scans=np.array(viewpoint_scans, dtype=np.int16),
+        offsets=np.array(offsets, dtype=np.int32),
+        next_viewpoint=np.array(next_viewpoint, dtype=np.int32),
+        abs_view_index=np.array(abs_view_index, dtype=np.int8),
+        rel_heading=np.array(rel_heading, dtype=np.float32),
+        rel_elevation=np.array(rel_elevation, dtype=np.float32),
+        distance=np.array(distance, dtype=np.float32))
+    print('Wrote adjacency for %d viewpoints to %s' % (len(viewpoints), output_path))
+
+
+def make_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output_path", default=paths.panorama_index_path)
+    parser.add_argument("--scans", nargs="+", help="defaults to all scans in connectivity/scans.txt")
+    return parser
+
+
+if __name__ == "__main__":
+    args = make_arg_parser().parse_args()
+    if args.scans:
+        scans = args.scans
+    else:
+        with open('connectivity/scans.txt') as f:
+            scans = [scan.strip() for scan in f.readlines()]
+    build_panorama_index(scans, args.output_path)
@@ -8,9 +8,20 @@ mean_pooled_feature_store_paths = {
     'places365': 'img_features/ResNet-152-places365.tsv',
 }
 
+# converted from the tsv files by feature_store.py
+mean_pooled_binary_feature_store_paths = {
+    'imagenet': 'img_features/ResNet-152-imagenet',
+    'places365': 'img_features/ResNet-152-places365',
+}
+
 bottom_up_feature_store_path = "img_features/bottom_up_10_100"
 bottom_up_feature_cache_path = "img_features/bottom_up_10_100.pkl"
 bottom_up_feature_cache_dir = "img_features/bottom_up_10_100_cache"
 
 bottom_up_attribute_path = "data/visual_genome/attributes_vocab.txt"
 bottom_up_object_path = "data/visual_genome/objects_vocab.txt"
+
+panorama_index_path = "img_features/panorama_index.npz"
+
+# per-scan shortest path distances and next hops, written by shortest_paths.py
+nav_graph_cache_dir = "tasks/R2R/data/nav_graph_cache"
@@ -0,0 +1,101 @@
+''' Measure how much quantizing the mean-pooled feature store changes the
+    features, and the follower and speaker scores of gold paths, on the
+    validation splits '''
+
+import pprint
+
+import numpy as np
+import torch
+
+import utils
+import train
+import train_speaker
+from env import MemmapMeanPooledImageFeatures
+
+
+def _gold_path_scores(env, follower, speaker, load_next_minibatch):
+    path_obs, path_actions, encoded_instructions = \
+        env.gold_obs_actions_and_instructions(
+            train.max_episode_len, load_next_minibatch=load_next_minibatch)
+    with torch.no_grad():
+        follower_trajs, _ = follower._score_obs_actions_and_instructions(
+            path_obs, path_actions, encoded_instructions)
+        speaker_outputs, _ = speaker._score_obs_actions_and_instructions(
+            path_obs, path_actions, encoded_instructions, feedback='teacher')
+    features = np.stack([ob['feature'][0] for path_o in path_obs for ob in path_o])
+    return (np.array([float(traj['score']) for traj in follower_trajs]),
+            np.array([output['score'] for output in speaker_outputs]),
+            features)
+
+
+def measure_drift(env, follower, speaker, quantized_features, n_batches):
+    float32_features = env.image_features_list
+    follower.env = env
+    speaker.env = env
+    env.reset_epoch()
+    feature_errors = []
+    follower_drift = []
+    speaker_drift = []
+    for _ in range(n_batches):
+        env.image_features_list = float32_features
+        env.observation_cache.clear()
+        follower_scores, speaker_scores, features = _gold_path_scores(
+            env, follower, speaker, load_next_minibatch=True)
+        # score the same batch again with the quantized features
+        env.image_features_list = quantized_features
+        env.observation_cache.clear()
+        q_follower_scores, q_speaker_scores, q_features = _gold_path_scores(
+            env, follower, speaker, load_next_minibatch=False)
+        feature_errors.append(np.abs(q_features - features).max())
+        follower_drift.extend(np.abs(q_follower_scores - follower_scores))
+        speaker_drift.extend(np.abs(q_speaker_scores - speaker_scores))
+    env.image_features_list = float32_features
+    env.observation_cache.clear()
+    return {
+        'max_feature_error': float(np.max(feature_errors)),
+        'mean_follower_score_drift': float(np.mean(follower_drift)),
+        'max_follower_score_drift': float(np.max(follower_drift)),
+        'mean_speaker_score_drift': float(np.mean(speaker_drift)),
+        'max_speaker_score_drift': float(np.max(speaker_drift)),
+    }
+
+
+def drift_entry_point(args):
+    assert args.mean_pooled_feature_format == "memmap" and args.mean_pooled_feature_dtype == "float32", \
+        'drift is measured against the float32 memmap store'
+    assert not args.feature_bank, \
+        'drift swaps the featurizers of the envs, which a feature bank would ignore'
+    follower, follower_train_env, follower_val_envs = train.train_setup(
+        args, args.batch_size)
+    load_args = {}
+    if args.no_cuda:
+        load_args['map_location'] = 'cpu'
+    follower.load(args.follower_prefix, **load_args)
+    speaker, speaker_train_env, speaker_val_envs = \
+        train_speaker.train_setup(args)
+    speaker.load(args.speaker_prefix, **load_args)
+    follower.encoder.eval()
+    follower.decoder.eval()
+    speaker.encoder.eval()
+    speaker.decoder.eval()
+
+    for dtype in args.quantized_dtype:
+        quantized_features = [MemmapMeanPooledImageFeatures(args.image_feature_datasets, dtype=dtype)]
+        for env_name, (val_env, evaluator) in sorted(follower_val_envs.items()):
+            drift = measure_drift(val_env, follower, speaker, quantized_features, args.n_batches)
+            print('%s %s' % (env_name, dtype))
+            pprint.pprint(drift)
+
+
+def make_arg_parser():
+    parser = train.make_arg_parser()
+    parser.add_argument("follower_prefix")
+    parser.add_argument("speaker_prefix")
+    parser.add_argument("--quantized_dtype", nargs="+", choices=["float16", "int8"], default=["float16", "int8"])
+    parser.add_argument("--batch_size", type=int, default=30)
+    parser.add_argument("--n_batches", type=int, default=10)
+    return parser
+
+
+if __name__ == "__main__":
+    utils.run(make_arg_parser(), drift_entry_point)
@@ -14,7 +14,8 @@ def run_rational_follower(envir, evaluator, follower, speaker, beam_size,
                           include_gold=False, output_file=None, eval_file=None,
                           compute_oracle=False, mask_undo=False,
                           state_factored_search=False, state_first_n_ws_key=4,
-                          physical_traversal=False):
+                          state_expansion_budget=None, physical_traversal=False,
+                          state_successor_size=1):
     follower.env = envir
     envir.reset_epoch()
 
@@ -44,8 +45,9 @@ def run_rational_follower(envir, evaluator, follower, speaker, beam_size,
         if state_factored_search:
             beam_candidates, candidate_inf_states, traversed_lists = \
                 follower.state_factored_search(
-                    beam_size, 1, load_next_minibatch=not include_gold,
-                    mask_undo=mask_undo, first_n_ws_key=state_first_n_ws_key)
+                    beam_size, state_successor_size, load_next_minibatch=not include_gold,
+                    mask_undo=mask_undo, first_n_ws_key=state_first_n_ws_key,
+                    expansion_budget=state_expansion_budget)
         else:
             beam_candidates, candidate_inf_states, traversed_lists = \
                 follower.beam_search(
@@ -87,7 +89,8 @@ def run_rational_follower(envir, evaluator, follower, speaker, beam_size,
                     candidate_inf_state = \
                         candidate_inf_states[instance_index][i]
                     path_from_last_to_next = least_common_viewpoint_path(
-                        last_traversed, candidate_inf_state)
+                        last_traversed, candidate_inf_state,
+                        traversed_lists[instance_index].ancestor_index)
                     assert path_from_last_to_next[0].world_state.viewpointId \
                         == last_traversed.world_state.viewpointId
                     assert path_from_last_to_next[-1].world_state.viewpointId \
@@ -135,6 +138,15 @@ def run_rational_follower(envir, evaluator, follower, speaker, beam_size,
                       for cand in lst]
                       
 
+    if state_factored_search:
+        num_exhausted = sum(
+            any(cand.get('budget_exhausted', False) for cand in lst)
+            for lst in candidate_lists_by_instr_id.values())
+        if num_exhausted:
+            print("state factored search ran out of expansion budget on "
+                  "%d instructions; their unstopped candidates have "
+                  "budget_exhausted set" % num_exhausted)
+
     speaker_std = np.std(speaker_scores)
     follower_std = np.std(follower_scores)
 
@@ -237,6 +249,8 @@ def validate_entry_point(args):
             mask_undo=args.mask_undo,
             state_factored_search=args.state_factored_search,
             state_first_n_ws_key=args.state_first_n_ws_key,
+            state_expansion_budget=args.state_expansion_budget,
+            state_successor_size=args.state_successor_size,
             physical_traversal=args.physical_traversal,
         )
         pprint.pprint(accuracies_by_weight)
@@ -260,8 +274,22 @@ def make_arg_parser():
     parser.add_argument("--eval_file")
     parser.add_argument("--compute_oracle", action='store_true')
     parser.add_argument("--mask_undo", action='store_true')
-    parser.add_argument("--state_factored_search", action='store_true')
+    parser.add_argument("--state_factored_search", action='store_true',
+                        help="search with state_factored_search instead of "
+                             "beam_search. Each expanded state only keeps its "
+                             "--state_successor_size best actions as "
+                             "successors, so results differ from searches "
+                             "that kept every action")
+    parser.add_argument("--state_successor_size", type=int, default=1,
+                        help="states expanded for each instance at each step "
+                             "of state factored search, and best actions "
+                             "kept as successors of each")
     parser.add_argument("--state_first_n_ws_key", type=int, default=4)
+    parser.add_argument("--state_expansion_budget", type=int,
+                        help="total states expanded by each state factored search, "
+                             "across the batch (default: no limit). Instances "
+                             "cut off without a stopped path get their best "
+                             "unstopped state, marked budget_exhausted")
     parser.add_argument("--physical_traversal", action='store_true')
 
     return parser
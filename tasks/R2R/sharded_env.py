@@ -0,0 +1,248 @@
+''' EnvBatch with the batch split into shards, each stepped by its own
+    worker process. States come back through shared memory as flat arrays
+    of viewpoint indices and angles rather than as pickled objects '''
+
+import atexit
+import multiprocessing
+import traceback
+
+import numpy as np
+
+from env import EnvBatch, NavGraphEnvBatch, NavGraphLocation, NavGraphState, WorldState, load_nav_graph_scan
+from utils import flatten
+
+# bytes of shared memory per state in each worker's block, enough for the
+# navigable locations and adj_loc_list of any viewpoint of the dataset
+_SHARED_BYTES_PER_STATE = 4096
+
+
+def _layout_arrays(arrays):
+    ''' (name, dtype, shape, offset) of each of arrays: list of (name, array)
+        packed into one block, and the size of the block '''
+    layout = []
+    size = 0
+    for name, array in arrays:
+        size = (size + 7) // 8 * 8
+        layout.append((name, array.dtype.str, array.shape, size))
+        size += array.nbytes
+    return layout, size
+
+
+class _SharedArrays(object):
+    ''' Writes named arrays into a block of shared memory (a RawArray made
+        before the worker was started, since python 3.6 can't share memory
+        made afterwards). Arrays that don't fit in it are sent through the
+        pipe instead '''
+
+    def __init__(self, block):
+        self.block = block
+
+    def write(self, arrays):
+        ''' arrays: list of (name, array). Returns what _SharedArraysReader.read
+            reads them back from '''
+        layout, size = _layout_arrays(arrays)
+        if size > len(self.block):
+            return 'pickled', arrays
+        for (name, dtype, shape, offset), (_, array) in zip(layout, arrays):
+            np.ndarray(shape, dtype, buffer=self.block, offset=offset)[...] = array
+        return 'shared', layout
+
+
+class _SharedArraysReader(object):
+    def __init__(self, block):
+        self.block = block
+
+    def read(self, kind, payload):
+        if kind == 'pickled':
+            return dict(payload)
+        return {array_name: np.ndarray(shape, dtype, buffer=self.block, offset=offset).copy()
+                for array_name, dtype, shape, offset in payload}
+
+
+def _encode_states(states):
+    ''' Flatten (state, adj_loc_list) pairs into arrays, identifying
+        viewpoints by their index in the scan's connectivity graph '''
+    state_ints, state_floats = [], []
+    navigable_ints, navigable_floats = [], []
+    adj_ints, adj_floats = [], []
+    for state, adj_loc_list in states:
+        scan = load_nav_graph_scan(state.scanId)
+        state_ints.append([state.step, state.viewIndex, scan.index[state.location.viewpointId],
+                           len(state.navigableLocations), len(adj_loc_list) - 1])
+        state_floats.append([state.heading, state.elevation])
+        for loc in state.navigableLocations:
+            navigable_ints.append(scan.index[loc.viewpointId])
+            navigable_floats.append([loc.rel_heading, loc.rel_elevation, loc.rel_distance])
+        for adj_dict in adj_loc_list[1:]:
+            adj_ints.append([scan.index[adj_dict['nextViewpointId']], adj_dict['absViewIndex']])
+            adj_floats.append([adj_dict['rel_heading'], adj_dict['rel_elevation'], adj_dict['distance']])
+    return [
+        ('state_ints', np.array(state_ints, dtype=np.int32).reshape(-1, 5)),
+        ('state_floats', np.array(state_floats, dtype=np.float64).reshape(-1, 2)),
+        ('navigable_ints', np.array(navigable_ints, dtype=np.int32)),
+        ('navigable_floats', np.array(navigable_floats, dtype=np.float64).reshape(-1, 3)),
+        ('adj_ints', np.array(adj_ints, dtype=np.int32).reshape(-1, 2)),
+        ('adj_floats', np.array(adj_floats, dtype=np.float64).reshape(-1, 3))]
+
+
+def _decode_states(world_states, arrays):
+    state_ints = arrays['state_ints'].tolist()
+    state_floats = arrays['state_floats'].tolist()
+    navigable_ints = arrays['navigable_ints'].tolist()
+    navigable_floats = arrays['navigable_floats'].tolist()
+    adj_ints = arrays['adj_ints'].tolist()
+    adj_floats = arrays['adj_floats'].tolist()
+    assert len(state_ints) == len(world_states)
+    states = []
+    navigable_start = 0
+    adj_start = 0
+    for world_state, (step, viewIndex, ix, num_navigable, num_adj), (heading, elevation) in zip(world_states, state_ints, state_floats):
+        scan = load_nav_graph_scan(world_state.scanId)
+        navigable_locations = [
+            NavGraphLocation(scan.viewpoints[j], j, scan.positions[j].tolist(), rel_heading, rel_elevation, rel_distance)
+            for j, (rel_heading, rel_elevation, rel_distance) in zip(
+                navigable_ints[navigable_start:navigable_start + num_navigable],
+                navigable_floats[navigable_start:navigable_start + num_navigable])]
+        navigable_start += num_navigable
+        adj_loc_list = [{
+            'absViewIndex': -1,
+            'nextViewpointId': scan.viewpoints[ix]}]
+        for (j, absViewIndex), (rel_heading, rel_elevation, distance) in zip(
+                adj_ints[adj_start:adj_start + num_adj], adj_floats[adj_start:adj_start + num_adj]):
+            adj_loc_list.append({
+                'absViewIndex': absViewIndex,
+                'nextViewpointId': scan.viewpoints[j],
+                'rel_heading': rel_heading,
+                'rel_elevation': rel_elevation,
+                'distance': distance})
+        adj_start += num_adj
+        state = NavGraphState(world_state.scanId, step, navigable_locations[0], heading, elevation, viewIndex, navigable_locations)
+        states.append((state, adj_loc_list))
+    return states
+
+
+def _encode_world_states(world_states):
+    return [
+        ('viewpoint_ints', np.array([load_nav_graph_scan(ws.scanId).index[ws.viewpointId] for ws in world_states], dtype=np.int32)),
+        ('angle_floats', np.array([[ws.heading, ws.elevation] for ws in world_states], dtype=np.float64).reshape(-1, 2))]
+
+
+def _decode_world_states(world_states, arrays):
+    return [WorldState(ws.scanId, load_nav_graph_scan(ws.scanId).viewpoints[ix], heading, elevation)
+            for ws, ix, (heading, elevation) in zip(
+                world_states, arrays['viewpoint_ints'].tolist(), arrays['angle_floats'].tolist())]
+
+
+def _worker(connection, block, batch_size, beam_size, env_backend, pin_scans):
+    if env_backend == 'nav_graph':
+        env = NavGraphEnvBatch(batch_size, beam_size)
+    else:
+        env = EnvBatch(batch_size, beam_size, pin_scans=pin_scans)
+    shared_arrays = _SharedArrays(block)
+    try:
+        while True:
+            command = connection.recv()
+            if command is None:
+                break
+            name, world_states, last_locations, beamed = command
+            try:
+                if name == 'getStates':
+                    results = env.getStates(world_states, beamed=beamed)
+                    arrays = _encode_states(flatten(results) if beamed else results)
+                else:
+                    assert name == 'makeActions'
+                    # each action is the only entry of a minimal adj_loc_list
+                    actions = [[0] * len(row) for row in last_locations] if beamed else [0] * len(last_locations)
+                    last_obs = [[{'adj_loc_list': [loc]} for loc in row] for row in last_locations] if beamed \
+                        else [{'adj_loc_list': [loc]} for loc in last_locations]
+                    results = env.makeActions(world_states, actions, last_obs, beamed=beamed)
+                    arrays = _encode_world_states(flatten(results) if beamed else results)
+                connection.send(('ok', shared_arrays.write(arrays)))
+            except Exception:
+                connection.send(('error', traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+class ShardedEnvBatch():
+    ''' Same interface as EnvBatch, with the batch rows (and their beams of
+        simulators) split over num_workers processes which are stepped in
+        parallel. The workers are stopped by close(), or at exit '''
+
+    def __init__(self, batch_size, beam_size, num_workers, env_backend='simulator', pin_scans=False):
+        self.batch_size = batch_size
+        self.beam_size = beam_size
+        num_workers = min(num_workers, batch_size)
+        self.shards = [shard.tolist() for shard in np.array_split(np.arange(batch_size), num_workers)]
+        self.connections = []
+        self.readers = []
+        self.workers = []
+        for shard in self.shards:
+            connection, worker_connection = multiprocessing.Pipe()
+            block = multiprocessing.RawArray('b', max(len(shard) * beam_size * _SHARED_BYTES_PER_STATE, 1 << 20))
+            worker = multiprocessing.Process(
+                target=_worker, args=(worker_connection, block, len(shard), beam_size, env_backend, pin_scans), daemon=True)
+            worker.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.readers.append(_SharedArraysReader(block))
+            self.workers.append(worker)
+        atexit.register(self.close)
+
+    def close(self):
+        for connection, worker in zip(self.connections, self.workers):
+            connection.send(None)
+            worker.join()
+            connection.close()
+        self.connections, self.readers, self.workers = [], [], []
+
+    def newEpisodes(self, scanIds, viewpointIds, headings, beamed=False):
+        assert len(scanIds) == len(viewpointIds)
+        assert len(headings) == len(viewpointIds)
+        assert len(scanIds) == self.batch_size
+        world_states = []
+        for scanId, viewpointId, heading in zip(scanIds, viewpointIds, headings):
+            world_state = WorldState(scanId, viewpointId, heading, 0)
+            if beamed:
+                world_states.append([world_state])
+            else:
+                world_states.append(world_state)
+        return world_states
+
+    def _dispatch(self, name, world_states, last_locations, beamed, decode):
+        # send to all the workers before waiting on any of them
+        for connection, shard in zip(self.connections, self.shards):
+            connection.send((name, [world_states[i] for i in shard],
+                             last_locations and [last_locations[i] for i in shard], beamed))
+        results = []
+        for connection, reader, shard in zip(self.connections, self.readers, self.shards):
+            status, payload = connection.recv()
+            if status != 'ok':
+                raise RuntimeError('%s failed in environment worker:\n%s' % (name, payload))
+            shard_world_states = [world_states[i] for i in shard]
+            decoded = decode(flatten(shard_world_states) if beamed else shard_world_states, reader.read(*payload))
+            if beamed:
+                start = 0
+                for row in shard_world_states:
+                    results.append(decoded[start:start + len(row)])
+                    start += len(row)
+            else:
+                results.extend(decoded)
+        return results
+
+    def getStates(self, world_states, beamed=False):
+        ''' Get list of states. '''
+        return self._dispatch('getStates', world_states, None, beamed, _decode_states)
+
+    def makeActions(self, world_states, actions, last_obs, beamed=False):
+        ''' Take an action using the full state dependent action interface (with batched input).
+            Each action is an index in the adj_loc_list,
+            0 means staying still (i.e. stop)
+        '''
+        def f(action, last_ob):
+            loc_attr = last_ob['adj_loc_list'][action]
+            return {'nextViewpointId': loc_attr['nextViewpointId'], 'absViewIndex': loc_attr['absViewIndex']}
+        last_locations = [
+            [f(action, last_ob) for action, last_ob in zip(row_actions, row_obs)] if beamed else f(row_actions, row_obs)
+            for row_actions, row_obs in zip(actions, last_obs)]
+        return self._dispatch('makeActions', world_states, last_locations, beamed, _decode_world_states)
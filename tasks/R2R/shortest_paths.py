@@ -0,0 +1,89 @@
+''' All-pairs shortest path distances and next hops of each scan's
+    navigation graph, shared by every environment and evaluator in a process
+    and cached on disk between runs '''
+
+import os
+import os.path
+import hashlib
+import functools
+
+import numpy as np
+import networkx as nx
+
+import paths
+import interning
+from utils import load_nav_graphs
+
+
+class ScanShortestPaths(object):
+    ''' distances[i, j] is the shortest path distance from viewpoints[i] to
+        viewpoints[j] (inf if unreachable), and next_hops[i, j] the index of
+        the viewpoint after viewpoints[i] on that path (-1 if i == j or j is
+        unreachable). The paths are the ones nx.all_pairs_dijkstra_path
+        returns, so ties are broken the same way '''
+
+    def __init__(self, viewpoints, distances, next_hops):
+        self.viewpoints = viewpoints
+        self.index = interning.ViewpointRows(viewpoints)
+        self.distances = distances
+        self.next_hops = next_hops
+
+    def distance(self, viewpointId, goalViewpointId):
+        return float(self.distances[self.index[viewpointId], self.index[goalViewpointId]])
+
+    def next_viewpoint(self, viewpointId, goalViewpointId):
+        ''' The viewpoint after viewpointId on the shortest path to goalViewpointId '''
+        next_ix = self.next_hops[self.index[viewpointId], self.index[goalViewpointId]]
+        assert next_ix >= 0, '%s is not reachable from %s' % (goalViewpointId, viewpointId)
+        return self.viewpoints[next_ix]
+
+    def path(self, viewpointId, goalViewpointId):
+        ''' Shortest path, including both ends '''
+        path = [viewpointId]
+        while path[-1] != goalViewpointId:
+            path.append(self.next_viewpoint(path[-1], goalViewpointId))
+        return path
+
+
+def compute_shortest_paths(G):
+    viewpoints = list(G.nodes())
+    index = {viewpointId: ix for ix, viewpointId in enumerate(viewpoints)}
+    distances = np.full((len(viewpoints), len(viewpoints)), np.inf)
+    next_hops = np.full((len(viewpoints), len(viewpoints)), -1, dtype=np.int16)
+    for source_ix, source in enumerate(viewpoints):
+        source_distances, source_paths = nx.single_source_dijkstra(G, source)
+        for target, distance in source_distances.items():
+            distances[source_ix, index[target]] = distance
+        for target, path in source_paths.items():
+            if len(path) > 1:
+                next_hops[source_ix, index[target]] = index[path[1]]
+    return ScanShortestPaths(viewpoints, distances, next_hops)
+
+
+def _connectivity_hash(scan):
+    with open('connectivity/%s_connectivity.json' % scan, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def load_shortest_paths(scan, cache_dir=paths.nav_graph_cache_dir):
+    ''' Shortest paths of a scan, read from cache_dir if they've been computed
+        from the same connectivity graph before '''
+    connectivity_hash = _connectivity_hash(scan)
+    cache_path = os.path.join(cache_dir, '%s.npz' % scan) if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        data = np.load(cache_path)
+        if str(data['connectivity_hash']) == connectivity_hash:
+            return ScanShortestPaths(data['viewpoints'].tolist(), data['distances'], data['next_hops'])
+    shortest_paths = compute_shortest_paths(load_nav_graphs([scan])[scan])
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write then rename, so that concurrent processes never read a partial file
+        tmp_path = '%s.%d.tmp.npz' % (cache_path[:-len('.npz')], os.getpid())
+        np.savez(tmp_path,
+                 connectivity_hash=connectivity_hash,
+                 viewpoints=np.array(shortest_paths.viewpoints),
+                 distances=shortest_paths.distances,
+                 next_hops=shortest_paths.next_hops)
+        os.replace(tmp_path, cache_path)
+    return shortest_paths
@@ -83,6 +83,17 @@ class Seq2SeqSpeaker(object):
         assert batch_size == len(path_actions)
 
         mask = np.ones((batch_size, max_path_length), np.uint8)
+        if self.env.feature_bank is not None:
+            batched_image_features, batched_action_embeddings = \
+                self._gather_features_and_action_embeddings(path_obs, path_actions, mask)
+            return [obs[0] for obs in path_obs], \
+                   batched_image_features, \
+                   batched_action_embeddings, \
+                   try_cuda(torch.from_numpy(mask)), \
+                   list(seq_lengths), \
+                   encoded_instructions, \
+                   list(perm_indices)
+
         action_embedding_dim = path_obs[0][0]['action_embedding'].shape[-1]
         batched_action_embeddings = [
             np.zeros((batch_size, action_embedding_dim), np.float32)
@@ -120,6 +131,41 @@ class Seq2SeqSpeaker(object):
                encoded_instructions, \
                list(perm_indices)
 
+    def _gather_features_and_action_embeddings(self, path_obs, path_actions, mask):
+        ''' The image features and action embeddings of each step of the
+            paths, gathered from the env's feature bank (and zero after the end
+            of a path). Fills in mask '''
+        max_path_length = mask.shape[1]
+        batch_size = len(path_obs)
+        feature_rows = np.zeros((max_path_length, batch_size), np.int64)
+        view_indices = np.zeros((max_path_length, batch_size), np.int64)
+        action_view_indices = np.full((max_path_length, batch_size, 1), -1, np.int64)
+        action_angles = np.zeros((max_path_length, batch_size, 1, 2), np.float64)
+        for i, (obs, actions) in enumerate(zip(path_obs, path_actions)):
+            # don't include the last state, which should result after the stop action
+            assert len(obs) == len(actions) + 1
+            obs = obs[:-1]
+            mask[i, :len(actions)] = 0
+            for t, (ob, a) in enumerate(zip(obs, actions)):
+                assert a >= 0
+                feature_rows[t, i] = ob['feature_row']
+                view_indices[t, i] = ob['viewIndex']
+                action_view_indices[t, i, 0] = ob['action_view_indices'][a]
+                action_angles[t, i, 0] = ob['action_angles'][a]
+        feature_bank = self.env.feature_bank
+        is_step = try_cuda(torch.from_numpy(1 - mask.T.reshape(-1)).float())
+        features = feature_bank.get_features_with_loc(
+            try_cuda(torch.from_numpy(feature_rows.reshape(-1))),
+            try_cuda(torch.from_numpy(view_indices.reshape(-1))))
+        features = features * is_step.view(-1, 1, 1)
+        action_embeddings = feature_bank.get_action_embeddings(
+            try_cuda(torch.from_numpy(feature_rows.reshape(-1))),
+            try_cuda(torch.from_numpy(action_view_indices.reshape(-1, 1))),
+            try_cuda(torch.from_numpy(action_angles.reshape(-1, 1, 2))))
+        batched_image_features = list(features.view((max_path_length, batch_size) + features.size()[1:]))
+        batched_action_embeddings = list(action_embeddings.view(max_path_length, batch_size, -1))
+        return batched_image_features, batched_action_embeddings
+
     def _score_obs_actions_and_instructions(self, path_obs, path_actions, encoded_instructions, feedback):
         assert len(path_obs) == len(path_actions)
         assert len(path_obs) == len(encoded_instructions)
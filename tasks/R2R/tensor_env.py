@@ -0,0 +1,186 @@
+''' An R2RBatch whose agents are stepped and observed as tensors. The
+    navigation graphs of its scans are padded adjacency tables and the
+    features are in a feature bank on the compute device, so that the states,
+    transitions, observations and teacher actions of a whole batch (or beam)
+    are a few index and gather operations '''
+
+from collections import namedtuple
+
+import numpy as np
+import torch
+
+from env import R2RBatch, FeatureBankIndices, load_nav_graph_scan, discretize_view, view_heading_elevation
+from shortest_paths import load_shortest_paths
+from utils import try_cuda
+import interning
+
+
+TensorObservations = namedtuple("TensorObservations", ["features", "action_embeddings", "is_valid", "teacher", "feature_bank_indices"])
+
+
+class TensorizedNavGraphs(object):
+    ''' The navigation graphs of a set of scans, with the viewpoints numbered
+        by a global node index.
+
+        For node n with the camera at heading step h (viewIndex % 12), action a
+        (an index in the adj_loc_list, 0 being stop) leads to node
+        adj_nodes[n, h, a], looking at view adj_view_indices[n, h, a], with
+        rel_heading and rel_elevation in adj_rel_headings and
+        adj_rel_elevations. Entries past num_actions[n, h] are -1, as is the
+        view index of stop.
+
+        next_hops[next_hop_offsets[n] + node_local_ix[g]] is the node after n
+        on the shortest path from n to g (-1 if n == g) '''
+
+    def __init__(self, scans):
+        self.scans = sorted(scans)
+        self.node_offsets = {}
+        self.viewpoints = []
+        self.included = []
+        for scan in self.scans:
+            nav_scan = load_nav_graph_scan(scan)
+            self.node_offsets[scan] = len(self.viewpoints)
+            self.viewpoints.extend((scan, viewpointId) for viewpointId in nav_scan.viewpoints)
+            self.included.extend(nav_scan.included)
+        num_nodes = len(self.viewpoints)
+
+        adj_loc_lists = []
+        for scan in self.scans:
+            nav_scan = load_nav_graph_scan(scan)
+            for ix, included in enumerate(nav_scan.included):
+                if included:
+                    adj_loc_lists.append([nav_scan.get_adj_loc_list(ix, heading_step) for heading_step in range(12)])
+                else:
+                    adj_loc_lists.append([[{'absViewIndex': -1, 'nextViewpointId': nav_scan.viewpoints[ix]}]] * 12)
+        max_num_actions = max(len(adj_loc_list) for node_lists in adj_loc_lists for adj_loc_list in node_lists)
+        adj_nodes = np.full((num_nodes, 12, max_num_actions), -1, dtype=np.int64)
+        adj_view_indices = np.full((num_nodes, 12, max_num_actions), -1, dtype=np.int64)
+        adj_rel_headings = np.zeros((num_nodes, 12, max_num_actions), dtype=np.float64)
+        adj_rel_elevations = np.zeros((num_nodes, 12, max_num_actions), dtype=np.float64)
+        num_actions = np.zeros((num_nodes, 12), dtype=np.int64)
+        for node, node_lists in enumerate(adj_loc_lists):
+            scan = self.viewpoints[node][0]
+            nav_scan = load_nav_graph_scan(scan)
+            for heading_step, adj_loc_list in enumerate(node_lists):
+                num_actions[node, heading_step] = len(adj_loc_list)
+                for a, loc_attr in enumerate(adj_loc_list):
+                    adj_nodes[node, heading_step, a] = self.node_offsets[scan] + nav_scan.index[loc_attr['nextViewpointId']]
+                    if a > 0:
+                        adj_view_indices[node, heading_step, a] = loc_attr['absViewIndex']
+                        adj_rel_headings[node, heading_step, a] = loc_attr['rel_heading']
+                        adj_rel_elevations[node, heading_step, a] = loc_attr['rel_elevation']
+
+        node_local_ix = np.zeros(num_nodes, dtype=np.int64)
+        next_hop_offsets = np.zeros(num_nodes, dtype=np.int64)
+        next_hops = []
+        next_hops_size = 0
+        for scan in self.scans:
+            nav_scan = load_nav_graph_scan(scan)
+            offset = self.node_offsets[scan]
+            num_scan_nodes = len(nav_scan.viewpoints)
+            node_local_ix[offset:offset + num_scan_nodes] = np.arange(num_scan_nodes)
+            next_hop_offsets[offset:offset + num_scan_nodes] = next_hops_size + np.arange(num_scan_nodes) * num_scan_nodes
+            # the shortest paths number the viewpoints in graph order, so map them to the scan's order
+            shortest_paths = load_shortest_paths(scan)
+            local_ix = np.array([nav_scan.index[viewpointId] for viewpointId in shortest_paths.viewpoints], dtype=np.int64)
+            scan_next_hops = np.full((num_scan_nodes, num_scan_nodes), -1, dtype=np.int64)
+            scan_next_hops[np.ix_(local_ix, local_ix)] = np.where(
+                shortest_paths.next_hops >= 0, offset + local_ix[shortest_paths.next_hops], -1)
+            next_hops.append(scan_next_hops.reshape(-1))
+            next_hops_size += num_scan_nodes * num_scan_nodes
+
+        self.adj_nodes = try_cuda(torch.from_numpy(adj_nodes))
+        self.adj_view_indices = try_cuda(torch.from_numpy(adj_view_indices))
+        self.adj_rel_headings = try_cuda(torch.from_numpy(adj_rel_headings))
+        self.adj_rel_elevations = try_cuda(torch.from_numpy(adj_rel_elevations))
+        self.num_actions = try_cuda(torch.from_numpy(num_actions))
+        self.node_local_ix = try_cuda(torch.from_numpy(node_local_ix))
+        self.next_hop_offsets = try_cuda(torch.from_numpy(next_hop_offsets))
+        self.next_hops = try_cuda(torch.from_numpy(np.concatenate(next_hops)))
+
+    def node_index(self, scanId, viewpointId):
+        return self.node_offsets[scanId] + load_nav_graph_scan(scanId).get_ix(viewpointId)
+
+    def get_feature_rows(self, feature_bank):
+        ''' The row of each node in feature_bank (0 for nodes that aren't included) '''
+        included = np.array(self.included, dtype=bool)
+        ids = interning.viewpoints.intern_all([viewpointId for scanId, viewpointId in self.viewpoints])
+        rows = np.zeros(len(self.viewpoints), dtype=np.int64)
+        rows[included] = feature_bank.rows.rows_of_ids(ids[included])
+        return try_cuda(torch.from_numpy(rows))
+
+
+class TensorizedR2RBatch(R2RBatch):
+    ''' R2RBatch with, in addition to its methods on world states and
+        observation dicts, a tensor interface: world states are (nodes,
+        view_indices) tensors over the nodes of a TensorizedNavGraphs, and are
+        stepped and observed by reset_tensors, step_tensors and observe_tensors.
+        These compute transitions from the connectivity graphs, like the
+        nav_graph backend. It always has a feature bank '''
+
+    def __init__(self, image_features_list, *args, **kwargs):
+        kwargs['feature_bank'] = True
+        super(TensorizedR2RBatch, self).__init__(image_features_list, *args, **kwargs)
+        print('Building navigation graph tensors for %d scans' % len(self.scans))
+        self.graphs = TensorizedNavGraphs(self.scans)
+        self.feature_rows = self.graphs.get_feature_rows(self.feature_bank)
+
+    def reset_tensors(self, sort=False, load_next_minibatch=True):
+        ''' Load a new minibatch, returning the nodes and view indices of the
+            starting states, and setting goal_nodes to the goal of each item '''
+        if load_next_minibatch:
+            self._next_minibatch(sort)
+        assert len(self.batch) == self.batch_size
+        nodes = [self.graphs.node_index(item['scan'], item['path'][0]) for item in self.batch]
+        view_indices = [discretize_view(item['heading'], 0)[2] for item in self.batch]
+        self.goal_nodes = try_cuda(torch.LongTensor(
+            [self.graphs.node_index(item['scan'], item['path'][-1]) for item in self.batch]))
+        return try_cuda(torch.LongTensor(nodes)), try_cuda(torch.LongTensor(view_indices))
+
+    def step_tensors(self, nodes, view_indices, actions):
+        ''' Take an action (an index in the adj_loc_list, 0 to stop) from each state '''
+        heading_steps = view_indices % 12
+        next_nodes = self.graphs.adj_nodes[nodes, heading_steps, actions]
+        next_view_indices = self.graphs.adj_view_indices[nodes, heading_steps, actions]
+        next_view_indices = torch.where(actions == 0, view_indices, next_view_indices)
+        return next_nodes, next_view_indices
+
+    def observe_tensors(self, nodes, view_indices, goal_nodes=None):
+        ''' The features, padded action embeddings and valid actions of each
+            state, and its teacher action towards goal_nodes if given, as in
+            batch_observations, and the FeatureBankIndices they are made from '''
+        heading_steps = view_indices % 12
+        num_actions = self.graphs.num_actions[nodes, heading_steps]
+        max_num_a = int(num_actions.max())
+        is_valid = (try_cuda(torch.arange(max_num_a)).unsqueeze(0) < num_actions.unsqueeze(1)).float()
+        rows = self.feature_rows[nodes]
+        features_with_loc = self.feature_bank.get_features_with_loc(rows, view_indices)
+        action_angles = torch.stack([
+            self.graphs.adj_rel_headings[nodes, heading_steps, :max_num_a],
+            self.graphs.adj_rel_elevations[nodes, heading_steps, :max_num_a]], dim=2)
+        action_view_indices = self.graphs.adj_view_indices[nodes, heading_steps, :max_num_a]
+        action_embeddings = self.feature_bank.get_action_embeddings(rows, action_view_indices, action_angles)
+
+        if goal_nodes is None:
+            teacher = None
+        else:
+            next_nodes = self.graphs.next_hops[
+                self.graphs.next_hop_offsets[nodes] + self.graphs.node_local_ix[goal_nodes]]
+            adj_nodes = self.graphs.adj_nodes[nodes, heading_steps, :max_num_a]
+            # padding is -1, as is the next hop towards an unreachable goal
+            matches = (adj_nodes == next_nodes.unsqueeze(1)) & (adj_nodes >= 0)
+            found, teacher = matches.long().max(1)
+            missing = (found == 0) & (nodes != goal_nodes)
+            if missing.any():
+                i = int(missing.nonzero()[0])
+                print('node:', self.graphs.viewpoints[int(nodes[i])])
+                print('goal node:', self.graphs.viewpoints[int(goal_nodes[i])])
+                raise Exception('Bug: next hop towards the goal not in adj_loc_list')
+            teacher = teacher.masked_fill(nodes == goal_nodes, 0)
+        feature_bank_indices = FeatureBankIndices(self.feature_bank, rows, view_indices, action_view_indices, action_angles)
+        return TensorObservations(features_with_loc, action_embeddings, is_valid, teacher, feature_bank_indices)
+
+    def path_elements(self, nodes, view_indices):
+        ''' (viewpointId, heading, elevation) of each state, as in path_element_from_observation '''
+        return [(self.graphs.viewpoints[node][1],) + view_heading_elevation(view_index)
+                for node, view_index in zip(nodes, view_indices)]
@@ -12,6 +12,7 @@ import argparse
 import utils
 from utils import read_vocab, Tokenizer, vocab_pad_idx, timeSince, try_cuda
 from env import R2RBatch, ImageFeatures
+from tensor_env import TensorizedR2RBatch
 from model import EncoderLSTM, AttnDecoderLSTM
 from follower import Seq2SeqAgent
 import eval
@@ -171,14 +172,25 @@ def setup():
     torch.cuda.manual_seed(1)
 
 
+def make_env(args, image_features_list, splits, tokenizer,
+             batch_size=BATCH_SIZE):
+    if args.tensorized_env:
+        return TensorizedR2RBatch(image_features_list, batch_size=batch_size,
+                                  splits=splits, tokenizer=tokenizer,
+                                  **R2RBatch.kwargs_from_args(args))
+    return R2RBatch(image_features_list, batch_size=batch_size,
+                    splits=splits, tokenizer=tokenizer,
+                    **R2RBatch.kwargs_from_args(args))
+
+
 def make_more_train_env(args, train_vocab_path, train_splits,
                         batch_size=BATCH_SIZE):
     setup()
     image_features_list = ImageFeatures.from_args(args)
     vocab = read_vocab(train_vocab_path)
     tok = Tokenizer(vocab=vocab)
-    train_env = R2RBatch(image_features_list, batch_size=batch_size,
-                         splits=train_splits, tokenizer=tok)
+    train_env = make_env(args, image_features_list, train_splits, tok,
+                         batch_size=batch_size)
     return train_env
 
 
@@ -188,8 +200,8 @@ def make_env_and_models(args, train_vocab_path, train_splits, test_splits,
     image_features_list = ImageFeatures.from_args(args)
     vocab = read_vocab(train_vocab_path)
     tok = Tokenizer(vocab=vocab)
-    train_env = R2RBatch(image_features_list, batch_size=batch_size,
-                         splits=train_splits, tokenizer=tok)
+    train_env = make_env(args, image_features_list, train_splits, tok,
+                         batch_size=batch_size)
 
     enc_hidden_size = hidden_size//2 if args.bidirectional else hidden_size
     glove = np.load(glove_path)
@@ -201,8 +213,8 @@ def make_env_and_models(args, train_vocab_path, train_splits, test_splits,
         action_embedding_size, hidden_size, dropout_ratio,
         feature_size=feature_size))
     test_envs = {
-        split: (R2RBatch(image_features_list, batch_size=batch_size,
-                         splits=[split], tokenizer=tok),
+        split: (make_env(args, image_features_list, [split], tok,
+                         batch_size=batch_size),
                 eval.Evaluation([split]))
         for split in test_splits}
 
@@ -234,7 +246,8 @@ def train_setup(args, batch_size=BATCH_SIZE):
 
     agent = Seq2SeqAgent(
         train_env, "", encoder, decoder, max_episode_len,
-        max_instruction_length=MAX_INPUT_LENGTH)
+        max_instruction_length=MAX_INPUT_LENGTH,
+        pipelined=args.pipelined_rollouts)
 
     if args.use_pretraining:
         return agent, train_env, val_envs, pretrain_env
@@ -295,6 +308,7 @@ def train_val(args):
 def make_arg_parser():
     parser = argparse.ArgumentParser()
     ImageFeatures.add_args(parser)
+    R2RBatch.add_args(parser)
     parser.add_argument(
         "--feedback_method", choices=["sample", "teacher", "teacher+sample"],
         default="sample")
@@ -308,6 +322,12 @@ def make_arg_parser():
         "--use_train_subset", action='store_true',
         help="use a subset of the original train data for validation")
     parser.add_argument("--use_test_set", action='store_true')
+    parser.add_argument(
+        "--tensorized_env", action='store_true',
+        help="step and observe the follower's rollouts and beam search as tensors (trajectories then have no observations)")
+    parser.add_argument(
+        "--pipelined_rollouts", action='store_true',
+        help="step and observe half of the batch on a background thread while the follower's decoder runs on the other half")
     return parser
 
 
@@ -180,7 +180,8 @@ def make_env_and_models(args, train_vocab_path, train_splits, test_splits,
     vocab = read_vocab(train_vocab_path)
     tok = Tokenizer(vocab=vocab)
     train_env = R2RBatch(image_features_list, batch_size=batch_size,
-                         splits=train_splits, tokenizer=tok)
+                         splits=train_splits, tokenizer=tok,
+                         **R2RBatch.kwargs_from_args(args))
 
     enc_hidden_size = hidden_size//2 if bidirectional else hidden_size
     glove = np.load(glove_path)
@@ -195,7 +196,8 @@ def make_env_and_models(args, train_vocab_path, train_splits, test_splits,
     test_envs = {
         split: (R2RBatch(image_features_list, batch_size=batch_size,
                          splits=[split], tokenizer=tok,
-                         instruction_limit=test_instruction_limit),
+                         instruction_limit=test_instruction_limit,
+                         **R2RBatch.kwargs_from_args(args)),
                 eval_speaker.SpeakerEvaluation(
                     [split], instructions_per_path=test_instruction_limit))
         for split in test_splits}
@@ -258,6 +260,7 @@ def train_val(args):
 def make_arg_parser():
     parser = argparse.ArgumentParser()
     ImageFeatures.add_args(parser)
+    R2RBatch.add_args(parser)
     parser.add_argument(
         "--use_train_subset", action='store_true',
         help="use a subset of the original train data for validation")
@@ -7,12 +7,14 @@ import string
 import json
 import time
 import math
-from collections import Counter
+from collections import Counter, OrderedDict
 import numpy as np
 import networkx as nx
 import subprocess
 import itertools
 import base64
+import queue
+import threading
 
 
 # padding, unknown word, end of sentence
@@ -192,6 +194,103 @@ def flatten(lol):
 def all_equal(lst):
     return all(x == lst[0] for x in lst[1:])
 
+class LRUCache(object):
+    ''' Mapping with at most maxsize entries, evicting the least recently used
+        one when full. Counts hits, misses and evictions '''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        if key in self._data:
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+class OrderedWorker(object):
+    ''' Runs functions on a background thread, one at a time in the order
+        they are submitted, and hands their results back through a queue in
+        the same order. At most max_pending results may be outstanding (submitted
+        and not yet collected by result). With background=False the functions
+        run on the calling thread when they are submitted, so the two modes
+        run the same code in the same order '''
+
+    def __init__(self, max_pending, background=True):
+        self.background = background
+        self._results = queue.Queue(max_pending)
+        if background:
+            self._requests = queue.Queue(max_pending + 1)
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            function, args = request
+            try:
+                self._results.put((True, function(*args)))
+            except Exception as e:
+                self._results.put((False, e))
+
+    def submit(self, function, *args):
+        if self.background:
+            self._requests.put((function, args))
+        else:
+            self._results.put((True, function(*args)))
+
+    def result(self):
+        ''' The result of the oldest function whose result hasn't been
+            collected, waiting for it to finish. Reraises its exception '''
+        ok, value = self._results.get()
+        if not ok:
+            raise value
+        return value
+
+    def close(self):
+        if self.background:
+            # drop uncollected results, so that the thread can't block on them
+            while not self._results.empty():
+                self._results.get()
+            self._requests.put(None)
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
 def try_cuda(pytorch_obj):
     import torch.cuda
     try: